@@ -0,0 +1,391 @@
+"""Offline benchmark suite for the backend API.
+
+Starts the mock OpenAI-compatible server (`mock_llm_server.py`) and the
+backend (`uvicorn main:app`) as separate processes, points phi4 and deepseek
+at the mock, then drives each scenario at every concurrency level:
+
+    message         POST /api/message (streamed phi4 reply)
+    upload          POST /api/upload-document (unique text files)
+    templates       GET /api/prompt-templates
+    templates_304   GET /api/prompt-templates with a matching If-None-Match
+    categories      GET /api/categories
+    search          GET /api/prompt-templates/search
+    conversations   GET /api/conversations (a page of 100 seeded conversations)
+    messages        GET /api/conversations/{id}/messages (a page of 200 seeded messages)
+    enhance         POST /api/enhance-prompt
+    oversized       POST /api/message with content over the size limit (expects 422)
+
+The last four cover request validation and response serialization; their
+data is seeded through the API before the first run.
+
+For each run it reports requests/s, errors, time to first byte, total latency
+percentiles (p50/p95/p99), time to first token for `message`, and the
+backend's resident memory. Results can be saved as a baseline and later runs
+compared against it.
+
+Usage:
+    cd backend
+    python benchmarks/benchmark_suite.py --concurrency 1,10,50 --requests 200 --save baseline.json
+    python benchmarks/benchmark_suite.py --concurrency 1,10,50 --requests 200 --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+
+sys.path.insert(0, BENCHMARK_DIR)
+from mock_llm_server import add_mock_arguments, free_port  # noqa: E402
+
+SCENARIOS = ("message", "upload", "templates", "templates_304", "categories", "search",
+             "conversations", "messages", "enhance", "oversized")
+SEARCH_QUERIES = ("code", "secur", "explain", "data analysis", "bug", "write")
+SERIALIZATION_SCENARIOS = ("conversations", "messages")
+SERIALIZATION_USER = "bench-serialize"
+SEED_CONVERSATIONS = 100
+SEED_TURNS = 100
+OVERSIZED_CONTENT = "x" * 40000
+
+
+# --- Process management ---
+
+def wait_for(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise SystemExit(f"Timed out waiting for {url}")
+
+
+def start_mock(args: argparse.Namespace) -> Tuple[subprocess.Popen, str]:
+    port = free_port()
+    command = [
+        sys.executable, os.path.join(BENCHMARK_DIR, "mock_llm_server.py"), "--port", str(port),
+        "--first-token-latency", str(args.first_token_latency),
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--response-tokens", str(args.response_tokens),
+        "--error-rate", str(args.error_rate),
+        "--error-status", str(args.error_status),
+        "--seed", str(args.seed),
+    ]
+    process = subprocess.Popen(command)
+    wait_for(f"http://127.0.0.1:{port}/stats")
+    return process, f"http://127.0.0.1:{port}/v1"
+
+
+def start_backend(mock_url: str, workdir: str, show_logs: bool) -> Tuple[subprocess.Popen, str]:
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "OPENROUTER_BASE_URL": mock_url,
+        "OPENROUTER_API_KEY": "mock",
+        "DEEPSEEK_BASE_URL": mock_url,
+        "DEEPSEEK_API_KEY": "mock",
+        # Measure the serving path itself, not the limiter or cache
+        "USER_RATE_PER_MINUTE": "0",
+        "ADMISSION_MAX_QUEUE": "100000",
+        "OPENROUTER_MAX_CONCURRENCY": "1000",
+        "COMPLETION_CACHE_ENABLED": "0",
+        "TEMPLATE_RELOAD_INTERVAL": "0",
+        "UPLOAD_DIR": os.path.join(workdir, "uploads"),
+        "DOCUMENT_DB_PATH": os.path.join(workdir, "documents.db"),
+        "CONVERSATION_DB_PATH": os.path.join(workdir, "conversations.db"),
+    })
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    # Per-request INFO logging would drown the report; keep it in the work dir unless asked
+    output = None if show_logs else open(os.path.join(workdir, "backend.log"), "wb")
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=output, stderr=subprocess.STDOUT if output else None)
+    base_url = f"http://127.0.0.1:{port}"
+    wait_for(f"{base_url}/health")
+    return process, base_url
+
+
+def stop(process: Optional[subprocess.Popen]) -> None:
+    if process is not None and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def memory_mb(pid: Optional[int]) -> Dict[str, Optional[float]]:
+    """Current and peak resident memory of a process (Linux /proc), in MB"""
+    result = {"rss_mb": None, "peak_rss_mb": None}
+    if pid is None:
+        return result
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    result["rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+                elif line.startswith("VmHWM:"):
+                    result["peak_rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return result
+
+
+# --- Load generation ---
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values: List[float], prefix: str) -> Dict[str, Optional[float]]:
+    summary = {}
+    for pct in (50, 95, 99):
+        value = percentile(values, pct)
+        summary[f"{prefix}_p{pct}_ms"] = round(value * 1000, 2) if value is not None else None
+    summary[f"{prefix}_mean_ms"] = round(statistics.mean(values) * 1000, 2) if values else None
+    return summary
+
+
+class Scenario:
+    """Builds and measures one request of a scenario"""
+
+    def __init__(self, name: str, upload_bytes: int, etag: Optional[str], conversation_id: Optional[str] = None):
+        self.name = name
+        self.upload_bytes = upload_bytes
+        self.etag = etag
+        self.conversation_id = conversation_id
+
+    async def run_one(self, client: httpx.AsyncClient, i: int) -> dict:
+        start = time.perf_counter()
+        first_byte = first_token = None
+        if self.name == "message":
+            payload = {"content": f"benchmark prompt {i} {uuid.uuid4().hex[:8]}", "model": "phi4", "user_id": f"bench-{i % 50}"}
+            async with client.stream("POST", "/api/message", json=payload) as response:
+                seen = b""
+                async for chunk in response.aiter_raw():
+                    now = time.perf_counter()
+                    if first_byte is None:
+                        first_byte = now
+                    if first_token is None:
+                        seen += chunk
+                        # The first line is the USER_ID header; anything after it is reply text
+                        newline = seen.find(b"\n")
+                        if newline != -1 and len(seen) > newline + 1:
+                            first_token = now
+                status = response.status_code
+        else:
+            if self.name == "upload":
+                body = (f"benchmark document {i} {uuid.uuid4().hex}\n".encode() * (self.upload_bytes // 48 + 1))[:self.upload_bytes]
+                files = {"file": (f"bench-{i}.txt", body, "text/plain")}
+                response = await client.post("/api/upload-document", files=files)
+            elif self.name == "templates":
+                response = await client.get("/api/prompt-templates")
+            elif self.name == "templates_304":
+                response = await client.get("/api/prompt-templates", headers={"If-None-Match": self.etag or ""})
+            elif self.name == "categories":
+                response = await client.get("/api/categories")
+            elif self.name == "conversations":
+                response = await client.get("/api/conversations", params={"user_id": SERIALIZATION_USER, "limit": 100})
+            elif self.name == "messages":
+                response = await client.get(f"/api/conversations/{self.conversation_id}/messages", params={"user_id": SERIALIZATION_USER, "limit": 200})
+            elif self.name == "enhance":
+                payload = {"prompt": f"benchmark prompt {i}", "selected_category": "Code Analysis"}
+                response = await client.post("/api/enhance-prompt", json=payload)
+            elif self.name == "oversized":
+                response = await client.post("/api/message", json={"content": OVERSIZED_CONTENT, "user_id": f"bench-{i % 50}"})
+            else:
+                response = await client.get("/api/prompt-templates/search", params={"q": SEARCH_QUERIES[i % len(SEARCH_QUERIES)]})
+            first_byte = time.perf_counter()
+            status = response.status_code
+        end = time.perf_counter()
+        # Oversized messages succeed when they are turned away
+        ok = status == 422 if self.name == "oversized" else status < 400
+        return {
+            "ok": ok,
+            "ttfb": (first_byte or end) - start,
+            "first_token": (first_token - start) if first_token else None,
+            "total": end - start,
+        }
+
+
+async def run_scenario(base_url: str, scenario: Scenario, total: int, concurrency: int) -> dict:
+    samples = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        queue = iter(range(total))
+
+        async def worker() -> None:
+            for i in queue:
+                try:
+                    samples.append(await scenario.run_one(client, i))
+                except httpx.HTTPError:
+                    samples.append({"ok": False, "ttfb": None, "first_token": None, "total": None})
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    ok = [s for s in samples if s["ok"]]
+    result = {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": total - len(ok),
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(ok) / elapsed, 2) if elapsed else None,
+    }
+    result.update(summarize([s["ttfb"] for s in ok], "ttfb"))
+    result.update(summarize([s["total"] for s in ok], "latency"))
+    if scenario.name == "message":
+        result.update(summarize([s["first_token"] for s in ok if s["first_token"] is not None], "first_token"))
+    return result
+
+
+def print_result(key: str, result: dict) -> None:
+    memory = f"rss {result.get('rss_mb')}MB (peak {result.get('peak_rss_mb')}MB)" if result.get("rss_mb") else "rss n/a"
+    line = (
+        f"{key:<22} {result['rps']:>9.1f} req/s  err {result['errors']:<4} "
+        f"ttfb p50/p95/p99 {result['ttfb_p50_ms']}/{result['ttfb_p95_ms']}/{result['ttfb_p99_ms']}ms  "
+        f"total p50/p95/p99 {result['latency_p50_ms']}/{result['latency_p95_ms']}/{result['latency_p99_ms']}ms  {memory}"
+    )
+    if "first_token_p50_ms" in result:
+        line += f"  first token p50/p95 {result['first_token_p50_ms']}/{result['first_token_p95_ms']}ms"
+    print(line)
+
+
+# --- Baselines ---
+
+def compare(results: Dict[str, dict], baseline_path: str, tolerance: float, min_delta_ms: float) -> bool:
+    """Print deltas against a saved baseline; returns True when something regressed"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    regressed = False
+    print(f"\nComparison with {baseline_path} (tolerance {tolerance:.0%}):")
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None:
+            print(f"{key:<22} (not in baseline)")
+            continue
+        notes = []
+        for metric, higher_is_better in (("rps", True), ("latency_p95_ms", False), ("ttfb_p95_ms", False), ("peak_rss_mb", False)):
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = change < -tolerance if higher_is_better else change > tolerance
+            # Sub-millisecond jitter on fast endpoints isn't a regression
+            if metric.endswith("_ms") and after - before < min_delta_ms:
+                worse = False
+            regressed = regressed or worse
+            notes.append(f"{metric} {before} -> {after} ({change:+.1%}){' REGRESSION' if worse else ''}")
+        print(f"{key:<22} " + "; ".join(notes))
+    return regressed
+
+
+async def seed_conversations(client: httpx.AsyncClient) -> str:
+    """Create conversations and a long message history to serialize; returns the busiest conversation"""
+    for i in range(SEED_CONVERSATIONS):
+        response = await client.post("/api/conversations", json={"user_id": SERIALIZATION_USER, "title": f"Benchmark conversation {i}"})
+        response.raise_for_status()
+    conversation_id = response.json()["id"]
+    turns = iter(range(SEED_TURNS))
+
+    async def worker() -> None:
+        # Each turn stores the prompt and the mock's reply
+        for i in turns:
+            payload = {"content": f"seed prompt {i}", "model": "phi4", "user_id": SERIALIZATION_USER, "conversation_id": conversation_id}
+            async with client.stream("POST", "/api/message", json=payload) as response:
+                response.raise_for_status()
+                await response.aread()
+
+    await asyncio.gather(*(worker() for _ in range(10)))
+    return conversation_id
+
+
+async def run_all(args: argparse.Namespace, base_url: str, backend_pid: Optional[int]) -> Dict[str, dict]:
+    conversation_id = None
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        etag = (await client.get("/api/prompt-templates")).headers.get("etag")
+        if set(args.scenarios) & set(SERIALIZATION_SCENARIOS):
+            conversation_id = await seed_conversations(client)
+
+    results = {}
+    for name in args.scenarios:
+        scenario = Scenario(name, args.upload_kb * 1024, etag, conversation_id)
+        for concurrency in args.concurrency:
+            total = args.upload_requests if name == "upload" and args.upload_requests else args.requests
+            result = await run_scenario(base_url, scenario, total, concurrency)
+            result.update(memory_mb(backend_pid))
+            key = f"{name}@{concurrency}"
+            results[key] = result
+            print_result(key, result)
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios to run")
+    parser.add_argument("--concurrency", default="1,10,50", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and concurrency level")
+    parser.add_argument("--upload-requests", type=int, default=0, help="Override --requests for the upload scenario")
+    parser.add_argument("--upload-kb", type=int, default=64, help="Size of each uploaded document")
+    parser.add_argument("--backend-url", help="Benchmark an already running backend instead of starting one")
+    parser.add_argument("--show-logs", action="store_true", help="Print the backend's log output")
+    parser.add_argument("--save", help="Write results to this baseline file")
+    parser.add_argument("--compare", help="Compare results with this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative change before flagging a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=2.0, help="Ignore latency increases smaller than this")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if a regression is flagged")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    mock = backend = None
+    with tempfile.TemporaryDirectory(prefix="zorifbot-bench-") as workdir:
+        try:
+            if args.backend_url:
+                base_url, backend_pid = args.backend_url.rstrip("/"), None
+            else:
+                mock, mock_url = start_mock(args)
+                backend, base_url = start_backend(mock_url, workdir, args.show_logs)
+                backend_pid = backend.pid
+            results = asyncio.run(run_all(args, base_url, backend_pid))
+        finally:
+            stop(backend)
+            stop(mock)
+
+    if args.save:
+        meta = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("save", "compare")},
+        }
+        with open(args.save, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+
+    if args.compare and compare(results, args.compare, args.tolerance, args.min_delta_ms) and args.fail_on_regression:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,94 @@
+"""Offline benchmark of the /api/message pipeline using the fake provider.
+
+Serves the app on a local port (no upstream network, no API keys), drives it
+with the `fake` model and reports time-to-first-byte and total latency.
+
+Usage:
+    cd backend
+    python benchmarks/fake_provider_benchmark.py --requests 200 --concurrency 20
+"""
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server() -> str:
+    """Run the backend app in a background thread and return its base URL"""
+    import uvicorn
+    import main
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}"
+
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run(base_url: str, total: int, concurrency: int) -> None:
+    import httpx
+
+    ttfb, latency = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+
+        async def one(i: int) -> None:
+            payload = {"content": f"benchmark prompt number {i}", "model": "fake", "user_id": f"bench-{i}"}
+            async with semaphore:
+                start = time.perf_counter()
+                first = None
+                async with client.stream("POST", "/api/message", json=payload) as response:
+                    response.raise_for_status()
+                    async for _ in response.aiter_text():
+                        if first is None:
+                            first = time.perf_counter() - start
+                latency.append(time.perf_counter() - start)
+                ttfb.append(first or latency[-1])
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+
+    print(f"{total} requests, concurrency {concurrency}, {elapsed:.2f}s -> {total / elapsed:.1f} req/s")
+    for label, values in (("ttfb", ttfb), ("total", latency)):
+        print(
+            f"{label:>5}: mean {statistics.mean(values) * 1000:.1f}ms  "
+            f"p50 {percentile(values, 50) * 1000:.1f}ms  "
+            f"p95 {percentile(values, 95) * 1000:.1f}ms  "
+            f"p99 {percentile(values, 99) * 1000:.1f}ms"
+        )
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="Total number of requests")
+    parser.add_argument("--concurrency", type=int, default=20, help="Simultaneous requests in flight")
+    args = parser.parse_args()
+
+    os.environ["FAKE_PROVIDER_ENABLED"] = "1"
+    sys.path.insert(0, BACKEND_DIR)
+    logging.disable(logging.INFO)
+    asyncio.run(run(start_server(), args.requests, args.concurrency))
+
+
+if __name__ == "__main__":
+    main_cli()
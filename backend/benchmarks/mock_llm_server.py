@@ -0,0 +1,156 @@
+"""Mock OpenAI-compatible chat completions server for offline benchmarks.
+
+Answers `POST /v1/chat/completions` both streaming (SSE) and non-streaming,
+with a configurable time to first token, token rate, response length and
+injected errors. Replies carry OpenAI-style `usage` counts (for streams when
+`stream_options.include_usage` is set). Point a provider at it with e.g.
+`OPENROUTER_BASE_URL=http://127.0.0.1:8100/v1 OPENROUTER_API_KEY=mock`.
+
+Usage:
+    cd backend
+    python benchmarks/mock_llm_server.py --port 8100 --tokens-per-second 200 \
+        --first-token-latency 0.1 --error-rate 0.05 --error-status 503
+"""
+import argparse
+import asyncio
+import json
+import random
+import socket
+import threading
+import time
+from dataclasses import dataclass
+
+import uvicorn
+from fastapi import Body, FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class MockSettings:
+    first_token_latency: float = 0.05
+    tokens_per_second: float = 200.0
+    response_tokens: int = 60
+    error_rate: float = 0.0
+    error_status: int = 500
+    seed: int = 0
+
+
+def build_mock_app(settings: MockSettings) -> FastAPI:
+    """OpenAI-compatible app following `settings`"""
+    app = FastAPI()
+    rng = random.Random(settings.seed)
+    counters = {"requests": 0, "errors": 0}
+
+    def reply_tokens(data: dict) -> list:
+        messages = data.get("messages") or [{"content": "ok"}]
+        words = str(messages[-1].get("content", "")).split() or ["ok"]
+        return [f"{words[i % len(words)]} " for i in range(settings.response_tokens)]
+
+    def usage(data: dict, tokens: list) -> dict:
+        # Whitespace-separated words stand in for prompt tokens
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in data.get("messages") or [])
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+
+    def chunk(model: str, content: str) -> str:
+        event = {
+            "id": "mock-completion",
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+        }
+        return f"data: {json.dumps(event)}\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(data: dict = Body(...)):
+        counters["requests"] += 1
+        model = data.get("model", "mock")
+        if settings.error_rate > 0 and rng.random() < settings.error_rate:
+            counters["errors"] += 1
+            headers = {"Retry-After": "1"} if settings.error_status == 429 else None
+            return JSONResponse({"error": {"message": "injected failure"}}, status_code=settings.error_status, headers=headers)
+
+        tokens = reply_tokens(data)
+        delay = 1.0 / settings.tokens_per_second if settings.tokens_per_second > 0 else 0
+
+        if not data.get("stream"):
+            await asyncio.sleep(settings.first_token_latency + delay * len(tokens))
+            return {
+                "id": "mock-completion",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}
+                ],
+                "usage": usage(data, tokens),
+            }
+
+        async def events():
+            await asyncio.sleep(settings.first_token_latency)
+            for token in tokens:
+                yield chunk(model, token)
+                if delay:
+                    await asyncio.sleep(delay)
+            if (data.get("stream_options") or {}).get("include_usage"):
+                event = {"id": "mock-completion", "object": "chat.completion.chunk", "model": model,
+                         "choices": [], "usage": usage(data, tokens)}
+                yield f"data: {json.dumps(event)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    def stats():
+        return counters
+
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock_server(settings: MockSettings, port: int = 0) -> str:
+    """Run the mock in a background thread and return its `/v1` base URL"""
+    port = port or free_port()
+    config = uvicorn.Config(build_mock_app(settings), host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}/v1"
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--first-token-latency", type=float, default=0.05, help="Seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Streaming token rate (0 = no delay)")
+    parser.add_argument("--response-tokens", type=int, default=60, help="Tokens per reply")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status for injected errors")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for error injection")
+
+
+def settings_from_args(args: argparse.Namespace) -> MockSettings:
+    return MockSettings(
+        first_token_latency=args.first_token_latency,
+        tokens_per_second=args.tokens_per_second,
+        response_tokens=args.response_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        seed=args.seed,
+    )
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(build_mock_app(settings_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,106 @@
+"""Load test: concurrent phi4 requests must overlap instead of serializing.
+
+Starts a local OpenAI-compatible stub that answers after a fixed delay, points
+the phi4 path at it and fires N concurrent calls through `call_external_ai_api`.
+With a non-blocking client the wall time stays close to a single round trip;
+a blocking client would take roughly N times as long.
+
+Usage:
+    cd backend
+    python benchmarks/phi4_load_test.py --concurrency 20 --latency 0.5
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Body
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def build_stub_app(latency: float) -> FastAPI:
+    """OpenAI-compatible chat completions stub with a fixed response delay"""
+    stub = FastAPI()
+
+    @stub.post("/v1/chat/completions")
+    async def chat_completions(data: dict = Body(...)):
+        await asyncio.sleep(latency)
+        return {
+            "id": "stub-completion",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": data.get("model", "stub"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "stub reply"},
+                    "finish_reason": "stop",
+                }
+            ],
+        }
+
+    return stub
+
+
+def start_stub_server(latency: float) -> str:
+    """Run the stub in a background thread and return its base URL"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    config = uvicorn.Config(build_stub_app(latency), host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}/v1"
+
+
+async def run_load(concurrency: int) -> float:
+    import main
+
+    async def one(i: int) -> str:
+        return await main.call_external_ai_api(f"load test prompt {i}", "phi4", f"load-user-{i}")
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    failures = [r for r in results if r != "stub reply"]
+    if failures:
+        raise SystemExit(f"{len(failures)} of {concurrency} requests did not reach the stub")
+
+    print(f"openrouter pool: {main.http_clients.registry.stats().get('openrouter')}")
+    await main.http_clients.registry.aclose()
+    return elapsed
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=20, help="Number of simultaneous phi4 requests")
+    parser.add_argument("--latency", type=float, default=0.5, help="Stub upstream latency in seconds")
+    args = parser.parse_args()
+
+    os.environ["OPENROUTER_BASE_URL"] = start_stub_server(args.latency)
+    os.environ.setdefault("OPENROUTER_API_KEY", "load-test-key")
+    sys.path.insert(0, BACKEND_DIR)
+
+    elapsed = asyncio.run(run_load(args.concurrency))
+    serialized = args.concurrency * args.latency
+    print(f"{args.concurrency} concurrent phi4 requests, {args.latency:.2f}s upstream latency each")
+    print(f"wall time: {elapsed:.2f}s (serialized would be ~{serialized:.2f}s)")
+
+    # Allow generous overhead, but anything near serialized time means the loop was blocked
+    if elapsed > max(args.latency * 3, serialized / 2):
+        print("FAIL: requests ran one after another")
+        sys.exit(1)
+    print("OK: requests overlapped")
+
+
+if __name__ == "__main__":
+    main_cli()
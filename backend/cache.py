@@ -0,0 +1,213 @@
+"""Opt-in completion cache for identical prompts.
+
+Completions are keyed on (model, final prompt, temperature, max_tokens) and
+kept in a bounded LRU with a TTL, either in memory or in SQLite so entries
+survive restarts. Enable with `COMPLETION_CACHE_ENABLED=1`; tune with
+`COMPLETION_CACHE_BACKEND` (memory|sqlite), `COMPLETION_CACHE_PATH`,
+`COMPLETION_CACHE_MAX_ENTRIES`, `COMPLETION_CACHE_MAX_BYTES` and
+`COMPLETION_CACHE_TTL` (seconds).
+"""
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(model: str, prompt: Any, temperature: float, max_tokens: int) -> str:
+    """Stable digest of everything that determines a completion"""
+    raw = json.dumps([model, prompt, temperature, max_tokens], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+
+class MemoryBackend:
+    """In-process LRU bounded by entry count and total bytes"""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key: str, now: float) -> Tuple[Optional[str], bool]:
+        """Return (value, expired)"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, False
+        value, expires_at = entry
+        if expires_at <= now:
+            self._remove(key)
+            return None, True
+        self._entries.move_to_end(key)
+        return value, False
+
+    def set(self, key: str, value: str, expires_at: float) -> int:
+        """Store a value and return how many entries were evicted"""
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, expires_at)
+        self._bytes += len(value)
+        evicted = 0
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            evicted += 1
+        return evicted
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def size(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "bytes": self._bytes}
+
+
+class SQLiteBackend:
+    """LRU+TTL cache table in a SQLite file"""
+
+    def __init__(self, path: str, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completion_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_completion_cache_access ON completion_cache(last_access)")
+        self._conn.commit()
+
+    def get(self, key: str, now: float) -> Tuple[Optional[str], bool]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM completion_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None, False
+            if row[1] <= now:
+                self._conn.execute("DELETE FROM completion_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None, True
+            self._conn.execute("UPDATE completion_cache SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return row[0], False
+
+    def set(self, key: str, value: str, expires_at: float) -> int:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completion_cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, now),
+            )
+            evicted = self._conn.execute("DELETE FROM completion_cache WHERE expires_at <= ?", (now,)).rowcount
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM completion_cache"
+            ).fetchone()
+            # Drop least recently used rows until both bounds hold
+            while count > self.max_entries or total > self.max_bytes:
+                row = self._conn.execute(
+                    "SELECT key, LENGTH(value) FROM completion_cache ORDER BY last_access LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    break
+                self._conn.execute("DELETE FROM completion_cache WHERE key = ?", (row[0],))
+                count -= 1
+                total -= row[1]
+                evicted += 1
+            self._conn.commit()
+            return evicted
+
+    def size(self) -> Dict[str, int]:
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM completion_cache"
+            ).fetchone()
+        return {"entries": count, "bytes": total}
+
+
+class CompletionCache:
+    """Async facade over a cache backend with hit/miss accounting"""
+
+    def __init__(self, backend, ttl: float, enabled: bool = True):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+        self.stats = CacheStats()
+        # SQLite calls run in a worker thread so they never block the event loop
+        self._offload = isinstance(backend, SQLiteBackend)
+
+    async def _run(self, fn, *args):
+        if self._offload:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        value, expired = await self._run(self.backend.get, key, time.time())
+        if expired:
+            self.stats.expirations += 1
+        if value is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return value
+
+    async def set(self, key: str, value: str) -> None:
+        if not self.enabled or not value:
+            return
+        evicted = await self._run(self.backend.set, key, value, time.time() + self.ttl)
+        self.stats.stores += 1
+        self.stats.evictions += evicted
+
+    def snapshot(self) -> dict:
+        lookups = self.stats.hits + self.stats.misses
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "ttl_seconds": self.ttl,
+            **asdict(self.stats),
+            "hit_ratio": round(self.stats.hits / lookups, 4) if lookups else 0.0,
+            **self.backend.size(),
+        }
+
+
+def build_cache_from_env() -> CompletionCache:
+    enabled = os.getenv("COMPLETION_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+    max_entries = int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", "1000"))
+    max_bytes = int(os.getenv("COMPLETION_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+    ttl = float(os.getenv("COMPLETION_CACHE_TTL", "3600"))
+    backend_name = os.getenv("COMPLETION_CACHE_BACKEND", "memory").lower()
+
+    if enabled and backend_name == "sqlite":
+        path = os.getenv("COMPLETION_CACHE_PATH", "completion_cache.db")
+        backend = SQLiteBackend(path, max_entries, max_bytes)
+        logger.info(f"Completion cache enabled (sqlite at {path}, ttl={ttl}s)")
+    else:
+        backend = MemoryBackend(max_entries, max_bytes)
+        if enabled:
+            logger.info(f"Completion cache enabled (memory, max_entries={max_entries}, ttl={ttl}s)")
+    return CompletionCache(backend, ttl, enabled)
+
+
+# Process-wide completion cache used by the API handlers
+completion_cache = build_cache_from_env()
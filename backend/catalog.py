@@ -0,0 +1,197 @@
+"""Precompiled prompt-template catalog with ETag/conditional-GET support.
+
+The template list is compiled once (at startup or on reload) into lookup
+indexes by id and by case-folded category, plus per-category counts and an
+inverted index for full-text search. Every catalog response body is
+serialized up front together with a strong ETag, so handlers only pick a
+prebuilt body and answer `If-None-Match` with 304.
+"""
+import os
+import re
+import json
+import math
+import bisect
+import hashlib
+import logging
+from typing import Dict, List, Optional
+
+from fastapi import Response
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_CACHE_MAX_AGE = int(os.getenv("TEMPLATE_CACHE_MAX_AGE", "300"))
+DEFAULT_CATEGORY_ICON = "fas fa-lightbulb"
+
+# Search field weights and limits
+FIELD_WEIGHTS = {"title": 3.0, "category": 2.0, "template": 1.0}
+PREFIX_MATCH_FACTOR = 0.6
+MAX_PREFIX_EXPANSIONS = 50
+
+
+class PreparedBody:
+    """A serialized JSON body with its strong ETag"""
+
+    __slots__ = ("body", "etag")
+
+    def __init__(self, payload):
+        # Same compact encoding as FastAPI's default JSONResponse
+        self.body = json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag (RFC 9110)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def conditional_response(prepared: PreparedBody, if_none_match: Optional[str]) -> Response:
+    """200 with the prebuilt body, or 304 when the client's copy is current"""
+    headers = {
+        "ETag": prepared.etag,
+        "Cache-Control": f"public, max-age={TEMPLATE_CACHE_MAX_AGE}, must-revalidate",
+    }
+    if etag_matches(if_none_match, prepared.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=prepared.body, media_type="application/json", headers=headers)
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", text.casefold())
+
+
+class SearchIndex:
+    """Inverted index over template title, category and body with prefix matching"""
+
+    def __init__(self, templates: List[dict]):
+        self.templates = templates
+        postings: Dict[str, Dict[int, float]] = {}
+        for doc, template in enumerate(templates):
+            for field, weight in FIELD_WEIGHTS.items():
+                for term in tokenize(template[field]):
+                    doc_weights = postings.setdefault(term, {})
+                    # Repeated terms count once per field; the best field wins
+                    doc_weights[doc] = max(doc_weights.get(doc, 0.0), weight)
+        total = max(1, len(templates))
+        self.idf = {term: math.log(1 + total / len(docs)) for term, docs in postings.items()}
+        self.postings = postings
+        self.vocabulary = sorted(postings)
+
+    def _expand(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        terms = []
+        for term in self.vocabulary[start:start + MAX_PREFIX_EXPANSIONS]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def search(self, query: str, limit: int = 20, category: Optional[str] = None) -> List[dict]:
+        """Templates matching every query term (exactly or by prefix), best first"""
+        terms = tokenize(query)
+        if not terms:
+            return []
+        scores: Optional[Dict[int, float]] = None
+        for term in terms:
+            term_scores: Dict[int, float] = {}
+            for candidate in self._expand(term):
+                factor = 1.0 if candidate == term else PREFIX_MATCH_FACTOR
+                idf = self.idf[candidate]
+                for doc, weight in self.postings[candidate].items():
+                    score = weight * idf * factor
+                    if score > term_scores.get(doc, 0.0):
+                        term_scores[doc] = score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {doc: scores[doc] + score for doc, score in term_scores.items() if doc in scores}
+            if not scores:
+                return []
+
+        folded = category.casefold() if category else None
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        results = []
+        for doc, score in ranked:
+            template = self.templates[doc]
+            if folded and template["category"].casefold() != folded:
+                continue
+            results.append({**template, "score": round(score, 4)})
+            if len(results) >= limit:
+                break
+        return results
+
+
+class _CompiledCatalog:
+    """Immutable snapshot of the indexes and prebuilt responses"""
+
+    def __init__(self, templates: List[dict], category_icons: Dict[str, str]):
+        self.templates = [dict(t) for t in templates]
+        self.by_id: Dict[str, dict] = {t["id"]: t for t in self.templates}
+        self.by_category: Dict[str, List[dict]] = {}
+        for template in self.templates:
+            self.by_category.setdefault(template["category"].casefold(), []).append(template)
+
+        names = sorted({t["category"] for t in self.templates})
+        self.categories = [
+            {
+                "name": name,
+                "icon": category_icons.get(name, DEFAULT_CATEGORY_ICON),
+                "count": len(self.by_category[name.casefold()]),
+            }
+            for name in names
+        ]
+
+        self.templates_body = PreparedBody(self.templates)
+        self.categories_body = PreparedBody(self.categories)
+        self.category_bodies = {key: PreparedBody(items) for key, items in self.by_category.items()}
+        self.empty_body = PreparedBody([])
+        self.search_index = SearchIndex(self.templates)
+
+
+class TemplateCatalog:
+    """Reloadable catalog; readers always see one complete snapshot"""
+
+    def __init__(self, templates: List[dict], category_icons: Dict[str, str]):
+        self._snapshot = _CompiledCatalog(templates, category_icons)
+
+    def reload(self, templates: List[dict], category_icons: Dict[str, str]) -> None:
+        # Build the new snapshot fully before swapping it in
+        self._snapshot = _CompiledCatalog(templates, category_icons)
+        logger.info(f"Template catalog compiled: {len(templates)} templates, {len(self._snapshot.categories)} categories")
+
+    @property
+    def templates(self) -> List[dict]:
+        return self._snapshot.templates
+
+    @property
+    def categories(self) -> List[dict]:
+        return self._snapshot.categories
+
+    def get(self, template_id: str) -> Optional[dict]:
+        return self._snapshot.by_id.get(template_id)
+
+    def for_category(self, category: str) -> List[dict]:
+        return self._snapshot.by_category.get(category.casefold(), [])
+
+    def templates_body(self) -> PreparedBody:
+        return self._snapshot.templates_body
+
+    def categories_body(self) -> PreparedBody:
+        return self._snapshot.categories_body
+
+    def category_body(self, category: str) -> PreparedBody:
+        snapshot = self._snapshot
+        return snapshot.category_bodies.get(category.casefold(), snapshot.empty_body)
+
+    def search(self, query: str, limit: int = 20, category: Optional[str] = None) -> List[dict]:
+        return self._snapshot.search_index.search(query, limit, category)
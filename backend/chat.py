@@ -0,0 +1,455 @@
+"""The chat message pipeline shared by the HTTP and WebSocket transports.
+
+`prepare_turn` takes a message already validated as a `MessageRequest`,
+resolves the user, admits the request, loads stored history and retrieved
+document chunks, and builds the upstream messages. `ChatTurn.stream` relays
+the provider's tokens and records the reply and the stream metrics.
+Transports only frame what it produces: `/api/message` as plain text,
+`/ws/chat` as JSON token frames. Every completion, streamed or not, is
+entered in the usage ledger.
+"""
+import os
+import asyncio
+import logging
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, List, Optional
+
+from fastapi import HTTPException
+
+import conversations
+from identity import identity
+import ingestion
+import metrics
+from limits import AdmissionRejected, Ticket, admission
+import providers
+from cache import completion_cache, make_key
+from context import build_context_messages
+from providers import Provider, ProviderError, ProviderNotConfigured
+from resilience import CircuitOpen, upstream
+from retrieval import format_document_context, retriever
+from schemas import MessageRequest
+from singleflight import coalescer
+from usage import UsageRecord, ledger
+
+logger = logging.getLogger(__name__)
+
+# Most recent stored turns loaded for a conversation before token budgeting
+CONVERSATION_HISTORY_LIMIT = int(os.getenv("CONVERSATION_HISTORY_LIMIT", "50"))
+
+# Helper: Enhance prompt with category context
+def enhance_prompt(original_prompt: str, selected_category: Optional[str] = None) -> str:
+    enhancement_prefix = (
+        "You are an expert AI assistant. Please provide a detailed, accurate, and helpful response to the following query. Be specific, include examples where appropriate, and structure your response clearly.\n\n"
+    )
+    
+    # Add category-specific context if provided
+    if selected_category:
+        category_context = f"Context: The user is working in the '{selected_category}' domain. Please tailor your response accordingly.\n\n"
+        enhancement_prefix += category_context
+    
+    enhancement_prefix += "Query: "
+    enhancement_suffix = "\n\nPlease ensure your response is:\n- Accurate and well-researched\n- Clear and easy to understand\n- Includes practical examples if relevant\n- Structured with proper formatting\n- Comprehensive yet concise"
+    
+    return enhancement_prefix + original_prompt + enhancement_suffix
+
+# Helper: Generate fallback response
+def generate_fallback_response(prompt: str) -> str:
+    """Generate a helpful fallback response when API is not available"""
+    prompt_lower = prompt.lower().strip()
+    
+    # Simple keyword-based responses
+    if any(word in prompt_lower for word in ['hello', 'hi', 'hey']):
+        return "Hello! I'm your AI assistant. I'm currently in offline mode due to missing API key, but I'm here to help. How can I assist you today?"
+    
+    elif any(word in prompt_lower for word in ['code', 'programming', 'function', 'algorithm']):
+        return f"I see you're asking about code: '{prompt}'. While I'm in offline mode, I can suggest that you:\n\n1. Check the syntax and structure of your code\n2. Look for common programming patterns\n3. Consider edge cases and error handling\n4. Test with different inputs\n\nWould you like me to help you with any specific programming concepts when the API is available?"
+    
+    elif any(word in prompt_lower for word in ['explain', 'what is', 'how does']):
+        return f"You're asking: '{prompt}'. This is a great question! While I'm in offline mode, I'd recommend:\n\n1. Breaking down the concept into smaller parts\n2. Looking for real-world examples\n3. Checking official documentation\n4. Practicing with simple examples\n\nI'll be able to provide more detailed explanations once the API is available."
+    
+    elif any(word in prompt_lower for word in ['help', 'assist', 'support']):
+        return "I'm here to help! While I'm currently in offline mode, I can still guide you. What specific area do you need assistance with? I'll be able to provide more detailed help once the API connection is restored."
+    
+    else:
+        return f"Thank you for your message: '{prompt}'. I'm currently in offline mode due to missing API key, but I'm here to assist you. I'll be able to provide more comprehensive responses once the API connection is available. Is there anything specific I can help you with?"
+
+# Helper: Wrap a prompt in the chat messages format
+def build_messages(prompt: str) -> list:
+    return [
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
+# Helper: Completion cache key for the messages sent to a provider
+def completion_cache_key(provider: Provider, messages: list) -> str:
+    return make_key(provider.model, messages, provider.temperature, provider.max_tokens)
+
+# Helper: Metrics outcome label for a failed upstream call
+def failure_outcome(error: Exception) -> str:
+    return "402" if isinstance(error, ProviderError) and error.status_code == 402 else "error"
+
+# Helper: Metrics reason label for a fallback reply
+def fallback_reason(error: Exception) -> str:
+    if isinstance(error, CircuitOpen):
+        return "circuit_open"
+    if isinstance(error, ProviderNotConfigured):
+        return "not_configured"
+    return failure_outcome(error)
+
+# Helper: Count an upstream generation abandoned by its client and the tokens it no longer costs
+def record_cancelled_generation(provider: Provider, model: str, cache_key: str, received: int) -> None:
+    # A coalesced generation keeps running while other requests still follow it
+    if coalescer.followers(cache_key):
+        return
+    metrics.CANCELLED_GENERATIONS.labels(model).inc()
+    expected = upstream.expected_reply_tokens(provider)
+    saved = max(0, round(expected - received)) if expected is not None else 0
+    metrics.TOKENS_SAVED.labels(model).inc(saved)
+    logger.info(f"Cancelled {provider.name} generation after {received} tokens (~{saved} tokens saved)")
+
+# Helper: Add a completion to the usage ledger, estimating token counts the provider did not report
+def record_usage(provider: Provider, model: str, user_id: str, messages: list, reply: str, usage: dict,
+                 outcome: str, latency: float, ttft: Optional[float] = None) -> None:
+    source = "fallback" if outcome == "fallback" else usage.get("source", "upstream")
+    # A hedged call is billed at the price of the provider that answered
+    served_by = providers.registry.get(usage.get("model", model)) or provider
+    prompt_tokens = usage.get("prompt_tokens")
+    completion_tokens = usage.get("completion_tokens") or 0
+    estimated = False
+    if prompt_tokens is None:
+        prompt_tokens = completion_tokens = 0
+        # Cancelled streams never get a usage report, but the upstream still did the work
+        if source == "upstream" and outcome in ("ok", "cancelled"):
+            prompt_tokens = sum(served_by.count_tokens(message["content"]) for message in messages)
+            completion_tokens = served_by.count_tokens(reply) if reply else 0
+            estimated = True
+    ledger.record(UsageRecord(
+        user_id=user_id,
+        model=served_by.model,
+        outcome=outcome,
+        source=source,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        estimated=estimated,
+        cost_usd=served_by.estimate_cost(prompt_tokens, completion_tokens),
+        latency_seconds=latency,
+        ttft_seconds=ttft,
+    ))
+
+# Helper: Usage outcome of an upstream call that raised
+def usage_outcome(error: Exception) -> str:
+    return "fallback" if isinstance(error, (ProviderNotConfigured, CircuitOpen)) else failure_outcome(error)
+
+# Helper: Make one upstream call and record its usage once it finishes, even if the requests sharing it left
+async def metered_call(provider: Provider, model: str, user_id: str, messages: list) -> str:
+    usage = {"source": "upstream"}
+    outcome = "ok"
+    result = ""
+    started = time.perf_counter()
+    try:
+        result = await upstream.complete(provider, messages, user_id, usage)
+        return result
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        outcome = usage_outcome(e)
+        raise
+    finally:
+        record_usage(provider, model, user_id, messages, result, usage, outcome, time.perf_counter() - started)
+
+# Helper: Stream one upstream generation and record its usage once it ends, however many requests follow it
+async def metered_stream(provider: Provider, model: str, user_id: str, messages: list) -> AsyncIterator[str]:
+    usage = {"source": "upstream"}
+    outcome = "ok"
+    tokens = []
+    started = time.perf_counter()
+    first_token_at = None
+    try:
+        async with aclosing(upstream.stream(provider, messages, user_id, usage)) as stream:
+            async for token in stream:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                tokens.append(token)
+                yield token
+        if not tokens:
+            outcome = "fallback"
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        outcome = usage_outcome(e)
+        raise
+    finally:
+        record_usage(provider, model, user_id, messages, "".join(tokens), usage, outcome, time.perf_counter() - started,
+                     first_token_at - started if first_token_at is not None else None)
+
+# Helper: Call AI API through the provider registry
+async def call_external_ai_api(prompt: str, model: str, user_id: str, messages: Optional[list] = None,
+                               outcome: Optional[dict] = None) -> str:
+    logger.info(f"Calling AI API for user {user_id} with model {model}")
+    outcome = outcome if outcome is not None else {}
+    outcome["outcome"] = "ok"
+    
+    provider = providers.registry.get(model)
+    if provider is None:
+        logger.warning(f"Model {model} not implemented, using placeholder response")
+        outcome["outcome"] = "fallback"
+        metrics.FALLBACK_RESPONSES.labels("unknown", "unknown_model").inc()
+        return f"This is a placeholder response for model {model}. Your prompt was: {prompt}"
+    
+    messages = messages or build_messages(prompt)
+    requested = time.perf_counter()
+    cache_key = completion_cache_key(provider, messages)
+    cached = await completion_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"Completion cache hit for user {user_id} with model {model}")
+        record_usage(provider, model, user_id, messages, cached, {"source": "cache"}, "ok", time.perf_counter() - requested)
+        return cached
+    
+    # The call that starts the upstream request records its tokens; followers record a coalesced request
+    leader = False
+    
+    def start_upstream():
+        nonlocal leader
+        leader = True
+        return metered_call(provider, model, user_id, messages)
+    
+    started = time.perf_counter()
+    result = ""
+    try:
+        # Concurrent identical prompts share one upstream call
+        result = await coalescer.call(cache_key, start_upstream)
+        logger.info(f"Successfully received {provider.name} response for user {user_id}")
+        await completion_cache.set(cache_key, result)
+        return result
+    except asyncio.CancelledError:
+        outcome["outcome"] = "cancelled"
+        record_cancelled_generation(provider, model, cache_key, 0)
+        raise
+    except (ProviderNotConfigured, CircuitOpen) as e:
+        logger.warning(f"{str(e)}, using fallback response")
+        outcome["outcome"] = "fallback"
+        metrics.FALLBACK_RESPONSES.labels(model, fallback_reason(e)).inc()
+        return generate_fallback_response(prompt)
+    except Exception as e:
+        logger.error(f"Error calling {provider.name} API for user {user_id}: {str(e)}")
+        outcome["outcome"] = failure_outcome(e)
+        metrics.FALLBACK_RESPONSES.labels(model, fallback_reason(e)).inc()
+        return generate_fallback_response(prompt)
+    finally:
+        metrics.UPSTREAM_SECONDS.labels(model, outcome["outcome"]).observe(time.perf_counter() - started)
+        if not leader:
+            record_usage(provider, model, user_id, messages, result, {"source": "coalesced"}, outcome["outcome"],
+                         time.perf_counter() - requested)
+
+# Helper: Stream AI API response token by token
+async def stream_external_ai_api(prompt: str, model: str, user_id: str, messages: Optional[list] = None,
+                                 outcome: Optional[dict] = None) -> AsyncIterator[str]:
+    """Relay upstream tokens as they arrive, falling back to a single chunk for non-streaming models"""
+    outcome = outcome if outcome is not None else {}
+    outcome["outcome"] = "ok"
+    provider = providers.registry.get(model)
+    if provider is None or not provider.supports_streaming:
+        # Provider can't stream: send the full completion as one chunk
+        yield await call_external_ai_api(prompt, model, user_id, messages, outcome)
+        return
+
+    # Cache hits are sent back immediately as a single chunk
+    messages = messages or build_messages(prompt)
+    requested = time.perf_counter()
+    cache_key = completion_cache_key(provider, messages)
+    cached = await completion_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"Completion cache hit for user {user_id} with model {model}")
+        record_usage(provider, model, user_id, messages, cached, {"source": "cache"}, "ok", time.perf_counter() - requested)
+        yield cached
+        return
+
+    logger.info(f"Streaming AI API for user {user_id} with model {model}")
+    tokens = []
+    started = time.perf_counter()
+    first_token_at = None
+    # The stream that starts the upstream generation records its tokens when the generation ends,
+    # even if this request left earlier; followers record a coalesced request
+    leader = False
+    
+    def start_upstream():
+        nonlocal leader
+        leader = True
+        return metered_stream(provider, model, user_id, messages)
+    
+    # Concurrent identical prompts share one upstream stream
+    relay = coalescer.stream(cache_key, start_upstream)
+    try:
+        async for token in relay:
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            tokens.append(token)
+            yield token
+
+        if tokens:
+            logger.info(f"Successfully streamed {provider.name} response for user {user_id}")
+            await completion_cache.set(cache_key, "".join(tokens))
+        else:
+            logger.warning(f"{provider.name} stream ended without content, using fallback response")
+            outcome["outcome"] = "fallback"
+            metrics.FALLBACK_RESPONSES.labels(model, "empty_stream").inc()
+            yield generate_fallback_response(prompt)
+
+    except (asyncio.CancelledError, GeneratorExit):
+        # The client went away; closing the relay below stops the upstream stream
+        outcome["outcome"] = "cancelled"
+        raise
+    except (ProviderNotConfigured, CircuitOpen) as e:
+        logger.warning(f"{str(e)}, using fallback response")
+        outcome["outcome"] = "fallback"
+        metrics.FALLBACK_RESPONSES.labels(model, fallback_reason(e)).inc()
+        yield generate_fallback_response(prompt)
+    except Exception as e:
+        logger.error(f"Error streaming {provider.name} API for user {user_id}: {str(e)}")
+        outcome["outcome"] = failure_outcome(e)
+        # Once tokens have been relayed the reply can't be swapped for a fallback
+        if not tokens:
+            metrics.FALLBACK_RESPONSES.labels(model, fallback_reason(e)).inc()
+            yield generate_fallback_response(prompt)
+    finally:
+        await relay.aclose()
+        if outcome["outcome"] == "cancelled":
+            record_cancelled_generation(provider, model, cache_key, len(tokens))
+        label = outcome["outcome"]
+        if first_token_at is not None:
+            metrics.UPSTREAM_TTFT_SECONDS.labels(model, label).observe(first_token_at - started)
+        metrics.UPSTREAM_SECONDS.labels(model, label).observe(time.perf_counter() - started)
+        if not leader:
+            record_usage(provider, model, user_id, messages, "".join(tokens), {"source": "coalesced"}, label,
+                         time.perf_counter() - requested, first_token_at - requested if first_token_at is not None else None)
+
+# Helper: Look up the ready documents a message should be grounded on
+async def load_message_documents(document_ids: List[str], user_id: str) -> list:
+    documents = []
+    for document_id in dict.fromkeys(document_ids):
+        document = await ingestion.pipeline.index.get_document(document_id)
+        if document is None or document["user_id"] != user_id:
+            raise HTTPException(status_code=404, detail=f"Document {document_id} not found")
+        if document["status"] != ingestion.STATUS_READY:
+            raise HTTPException(status_code=409, detail=f"Document {document_id} is {document['status']}")
+        documents.append(document)
+    return documents
+
+
+class ChatTurn:
+    """One admitted chat message, ready to stream; holds its provider slot until released"""
+
+    def __init__(self, user_id: str, model: str, metric_model: str, content: str, prompt: str,
+                 messages: list, conversation_id: Optional[str], ticket: Ticket):
+        self.user_id = user_id
+        self.model = model
+        self.metric_model = metric_model
+        self.content = content
+        self.prompt = prompt
+        self.messages = messages
+        self.conversation_id = conversation_id
+        self.ticket = ticket
+        self.outcome = {"outcome": "ok"}
+        # Transports add what they put on the wire, for the stream metrics
+        self.bytes_sent = 0
+
+    def release(self) -> None:
+        self.ticket.release()
+
+    async def stream(self) -> AsyncIterator[str]:
+        """Relay the reply's tokens, store the answered turn in the conversation and record the stream metrics"""
+        in_flight = metrics.IN_FLIGHT.labels(self.metric_model)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            reply = []
+            tokens = stream_external_ai_api(self.prompt, self.model, self.user_id, self.messages, self.outcome)
+            # Closing on disconnect reaches the upstream call at once instead of at garbage collection
+            async with aclosing(tokens):
+                async for token in tokens:
+                    reply.append(token)
+                    yield token
+            # Fallback text and failed or abandoned replies are not kept, and neither is the
+            # question they answer, so the history never ends on an unanswered turn
+            if self.conversation_id and reply and self.outcome["outcome"] == "ok":
+                await conversations.store.append_message(self.conversation_id, "user", self.content)
+                await conversations.store.append_message(self.conversation_id, "assistant", "".join(reply))
+        finally:
+            self.release()
+            in_flight.dec()
+            label = self.outcome["outcome"]
+            metrics.STREAM_SECONDS.labels(self.metric_model, label).observe(time.perf_counter() - started)
+            metrics.STREAM_BYTES.labels(self.metric_model, label).observe(self.bytes_sent)
+
+
+async def prepare_turn(request: MessageRequest, user_id: Optional[str] = None,
+                       client: Optional[str] = None) -> ChatTurn:
+    """Admit a validated message and build its prompt; raises HTTPException for the transport to report
+
+    `user_id` is the transport's already known identity (a WebSocket
+    connection's); otherwise it is taken from the message. `client` is the
+    peer address the per-client rate limit is keyed on.
+    """
+    content = request.content
+    model = request.model
+    conversation_id = request.conversation_id
+    history = [msg.model_dump() for msg in request.history]
+
+    # If no user_id provided, issue a new one; known users refresh their session
+    try:
+        user_id = await identity.resolve(user_id or request.user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Per-client and per-user rate limits and provider capacity are checked before any work starts
+    provider = providers.registry.get(model)
+    # Unknown model names share one label so clients can't grow the metric series
+    metric_model = model if provider is not None else "unknown"
+    try:
+        ticket = await admission.admit(user_id, provider, client)
+    except AdmissionRejected as e:
+        logger.warning(f"Rejected message from user {user_id} for model {model}: {str(e)}")
+        metrics.REJECTED_REQUESTS.labels(metric_model).inc()
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": e.retry_after_header})
+
+    try:
+        build_started = time.perf_counter()
+        # Stored conversations supply their own history; the client only sends the new turn
+        if conversation_id:
+            conversation = await conversations.store.get_conversation(conversation_id)
+            if conversation is None or conversation["user_id"] != user_id:
+                raise HTTPException(status_code=404, detail="Conversation not found")
+            history = await conversations.store.recent_messages(conversation_id, CONVERSATION_HISTORY_LIMIT)
+
+        # Referenced documents are checked before anything is stored
+        documents = await load_message_documents(request.document_ids, user_id) if request.document_ids else []
+
+        # Enhance prompt with category context
+        prompt_to_send = enhance_prompt(content, request.selected_category) if request.is_enhanced else content
+
+        # Ground the prompt on the most relevant chunks of the referenced documents
+        if documents:
+            try:
+                hits = await retriever.retrieve(user_id, documents, content)
+            except RuntimeError as e:
+                raise HTTPException(status_code=503, detail=str(e))
+            logger.info(f"Retrieved {len(hits)} document chunks for user {user_id}")
+            prompt_to_send = format_document_context(prompt_to_send, hits)
+
+        # Keep the most recent turns that fit the provider's token budget
+        messages = build_context_messages(
+            history, prompt_to_send, provider, original_prompt=content
+        )
+
+        metrics.PROMPT_BUILD_SECONDS.labels(metric_model).observe(time.perf_counter() - build_started)
+    except BaseException:
+        # The slot is only handed to the turn once its prompt is built
+        ticket.release()
+        raise
+
+    return ChatTurn(user_id, model, metric_model, content, prompt_to_send, messages, conversation_id, ticket)
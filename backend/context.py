@@ -0,0 +1,109 @@
+"""Token-budgeted conversation context for upstream chat requests.
+
+Turns the client-supplied `history` into a structured `messages` array that
+fits a per-provider token budget. The most recent turns are kept verbatim;
+older turns are dropped or folded into a short extractive summary. Turns are
+dropped in fixed-size steps so the kept prefix stays identical across several
+consecutive requests, which lets providers reuse their prefix cache.
+
+Settings: `HISTORY_TOKEN_BUDGET` (default 3000), `HISTORY_OVERFLOW`
+(`summarize` or `drop`) and `HISTORY_COMPACTION_STEP` (turns, default 4).
+"""
+import os
+from typing import List, Optional
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_OVERFLOW = os.getenv("HISTORY_OVERFLOW", "summarize").lower()
+HISTORY_COMPACTION_STEP = max(1, int(os.getenv("HISTORY_COMPACTION_STEP", "4")))
+
+# Share of the budget reserved for the summary of dropped turns
+SUMMARY_BUDGET_RATIO = 0.15
+SUMMARY_SNIPPET_CHARS = 120
+
+
+def estimate_tokens(text: str) -> int:
+    """Fallback token estimate when no provider is known"""
+    return int(len(text) / 4) + 1
+
+
+def _role(sender: str) -> str:
+    return "user" if sender == "user" else "assistant"
+
+
+def normalize_history(history: list, current_prompt: Optional[str] = None) -> List[dict]:
+    """Convert client history entries into chat messages, skipping malformed ones"""
+    messages = [
+        {"role": _role(msg["sender"]), "content": msg["content"]}
+        for msg in history
+        if isinstance(msg, dict) and 'sender' in msg and isinstance(msg.get('content'), str) and msg['content']
+    ]
+    # The web client includes the turn being sent as the last history entry
+    if current_prompt is not None and messages and messages[-1] == {"role": "user", "content": current_prompt}:
+        messages.pop()
+    return messages
+
+
+def summarize_turns(turns: List[dict], budget: int, count_tokens) -> Optional[str]:
+    """Extractive summary of dropped turns: the earlier user requests, newest first"""
+    lines = []
+    used = count_tokens("Summary of earlier conversation:\n")
+    for turn in reversed(turns):
+        if turn["role"] != "user":
+            continue
+        snippet = " ".join(turn["content"].split())
+        if len(snippet) > SUMMARY_SNIPPET_CHARS:
+            snippet = snippet[:SUMMARY_SNIPPET_CHARS].rstrip() + "..."
+        line = f"- The user asked: {snippet}"
+        cost = count_tokens(line)
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    if not lines:
+        return None
+    return "Summary of earlier conversation:\n" + "\n".join(reversed(lines))
+
+
+def build_context_messages(
+    history: list,
+    prompt: str,
+    provider=None,
+    budget: Optional[int] = None,
+    overflow: Optional[str] = None,
+    step: Optional[int] = None,
+    original_prompt: Optional[str] = None,
+) -> List[dict]:
+    """Build a messages array with the most recent turns that fit the token budget
+
+    `original_prompt` is the un-enhanced text the client echoes at the end of
+    `history`; it defaults to `prompt`.
+    """
+    count_tokens = provider.count_tokens if provider is not None else estimate_tokens
+    if budget is None:
+        budget = getattr(provider, "history_token_budget", None) or HISTORY_TOKEN_BUDGET
+    overflow = overflow or HISTORY_OVERFLOW
+    step = step or HISTORY_COMPACTION_STEP
+
+    turns = normalize_history(history, original_prompt if original_prompt is not None else prompt)
+    costs = [count_tokens(turn["content"]) for turn in turns]
+
+    total = sum(costs)
+    dropped = 0
+    if total > budget:
+        # Reserve room for the summary, then drop the oldest turns in whole steps
+        keep_budget = budget - int(budget * SUMMARY_BUDGET_RATIO) if overflow == "summarize" else budget
+        while dropped < len(turns) and total > keep_budget:
+            total -= costs[dropped]
+            dropped += 1
+        dropped = min(len(turns), -(-dropped // step) * step)
+
+    messages = []
+    if dropped:
+        summary = None
+        if overflow == "summarize":
+            summary = summarize_turns(turns[:dropped], int(budget * SUMMARY_BUDGET_RATIO), count_tokens)
+        if summary:
+            messages.append({"role": "system", "content": summary})
+    messages.extend(turns[dropped:])
+    messages.append({"role": "user", "content": prompt})
+    return messages
@@ -0,0 +1,271 @@
+"""Server-side conversation and message persistence.
+
+SQLite is the default backend (`CONVERSATION_DB_PATH`, default
+`conversations.db`); `CONVERSATION_STORE=memory` keeps everything in process,
+and `CONVERSATION_STORE=package.module:ClassName` loads a custom backend that
+implements `ConversationStore`.
+
+Listings are keyset-paginated: each page returns an opaque cursor encoding the
+(updated_at|timestamp, id) of its last row, so loading page N costs the same
+as loading page 1.
+"""
+import os
+import time
+import uuid
+import base64
+import sqlite3
+import asyncio
+import logging
+import importlib
+import threading
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TITLE_MAX_CHARS = 60
+PREVIEW_MAX_CHARS = 200
+
+
+def _iso(ts: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts)) + f".{int(ts % 1 * 1000):03d}Z"
+
+
+def encode_cursor(sort_value: float, row_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{sort_value!r}|{row_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[float, str]:
+    try:
+        sort_value, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return float(sort_value), row_id
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def make_title(content: str) -> str:
+    title = " ".join(content.split())
+    return title if len(title) <= TITLE_MAX_CHARS else title[:TITLE_MAX_CHARS].rstrip() + "..."
+
+
+class ConversationStore:
+    """Interface for conversation persistence backends"""
+
+    async def create_conversation(self, user_id: str, title: Optional[str] = None) -> dict:
+        raise NotImplementedError
+
+    async def get_conversation(self, conversation_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def list_conversations(self, user_id: str, limit: int, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """Newest-updated first"""
+        raise NotImplementedError
+
+    async def delete_conversation(self, conversation_id: str) -> bool:
+        raise NotImplementedError
+
+    async def append_message(self, conversation_id: str, sender: str, content: str) -> dict:
+        raise NotImplementedError
+
+    async def list_messages(self, conversation_id: str, limit: int, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """Oldest first, starting after `cursor`"""
+        raise NotImplementedError
+
+    async def recent_messages(self, conversation_id: str, limit: int) -> List[dict]:
+        """The last `limit` messages, oldest first"""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class SQLiteConversationStore(ConversationStore):
+    """SQLite-backed store; queries run in a worker thread"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                last_message TEXT NOT NULL DEFAULT '',
+                message_count INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_conversations_user_updated
+                ON conversations(user_id, updated_at);
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT PRIMARY KEY,
+                conversation_id TEXT NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+                sender TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation_timestamp
+                ON messages(conversation_id, timestamp);
+            """
+        )
+        self._conn.commit()
+
+    async def _run(self, fn, *args):
+        return await asyncio.to_thread(self._locked, fn, *args)
+
+    def _locked(self, fn, *args):
+        with self._lock:
+            return fn(*args)
+
+    @staticmethod
+    def _conversation(row) -> dict:
+        return {
+            "id": row["id"],
+            "title": row["title"],
+            "lastMessage": row["last_message"],
+            "messageCount": row["message_count"],
+            "createdAt": _iso(row["created_at"]),
+            "updatedAt": _iso(row["updated_at"]),
+            "user_id": row["user_id"],
+        }
+
+    @staticmethod
+    def _message(row) -> dict:
+        return {
+            "id": row["id"],
+            "content": row["content"],
+            "sender": row["sender"],
+            "timestamp": _iso(row["timestamp"]),
+            "conversation_id": row["conversation_id"],
+        }
+
+    def _create(self, user_id: str, title: Optional[str]) -> dict:
+        now = time.time()
+        conversation_id = f"conv_{uuid.uuid4().hex[:16]}"
+        self._conn.execute(
+            "INSERT INTO conversations (id, user_id, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (conversation_id, user_id, title or "New conversation", now, now),
+        )
+        self._conn.commit()
+        return self._get(conversation_id)
+
+    def _get(self, conversation_id: str) -> Optional[dict]:
+        row = self._conn.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        return self._conversation(row) if row else None
+
+    def _list(self, user_id: str, limit: int, cursor: Optional[str]):
+        if cursor:
+            updated_at, last_id = decode_cursor(cursor)
+            rows = self._conn.execute(
+                "SELECT * FROM conversations WHERE user_id = ? AND (updated_at < ? OR (updated_at = ? AND id < ?))"
+                " ORDER BY updated_at DESC, id DESC LIMIT ?",
+                (user_id, updated_at, updated_at, last_id, limit + 1),
+            ).fetchall()
+        else:
+            rows = self._conn.execute(
+                "SELECT * FROM conversations WHERE user_id = ? ORDER BY updated_at DESC, id DESC LIMIT ?",
+                (user_id, limit + 1),
+            ).fetchall()
+        next_cursor = encode_cursor(rows[limit - 1]["updated_at"], rows[limit - 1]["id"]) if len(rows) > limit else None
+        return [self._conversation(row) for row in rows[:limit]], next_cursor
+
+    def _delete(self, conversation_id: str) -> bool:
+        deleted = self._conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,)).rowcount
+        self._conn.commit()
+        return deleted > 0
+
+    def _append(self, conversation_id: str, sender: str, content: str) -> dict:
+        now = time.time()
+        message_id = f"msg_{uuid.uuid4().hex[:16]}"
+        self._conn.execute(
+            "INSERT INTO messages (id, conversation_id, sender, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+            (message_id, conversation_id, sender, content, now),
+        )
+        # Title the conversation after its first user message
+        self._conn.execute(
+            "UPDATE conversations SET last_message = ?, message_count = message_count + 1, updated_at = ?,"
+            " title = CASE WHEN message_count = 0 AND title = 'New conversation' AND ? = 'user' THEN ? ELSE title END"
+            " WHERE id = ?",
+            (content[:PREVIEW_MAX_CHARS], now, sender, make_title(content), conversation_id),
+        )
+        self._conn.commit()
+        row = self._conn.execute("SELECT * FROM messages WHERE id = ?", (message_id,)).fetchone()
+        return self._message(row)
+
+    def _messages(self, conversation_id: str, limit: int, cursor: Optional[str]):
+        if cursor:
+            timestamp, last_id = decode_cursor(cursor)
+            rows = self._conn.execute(
+                "SELECT * FROM messages WHERE conversation_id = ? AND (timestamp > ? OR (timestamp = ? AND id > ?))"
+                " ORDER BY timestamp, id LIMIT ?",
+                (conversation_id, timestamp, timestamp, last_id, limit + 1),
+            ).fetchall()
+        else:
+            rows = self._conn.execute(
+                "SELECT * FROM messages WHERE conversation_id = ? ORDER BY timestamp, id LIMIT ?",
+                (conversation_id, limit + 1),
+            ).fetchall()
+        next_cursor = encode_cursor(rows[limit - 1]["timestamp"], rows[limit - 1]["id"]) if len(rows) > limit else None
+        return [self._message(row) for row in rows[:limit]], next_cursor
+
+    def _recent(self, conversation_id: str, limit: int) -> List[dict]:
+        rows = self._conn.execute(
+            "SELECT * FROM messages WHERE conversation_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (conversation_id, limit),
+        ).fetchall()
+        return [self._message(row) for row in reversed(rows)]
+
+    async def create_conversation(self, user_id: str, title: Optional[str] = None) -> dict:
+        return await self._run(self._create, user_id, title)
+
+    async def get_conversation(self, conversation_id: str) -> Optional[dict]:
+        return await self._run(self._get, conversation_id)
+
+    async def list_conversations(self, user_id: str, limit: int, cursor: Optional[str] = None):
+        return await self._run(self._list, user_id, limit, cursor)
+
+    async def delete_conversation(self, conversation_id: str) -> bool:
+        return await self._run(self._delete, conversation_id)
+
+    async def append_message(self, conversation_id: str, sender: str, content: str) -> dict:
+        return await self._run(self._append, conversation_id, sender, content)
+
+    async def list_messages(self, conversation_id: str, limit: int, cursor: Optional[str] = None):
+        return await self._run(self._messages, conversation_id, limit, cursor)
+
+    async def recent_messages(self, conversation_id: str, limit: int) -> List[dict]:
+        return await self._run(self._recent, conversation_id, limit)
+
+    async def close(self) -> None:
+        await self._run(self._conn.close)
+
+
+class MemoryConversationStore(SQLiteConversationStore):
+    """Non-persistent store for development and benchmarks"""
+
+    def __init__(self):
+        super().__init__(":memory:")
+
+
+def build_store_from_env() -> ConversationStore:
+    backend = os.getenv("CONVERSATION_STORE", "sqlite")
+    if backend == "sqlite":
+        path = os.getenv("CONVERSATION_DB_PATH", "conversations.db")
+        logger.info(f"Conversation store: sqlite at {path}")
+        return SQLiteConversationStore(path)
+    if backend == "memory":
+        logger.info("Conversation store: in-memory")
+        return MemoryConversationStore()
+    # Custom backend given as "package.module:ClassName"
+    module_name, _, class_name = backend.partition(":")
+    store_cls = getattr(importlib.import_module(module_name), class_name)
+    logger.info(f"Conversation store: {backend}")
+    return store_cls()
+
+
+# Process-wide conversation store used by the API handlers
+store = build_store_from_env()
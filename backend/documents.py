@@ -0,0 +1,92 @@
+"""Content-addressed storage for uploaded documents.
+
+Uploads are streamed in fixed-size chunks into a temporary file while their
+SHA-256 is computed, so the process never holds a whole document in memory.
+The size limit is enforced as bytes arrive. Finished files are moved to
+`<UPLOAD_DIR>/objects/<sha[:2]>/<sha>`; a second upload of identical content
+finds the existing object and is not stored again.
+"""
+import os
+import uuid
+import hashlib
+import logging
+from dataclasses import dataclass
+
+import aiofiles
+import aiofiles.os
+from fastapi import UploadFile
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "10")) * 1024 * 1024)
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    """Upload exceeded the configured size limit while streaming"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"File too large (max {limit // (1024 * 1024)}MB)")
+        self.limit = limit
+
+
+@dataclass
+class StoredBlob:
+    sha256: str
+    size: int
+    path: str
+    deduplicated: bool
+
+
+class BlobStore:
+    """Content-addressed file store keyed by SHA-256"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def exists(self, sha256: str) -> bool:
+        return os.path.exists(self.path_for(sha256))
+
+    async def save_upload(self, file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES) -> StoredBlob:
+        """Stream an upload to disk, hashing and enforcing the size limit on the fly"""
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        try:
+            async with aiofiles.open(tmp_path, "wb") as out:
+                while True:
+                    chunk = await file.read(UPLOAD_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise UploadTooLarge(max_bytes)
+                    digest.update(chunk)
+                    await out.write(chunk)
+
+            sha256 = digest.hexdigest()
+            final_path = self.path_for(sha256)
+            if os.path.exists(final_path):
+                await aiofiles.os.remove(tmp_path)
+                return StoredBlob(sha256, size, final_path, deduplicated=True)
+
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            # Atomic publish: readers never see a partially written object
+            os.replace(tmp_path, final_path)
+            return StoredBlob(sha256, size, final_path, deduplicated=False)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+# Process-wide blob store used by the API handlers
+blob_store = BlobStore(UPLOAD_DIR)
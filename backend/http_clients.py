@@ -0,0 +1,212 @@
+"""Process-wide pooled HTTP clients for upstream AI providers.
+
+One `httpx.AsyncClient` is kept per provider for the lifetime of the app so
+TCP/TLS connections to openrouter.ai and api.deepseek.com are reused across
+requests. Pool limits and timeouts are read from the environment per provider,
+e.g. `OPENROUTER_POOL_MAX_CONNECTIONS` or `DEEPSEEK_READ_TIMEOUT`.
+"""
+import os
+import logging
+import importlib.util
+from dataclasses import dataclass
+from typing import Dict
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 needs the optional `h2` package (pip install httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+@dataclass
+class PoolConfig:
+    """Connection-pool limits and timeouts for one provider"""
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 10.0
+    read_timeout: float = 60.0
+    write_timeout: float = 10.0
+    pool_timeout: float = 10.0
+    http2: bool = HTTP2_AVAILABLE
+
+    @classmethod
+    def from_env(cls, name: str, **defaults) -> "PoolConfig":
+        """Build a config from `<NAME>_POOL_*` and `<NAME>_*_TIMEOUT` variables"""
+        base = cls(**defaults)
+        prefix = name.upper()
+        return cls(
+            max_connections=_env_int(f"{prefix}_POOL_MAX_CONNECTIONS", base.max_connections),
+            max_keepalive_connections=_env_int(f"{prefix}_POOL_MAX_KEEPALIVE", base.max_keepalive_connections),
+            keepalive_expiry=_env_float(f"{prefix}_POOL_KEEPALIVE_EXPIRY", base.keepalive_expiry),
+            connect_timeout=_env_float(f"{prefix}_CONNECT_TIMEOUT", base.connect_timeout),
+            read_timeout=_env_float(f"{prefix}_READ_TIMEOUT", base.read_timeout),
+            write_timeout=_env_float(f"{prefix}_WRITE_TIMEOUT", base.write_timeout),
+            pool_timeout=_env_float(f"{prefix}_POOL_TIMEOUT", base.pool_timeout),
+            http2=_env_bool(f"{prefix}_HTTP2", base.http2) and HTTP2_AVAILABLE,
+        )
+
+    @property
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    @property
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(
+            connect=self.connect_timeout,
+            read=self.read_timeout,
+            write=self.write_timeout,
+            pool=self.pool_timeout,
+        )
+
+
+@dataclass
+class PoolStats:
+    """Request counters for one pooled client"""
+    requests: int = 0
+    in_flight: int = 0
+    waits: int = 0
+    errors: int = 0
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """Response stream wrapper that releases the in-flight slot when closed"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, stats: PoolStats):
+        self._stream = stream
+        self._stats = stats
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._stats.in_flight -= 1
+        await self._stream.aclose()
+
+
+class TrackedTransport(httpx.AsyncHTTPTransport):
+    """HTTP transport that counts in-flight requests and pool waits"""
+
+    def __init__(self, config: PoolConfig, **kwargs):
+        super().__init__(limits=config.limits, http2=config.http2, **kwargs)
+        self.config = config
+        self.stats = PoolStats()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.stats.requests += 1
+        # A request beyond the connection limit has to queue for a free slot
+        if self.stats.in_flight >= self.config.max_connections:
+            self.stats.waits += 1
+        self.stats.in_flight += 1
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            self.stats.in_flight -= 1
+            self.stats.errors += 1
+            raise
+        response.stream = _TrackedStream(response.stream, self.stats)
+        return response
+
+    def connection_counts(self) -> Dict[str, int]:
+        """Open and idle connection counts from the underlying pool"""
+        pool = getattr(self, "_pool", None)
+        connections = list(getattr(pool, "connections", []) or [])
+        idle = sum(1 for conn in connections if conn.is_idle())
+        return {"open": len(connections), "idle": idle}
+
+
+class ClientRegistry:
+    """Shared, lifespan-scoped `httpx.AsyncClient` per upstream provider"""
+
+    def __init__(self):
+        self._configs: Dict[str, PoolConfig] = {}
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._transports: Dict[str, TrackedTransport] = {}
+
+    def configure(self, name: str, config: PoolConfig) -> None:
+        """Register pool settings for a provider (takes effect on next open)"""
+        self._configs[name] = config
+
+    def _build(self, name: str) -> httpx.AsyncClient:
+        config = self._configs.get(name) or PoolConfig.from_env(name)
+        self._configs[name] = config
+        transport = TrackedTransport(config)
+        self._transports[name] = transport
+        logger.info(
+            f"Opening HTTP pool '{name}' (max_connections={config.max_connections}, "
+            f"keepalive={config.max_keepalive_connections}, http2={config.http2})"
+        )
+        return httpx.AsyncClient(transport=transport, timeout=config.timeout)
+
+    async def open(self) -> None:
+        """Create clients for every configured provider (called at app startup)"""
+        for name in self._configs:
+            if name not in self._clients:
+                self._clients[name] = self._build(name)
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        """Return the pooled client for a provider, creating it on first use"""
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._build(name)
+            self._clients[name] = client
+        return client
+
+    async def aclose(self) -> None:
+        """Close every pooled client (called at app shutdown)"""
+        for name, client in list(self._clients.items()):
+            try:
+                await client.aclose()
+                logger.info(f"Closed HTTP pool '{name}'")
+            except Exception as e:
+                logger.error(f"Error closing HTTP pool '{name}': {str(e)}")
+        self._clients.clear()
+        self._transports.clear()
+
+    def stats(self) -> Dict[str, dict]:
+        """Pool usage per provider: in use, idle, waits and limits"""
+        result = {}
+        for name, transport in self._transports.items():
+            counts = transport.connection_counts()
+            result[name] = {
+                "in_use": transport.stats.in_flight,
+                "idle": counts["idle"],
+                "open_connections": counts["open"],
+                "waits": transport.stats.waits,
+                "requests": transport.stats.requests,
+                "errors": transport.stats.errors,
+                "max_connections": transport.config.max_connections,
+                "max_keepalive_connections": transport.config.max_keepalive_connections,
+                "http2": transport.config.http2,
+            }
+        return result
+
+
+# Process-wide registry used by the API handlers
+registry = ClientRegistry()
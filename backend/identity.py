@@ -0,0 +1,313 @@
+"""User identity issuance and the session registry.
+
+New users get IDs of the form `user_<ULID>`: a 48-bit millisecond timestamp
+followed by 80 random bits, Crockford base32 encoded. IDs are unique across
+threads and worker processes, and they sort by creation time. Within one
+millisecond the generator increments the random part, so IDs issued by a
+process stay strictly increasing.
+
+The session registry remembers which IDs are active and when each was last
+seen, so per-user caches, limits and conversation indexes key on a stable
+identity. Only IDs found in the registry are accepted: an unknown or expired
+ID is replaced by a newly issued one rather than registered on first sight,
+so clients cannot mint identities of their own. Sessions idle longer than `SESSION_TTL` seconds (default 30 days)
+are evicted. `SESSION_STORE=memory` (default) keeps a bounded in-process LRU
+(`SESSION_MAX_ENTRIES`). `SESSION_STORE=sqlite` (`SESSION_DB_PATH`) shares
+sessions between worker processes (needed with several workers, or IDs issued
+by one worker are unknown to the others); `package.module:ClassName` loads a custom
+`SessionStore`.
+"""
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import importlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(30 * 24 * 3600)))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "100000"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "300"))
+# Last-seen times are only written back this often per user
+SESSION_TOUCH_INTERVAL = float(os.getenv("SESSION_TOUCH_INTERVAL", "60"))
+
+USER_ID_PREFIX = "user_"
+MAX_USER_ID_CHARS = 128
+CROCKFORD_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
+class ULIDGenerator:
+    """Monotonic ULIDs: time-ordered, 80 bits of randomness per millisecond"""
+
+    RANDOM_BITS = 80
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._last_random = 0
+
+    def new(self) -> str:
+        with self._lock:
+            ms = time.time_ns() // 1_000_000
+            if ms <= self._last_ms:
+                # Same millisecond (or clock went back): keep ordering by incrementing
+                ms = self._last_ms
+                random_part = self._last_random + 1
+                if random_part >> self.RANDOM_BITS:
+                    ms += 1
+                    random_part = int.from_bytes(os.urandom(10), "big")
+            else:
+                random_part = int.from_bytes(os.urandom(10), "big")
+            self._last_ms, self._last_random = ms, random_part
+        value = (ms << self.RANDOM_BITS) | random_part
+        chars = []
+        for _ in range(26):
+            chars.append(CROCKFORD_ALPHABET[value & 31])
+            value >>= 5
+        return "".join(reversed(chars))
+
+
+def ulid_timestamp(ulid: str) -> float:
+    """Creation time (seconds) encoded in a ULID"""
+    value = 0
+    for char in ulid[:10]:
+        value = value * 32 + CROCKFORD_ALPHABET.index(char)
+    return value / 1000
+
+
+# --- Session stores ---
+
+class SessionStore:
+    """Interface for session registry backends; times are epoch seconds"""
+
+    async def touch(self, user_id: str, now: float) -> Tuple[float, float]:
+        """Register or refresh a session; returns (created_at, last_seen)"""
+        raise NotImplementedError
+
+    async def get(self, user_id: str) -> Optional[Tuple[float, float]]:
+        raise NotImplementedError
+
+    async def evict_expired(self, before: float) -> int:
+        raise NotImplementedError
+
+    async def count(self) -> int:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """Process-local LRU of sessions ordered by last activity"""
+
+    def __init__(self, max_entries: int = SESSION_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._sessions: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def touch(self, user_id: str, now: float) -> Tuple[float, float]:
+        created_at = self._sessions.pop(user_id, (now, now))[0]
+        self._sessions[user_id] = (created_at, now)
+        while len(self._sessions) > self.max_entries:
+            self._sessions.popitem(last=False)
+        return created_at, now
+
+    async def get(self, user_id: str) -> Optional[Tuple[float, float]]:
+        return self._sessions.get(user_id)
+
+    async def evict_expired(self, before: float) -> int:
+        evicted = 0
+        # Oldest activity first, so stop at the first live session
+        while self._sessions:
+            user_id, (_, last_seen) = next(iter(self._sessions.items()))
+            if last_seen >= before:
+                break
+            del self._sessions[user_id]
+            evicted += 1
+        return evicted
+
+    async def count(self) -> int:
+        return len(self._sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in a SQLite file shared by worker processes"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                last_seen REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_sessions_last_seen ON sessions(last_seen);
+            """
+        )
+        self._conn.commit()
+
+    async def _run(self, fn, *args):
+        return await asyncio.to_thread(self._locked, fn, *args)
+
+    def _locked(self, fn, *args):
+        with self._lock:
+            return fn(*args)
+
+    def _touch(self, user_id: str, now: float) -> Tuple[float, float]:
+        self._conn.execute(
+            "INSERT INTO sessions (user_id, created_at, last_seen) VALUES (?, ?, ?)"
+            " ON CONFLICT(user_id) DO UPDATE SET last_seen = excluded.last_seen",
+            (user_id, now, now),
+        )
+        self._conn.commit()
+        return self._get(user_id)
+
+    def _get(self, user_id: str) -> Optional[Tuple[float, float]]:
+        row = self._conn.execute("SELECT created_at, last_seen FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def _evict_expired(self, before: float) -> int:
+        evicted = self._conn.execute("DELETE FROM sessions WHERE last_seen < ?", (before,)).rowcount
+        self._conn.commit()
+        return evicted
+
+    def _count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    async def touch(self, user_id: str, now: float) -> Tuple[float, float]:
+        return await self._run(self._touch, user_id, now)
+
+    async def get(self, user_id: str) -> Optional[Tuple[float, float]]:
+        return await self._run(self._get, user_id)
+
+    async def evict_expired(self, before: float) -> int:
+        return await self._run(self._evict_expired, before)
+
+    async def count(self) -> int:
+        return await self._run(self._count)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def build_session_store_from_env() -> SessionStore:
+    backend = os.getenv("SESSION_STORE", "memory")
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "sqlite":
+        path = os.getenv("SESSION_DB_PATH", "sessions.db")
+        logger.info(f"Session store: sqlite at {path}")
+        return SQLiteSessionStore(path)
+    module_name, _, class_name = backend.partition(":")
+    store_cls = getattr(importlib.import_module(module_name), class_name)
+    logger.info(f"Session store: {backend}")
+    return store_cls()
+
+
+# --- Identity service ---
+
+class IdentityService:
+    """Issues user IDs and keeps the session registry current"""
+
+    def __init__(self, store: SessionStore, ttl: float = SESSION_TTL,
+                 touch_interval: float = SESSION_TOUCH_INTERVAL, sweep_interval: float = SESSION_SWEEP_INTERVAL):
+        self.store = store
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self.sweep_interval = sweep_interval
+        self.issued = 0
+        self.evicted = 0
+        self._ids = ULIDGenerator()
+        # Local write-back throttle: user_id -> (created_at, last write time)
+        self._recent: Dict[str, Tuple[float, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def new_user_id(self) -> str:
+        return USER_ID_PREFIX + self._ids.new()
+
+    async def issue(self) -> Tuple[str, float]:
+        """Create a new user session; returns (user_id, created_at)"""
+        user_id = self.new_user_id()
+        created_at, _ = await self.store.touch(user_id, time.time())
+        self._recent[user_id] = (created_at, created_at)
+        self.issued += 1
+        return user_id, created_at
+
+    async def resolve(self, user_id: Optional[str]) -> str:
+        """Return a known user ID (refreshing its session) or issue a new one"""
+        if not user_id:
+            return (await self.issue())[0]
+        if not isinstance(user_id, str) or len(user_id) > MAX_USER_ID_CHARS:
+            raise ValueError("Invalid user ID")
+        if not await self.is_known(user_id):
+            issued = (await self.issue())[0]
+            logger.info(f"Unknown user ID replaced with {issued}")
+            return issued
+        await self.touch(user_id)
+        return user_id
+
+    async def is_known(self, user_id: str) -> bool:
+        """Whether the ID was issued here and its session has not expired"""
+        if user_id in self._recent:
+            return True
+        return await self.store.get(user_id) is not None
+
+    async def touch(self, user_id: str) -> Tuple[float, float]:
+        """Refresh a session's last-seen time, writing through at most once per interval"""
+        now = time.time()
+        recent = self._recent.get(user_id)
+        if recent is not None and now - recent[1] < self.touch_interval:
+            return recent[0], now
+        created_at, last_seen = await self.store.touch(user_id, now)
+        if len(self._recent) >= SESSION_MAX_ENTRIES:
+            self._recent.clear()
+        self._recent[user_id] = (created_at, now)
+        return created_at, last_seen
+
+    async def sweep(self) -> int:
+        evicted = await self.store.evict_expired(time.time() - self.ttl)
+        if evicted:
+            self.evicted += evicted
+            self._recent.clear()
+            logger.info(f"Evicted {evicted} expired sessions")
+        return evicted
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Session sweep failed: {str(e)}")
+
+    def start(self) -> None:
+        if self.sweep_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.store.close()
+
+    async def snapshot(self) -> dict:
+        return {
+            "backend": type(self.store).__name__,
+            "sessions": await self.store.count(),
+            "issued": self.issued,
+            "evicted": self.evicted,
+            "ttl_seconds": self.ttl,
+        }
+
+
+# Process-wide identity service used by the API handlers
+identity = IdentityService(build_session_store_from_env())
@@ -0,0 +1,449 @@
+"""Background text extraction and chunk indexing for uploaded documents.
+
+Uploads are recorded and queued; the request returns at once with a document
+ID. Async dispatcher tasks hand each stored file to a process pool, which
+extracts the text and splits it into overlapping chunks off the event loop.
+Chunks are stored per content checksum, so identical files uploaded by
+different users are extracted only once. Clients poll the document status.
+
+Jobs are claimed atomically in the database before extraction, so several
+server workers sharing `documents.db` never process the same file twice. The
+worker holding a claim refreshes it while extracting; a periodic sweep requeues
+jobs whose claim went stale for `INGESTION_STALE_SECONDS`, so a job left
+`processing` by a worker that crashed or was restarted is picked up again.
+If an extractor takes its pool process down with it, the pool is replaced and
+the jobs it was running are retried once on the new one.
+
+When a document's chunks are ready, the `on_ready` hook (set by `retrieval`)
+receives them so they can be embedded off the request path.
+
+Settings: `DOCUMENT_DB_PATH` (default `documents.db`), `INGESTION_WORKERS`
+(process pool size), `INGESTION_CHUNK_CHARS`, `INGESTION_CHUNK_OVERLAP` and
+`INGESTION_SWEEP_INTERVAL`.
+"""
+import os
+import re
+import time
+import uuid
+import sqlite3
+import asyncio
+import logging
+import zipfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from documents import blob_store
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_DB_PATH = os.getenv("DOCUMENT_DB_PATH", "documents.db")
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", str(min(4, os.cpu_count() or 1))))
+CHUNK_CHARS = int(os.getenv("INGESTION_CHUNK_CHARS", "1000"))
+CHUNK_OVERLAP = int(os.getenv("INGESTION_CHUNK_OVERLAP", "200"))
+STALE_SECONDS = float(os.getenv("INGESTION_STALE_SECONDS", "120"))
+SWEEP_INTERVAL = float(os.getenv("INGESTION_SWEEP_INTERVAL", "30"))
+
+STATUS_QUEUED = "queued"
+STATUS_PROCESSING = "processing"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+
+
+# --- Extraction (runs in worker processes) ---
+
+def _extract_pdf(path: str) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise RuntimeError("PDF extraction requires the pypdf package")
+    reader = PdfReader(path)
+    return "\n\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def _extract_docx(path: str) -> str:
+    # A .docx is a zip archive; paragraphs live in word/document.xml
+    with zipfile.ZipFile(path) as archive:
+        xml = archive.read("word/document.xml").decode("utf-8", errors="replace")
+    paragraphs = []
+    for paragraph in re.findall(r"<w:p[ >].*?</w:p>", xml, flags=re.S):
+        text = "".join(re.findall(r"<w:t(?: [^>]*)?>([^<]*)</w:t>", paragraph))
+        if text:
+            paragraphs.append(text)
+    return "\n\n".join(paragraphs)
+
+
+def _extract_doc(path: str) -> str:
+    # Legacy binary .doc: keep runs of printable text (best effort without external tools)
+    with open(path, "rb") as f:
+        data = f.read()
+    runs = re.findall(rb"[\x20-\x7e\r\n\t]{20,}", data)
+    return "\n".join(run.decode("ascii", errors="ignore").strip() for run in runs)
+
+
+def _extract_txt(path: str) -> str:
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8", errors="replace")
+
+
+EXTRACTORS = {
+    "pdf": _extract_pdf,
+    "docx": _extract_docx,
+    "doc": _extract_doc,
+    "txt": _extract_txt,
+}
+
+
+def chunk_text(text: str, chunk_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """Split text into overlapping chunks, preferring paragraph and word boundaries"""
+    text = re.sub(r"[ \t]+", " ", text).strip()
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + chunk_chars)
+        if end < len(text):
+            # Back off to the last paragraph break, else the last space, in the second half
+            window = text[start:end]
+            cut = max(window.rfind("\n\n"), window.rfind(" "))
+            if cut > chunk_chars // 2:
+                end = start + cut
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+def extract_and_chunk(path: str, doc_type: str) -> List[str]:
+    """Worker entry point: extract text from a stored file and chunk it"""
+    extractor = EXTRACTORS.get(doc_type)
+    if extractor is None:
+        raise RuntimeError(f"No extractor for document type '{doc_type}'")
+    return chunk_text(extractor(path))
+
+
+# --- Persistence ---
+
+class DocumentIndex:
+    """SQLite tables for document records, per-checksum jobs and chunks"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                type TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_documents_user ON documents(user_id, created_at);
+            CREATE INDEX IF NOT EXISTS idx_documents_sha ON documents(sha256);
+            CREATE TABLE IF NOT EXISTS ingestion_jobs (
+                sha256 TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                error TEXT,
+                chunk_count INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                sha256 TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (sha256, idx)
+            );
+            """
+        )
+        self._conn.commit()
+
+    async def _run(self, fn, *args):
+        return await asyncio.to_thread(self._locked, fn, *args)
+
+    def _locked(self, fn, *args):
+        with self._lock:
+            return fn(*args)
+
+    def _add_document(self, user_id: str, sha256: str, filename: str, doc_type: str, size: int) -> tuple:
+        """Insert a document record; returns (document_id, job_status, created_job)"""
+        document_id = f"doc_{uuid.uuid4().hex[:16]}"
+        now = time.time()
+        self._conn.execute(
+            "INSERT INTO documents (id, user_id, sha256, filename, type, size, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (document_id, user_id, sha256, filename, doc_type, size, now),
+        )
+        row = self._conn.execute("SELECT status FROM ingestion_jobs WHERE sha256 = ?", (sha256,)).fetchone()
+        # A failed job is retried on re-upload; anything else is shared
+        created = row is None or row["status"] == STATUS_FAILED
+        if created:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ingestion_jobs (sha256, status, error, chunk_count, updated_at)"
+                " VALUES (?, ?, NULL, 0, ?)",
+                (sha256, STATUS_QUEUED, now),
+            )
+        self._conn.commit()
+        return document_id, STATUS_QUEUED if created else row["status"], created
+
+    def _set_status(self, sha256: str, status: str, error: Optional[str] = None) -> None:
+        self._conn.execute(
+            "UPDATE ingestion_jobs SET status = ?, error = ?, updated_at = ? WHERE sha256 = ?",
+            (status, error, time.time(), sha256),
+        )
+        self._conn.commit()
+
+    def _claim(self, sha256: str, stale_before: float) -> bool:
+        """Move a queued (or abandoned) job to processing; False if another worker has it"""
+        claimed = self._conn.execute(
+            "UPDATE ingestion_jobs SET status = ?, updated_at = ? WHERE sha256 = ?"
+            " AND (status = ? OR (status = ? AND updated_at < ?))",
+            (STATUS_PROCESSING, time.time(), sha256, STATUS_QUEUED, STATUS_PROCESSING, stale_before),
+        ).rowcount
+        self._conn.commit()
+        return claimed == 1
+
+    def _touch(self, sha256: str) -> None:
+        """Refresh the claim on a job that is still being processed"""
+        self._conn.execute(
+            "UPDATE ingestion_jobs SET updated_at = ? WHERE sha256 = ? AND status = ?",
+            (time.time(), sha256, STATUS_PROCESSING),
+        )
+        self._conn.commit()
+
+    def _store_chunks(self, sha256: str, chunks: List[str]) -> None:
+        self._conn.execute("DELETE FROM chunks WHERE sha256 = ?", (sha256,))
+        self._conn.executemany(
+            "INSERT INTO chunks (sha256, idx, text) VALUES (?, ?, ?)",
+            [(sha256, i, chunk) for i, chunk in enumerate(chunks)],
+        )
+        self._conn.execute(
+            "UPDATE ingestion_jobs SET status = ?, error = NULL, chunk_count = ?, updated_at = ? WHERE sha256 = ?",
+            (STATUS_READY, len(chunks), time.time(), sha256),
+        )
+        self._conn.commit()
+
+    def _get_document(self, document_id: str) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT d.*, j.status, j.error, j.chunk_count FROM documents d"
+            " JOIN ingestion_jobs j ON j.sha256 = d.sha256 WHERE d.id = ?",
+            (document_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "document_id": row["id"],
+            "user_id": row["user_id"],
+            "filename": row["filename"],
+            "type": row["type"],
+            "size": row["size"],
+            "checksum": row["sha256"],
+            "status": row["status"],
+            "error": row["error"],
+            "chunk_count": row["chunk_count"],
+        }
+
+    def _get_chunks(self, sha256: str) -> List[str]:
+        rows = self._conn.execute("SELECT text FROM chunks WHERE sha256 = ? ORDER BY idx", (sha256,)).fetchall()
+        return [row["text"] for row in rows]
+
+    def _get_chunk_texts(self, sha256: str, idxs: List[int]) -> dict:
+        placeholders = ",".join("?" * len(idxs))
+        rows = self._conn.execute(
+            f"SELECT idx, text FROM chunks WHERE sha256 = ? AND idx IN ({placeholders})", (sha256, *idxs)
+        ).fetchall()
+        return {row["idx"]: row["text"] for row in rows}
+
+    def _documents_for(self, sha256: str) -> List[Tuple[str, str]]:
+        rows = self._conn.execute("SELECT id, user_id FROM documents WHERE sha256 = ?", (sha256,)).fetchall()
+        return [(row["id"], row["user_id"]) for row in rows]
+
+    def _delete_document(self, document_id: str) -> bool:
+        # Jobs, chunks and blobs are keyed by content and may be shared with other uploads
+        deleted = self._conn.execute("DELETE FROM documents WHERE id = ?", (document_id,)).rowcount
+        self._conn.commit()
+        return deleted == 1
+
+    def _pending_jobs(self) -> List[tuple]:
+        rows = self._conn.execute(
+            "SELECT j.sha256, MIN(d.type) AS type FROM ingestion_jobs j JOIN documents d ON d.sha256 = j.sha256"
+            " WHERE j.status IN (?, ?) GROUP BY j.sha256",
+            (STATUS_QUEUED, STATUS_PROCESSING),
+        ).fetchall()
+        return [(row["sha256"], row["type"]) for row in rows]
+
+    def _stale_jobs(self, stale_before: float) -> List[tuple]:
+        rows = self._conn.execute(
+            "SELECT j.sha256, MIN(d.type) AS type FROM ingestion_jobs j JOIN documents d ON d.sha256 = j.sha256"
+            " WHERE j.status = ? AND j.updated_at < ? GROUP BY j.sha256",
+            (STATUS_PROCESSING, stale_before),
+        ).fetchall()
+        return [(row["sha256"], row["type"]) for row in rows]
+
+    async def add_document(self, user_id: str, sha256: str, filename: str, doc_type: str, size: int) -> tuple:
+        return await self._run(self._add_document, user_id, sha256, filename, doc_type, size)
+
+    async def set_status(self, sha256: str, status: str, error: Optional[str] = None) -> None:
+        await self._run(self._set_status, sha256, status, error)
+
+    async def claim(self, sha256: str, stale_before: float) -> bool:
+        return await self._run(self._claim, sha256, stale_before)
+
+    async def touch(self, sha256: str) -> None:
+        await self._run(self._touch, sha256)
+
+    async def store_chunks(self, sha256: str, chunks: List[str]) -> None:
+        await self._run(self._store_chunks, sha256, chunks)
+
+    async def get_document(self, document_id: str) -> Optional[dict]:
+        return await self._run(self._get_document, document_id)
+
+    async def get_chunks(self, sha256: str) -> List[str]:
+        return await self._run(self._get_chunks, sha256)
+
+    async def get_chunk_texts(self, sha256: str, idxs: List[int]) -> dict:
+        return await self._run(self._get_chunk_texts, sha256, idxs)
+
+    async def documents_for(self, sha256: str) -> List[Tuple[str, str]]:
+        return await self._run(self._documents_for, sha256)
+
+    async def delete_document(self, document_id: str) -> bool:
+        return await self._run(self._delete_document, document_id)
+
+    async def pending_jobs(self) -> List[tuple]:
+        return await self._run(self._pending_jobs)
+
+    async def stale_jobs(self, stale_before: float) -> List[tuple]:
+        return await self._run(self._stale_jobs, stale_before)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# --- Pipeline ---
+
+class IngestionPipeline:
+    """Queue of extraction jobs drained by async dispatchers onto a process pool"""
+
+    def __init__(self, index: DocumentIndex, path_for, workers: int = INGESTION_WORKERS,
+                 stale_seconds: float = STALE_SECONDS, sweep_interval: float = SWEEP_INTERVAL):
+        self.index = index
+        self.path_for = path_for
+        self.workers = max(1, workers)
+        self.stale_seconds = stale_seconds
+        self.sweep_interval = sweep_interval
+        self._queue: asyncio.Queue = None
+        self._pool: ProcessPoolExecutor = None
+        self._tasks: List[asyncio.Task] = []
+        # Called with [(document_id, user_id)] and the chunks once they are stored
+        self.on_ready: Optional[Callable[[List[Tuple[str, str]], List[str]], Awaitable[None]]] = None
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        self._tasks = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep()))
+        # Resume jobs interrupted by a restart; claims that are still fresh are left to the sweep
+        for sha256, doc_type in await self.index.pending_jobs():
+            self._queue.put_nowait((sha256, doc_type))
+        logger.info(f"Ingestion pipeline started with {self.workers} workers")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def submit(self, user_id: str, sha256: str, filename: str, doc_type: str, size: int) -> dict:
+        """Record an upload and queue extraction unless its content is already indexed"""
+        document_id, status, created = await self.index.add_document(user_id, sha256, filename, doc_type, size)
+        if created:
+            if self._queue is None:
+                # Lifespan not running (e.g. scripts): start the workers lazily
+                await self.start()
+            self._queue.put_nowait((sha256, doc_type))
+        elif status == STATUS_READY:
+            # Content was indexed for an earlier upload; only this document's hook is new
+            await self._notify_ready([(document_id, user_id)], await self.index.get_chunks(sha256))
+        return {"document_id": document_id, "status": status}
+
+    async def _notify_ready(self, documents: List[Tuple[str, str]], chunks: List[str]) -> None:
+        if self.on_ready is None or not chunks:
+            return
+        try:
+            await self.on_ready(documents, chunks)
+        except Exception as e:
+            # Best effort: retrieval indexes missing documents on first use
+            logger.error(f"Post-ingestion hook failed for {len(documents)} documents: {str(e)}")
+
+    async def _sweep(self) -> None:
+        """Requeue jobs whose worker stopped refreshing its claim"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                for sha256, doc_type in await self.index.stale_jobs(time.time() - self.stale_seconds):
+                    logger.warning(f"Requeueing stale ingestion job {sha256[:12]}")
+                    self._queue.put_nowait((sha256, doc_type))
+            except Exception as e:
+                logger.error(f"Error sweeping stale ingestion jobs: {str(e)}")
+
+    async def _heartbeat(self, sha256: str) -> None:
+        while True:
+            await asyncio.sleep(self.stale_seconds / 3)
+            await self.index.touch(sha256)
+
+    def _replace_pool(self, broken: ProcessPoolExecutor) -> None:
+        # Every job on a broken pool fails at once; only the first to notice replaces it
+        if self._pool is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    async def _extract(self, sha256: str, doc_type: str) -> List[str]:
+        """Run extraction on the pool, retrying once on a fresh pool if a worker process died"""
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            pool = self._pool
+            try:
+                return await loop.run_in_executor(pool, extract_and_chunk, self.path_for(sha256), doc_type)
+            except BrokenProcessPool:
+                logger.warning(f"Ingestion worker died while extracting {sha256[:12]}; replacing the pool")
+                self._replace_pool(pool)
+                if attempt:
+                    raise
+
+    async def _dispatch(self) -> None:
+        while True:
+            sha256, doc_type = await self._queue.get()
+            heartbeat = None
+            try:
+                if not await self.index.claim(sha256, time.time() - self.stale_seconds):
+                    continue
+                heartbeat = asyncio.create_task(self._heartbeat(sha256))
+                chunks = await self._extract(sha256, doc_type)
+                await self.index.store_chunks(sha256, chunks)
+                logger.info(f"Indexed document {sha256[:12]} into {len(chunks)} chunks")
+                await self._notify_ready(await self.index.documents_for(sha256), chunks)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error extracting document {sha256[:12]}: {str(e)}")
+                error = "Extraction worker crashed" if isinstance(e, BrokenProcessPool) else str(e)
+                await self.index.set_status(sha256, STATUS_FAILED, error)
+            finally:
+                if heartbeat is not None:
+                    heartbeat.cancel()
+                self._queue.task_done()
+
+
+# Process-wide pipeline used by the API handlers
+pipeline = IngestionPipeline(DocumentIndex(DOCUMENT_DB_PATH), blob_store.path_for)
@@ -0,0 +1,387 @@
+"""Admission control for chat requests: per-user rate limits and provider caps.
+
+Every `/api/message` call is admitted before any work starts (a batch counts
+once against the rate limit and takes a provider slot per item):
+
+1. A token bucket keyed on the client address (`CLIENT_RATE_PER_MINUTE`,
+   `CLIENT_BURST`), so rotating or dropping `user_id` does not buy a fresh
+   allowance.
+2. A token bucket keyed on `user_id` (`USER_RATE_PER_MINUTE`, `USER_BURST`).
+3. A per-provider gate capping concurrent upstream requests at the provider's
+   `max_concurrency`, with a bounded wait queue (`max_queue`, default
+   `ADMISSION_MAX_QUEUE`) and a queue timeout (`ADMISSION_QUEUE_TIMEOUT`).
+
+A request that is over its rate, or that finds the wait queue full, is
+rejected at once with `AdmissionRejected` carrying a Retry-After estimate, so
+the handler can answer 429 instead of piling work onto the event loop.
+
+Token buckets live in an in-memory backend by default. Multi-worker
+deployments share them through `RATE_LIMIT_BACKEND=sqlite` (one host,
+`RATE_LIMIT_DB_PATH`) or `RATE_LIMIT_BACKEND=redis` (`REDIS_URL`, needs the
+optional `redis` package); `package.module:ClassName` plugs in anything else.
+Provider caps are split evenly across the `WEB_CONCURRENCY` worker processes
+so the deployment as a whole keeps the configured limits.
+"""
+import os
+import math
+import time
+import asyncio
+import logging
+import sqlite3
+import importlib
+import threading
+from collections import deque
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Shared buckets across hosts need the optional `redis` package
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+USER_RATE_PER_MINUTE = float(os.getenv("USER_RATE_PER_MINUTE", "30"))
+USER_BURST = float(os.getenv("USER_BURST", "10"))
+# Several users can share one address (NAT, offices), so its allowance is wider
+CLIENT_RATE_PER_MINUTE = float(os.getenv("CLIENT_RATE_PER_MINUTE", "120"))
+CLIENT_BURST = float(os.getenv("CLIENT_BURST", "30"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Worker processes sharing the provider caps (set by server.py)
+WORKER_COUNT = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+
+class AdmissionRejected(Exception):
+    """Request refused by a rate limit or a full provider queue"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+# --- Rate limit backends ---
+
+class RateLimitBackend:
+    """Token-bucket storage; `take` returns 0 when allowed, else seconds to wait"""
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """Process-local token buckets with periodic pruning of idle keys"""
+
+    PRUNE_EVERY = 1024
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._ops = 0
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        self._ops += 1
+        if self._ops % self.PRUNE_EVERY == 0:
+            self._prune(now, rate, burst)
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            return 0.0
+        self._buckets[key] = (tokens, now)
+        return (1 - tokens) / rate
+
+    def _prune(self, now: float, rate: float, burst: float) -> None:
+        # A bucket idle long enough to refill completely carries no state
+        full_after = burst / rate if rate > 0 else 0
+        idle = [key for key, (_, updated) in self._buckets.items() if now - updated > full_after]
+        for key in idle:
+            del self._buckets[key]
+
+
+class SQLiteRateLimitBackend(RateLimitBackend):
+    """Token buckets in a SQLite file shared by the worker processes on one host"""
+
+    PRUNE_EVERY = 1024
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5.0, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._ops = 0
+
+    def _take(self, key: str, rate: float, burst: float) -> float:
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the write lock up front so read-modify-write is atomic across processes
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+                tokens, updated = row if row else (burst, now)
+                tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)", (key, tokens, now)
+                )
+                self._ops += 1
+                if self._ops % self.PRUNE_EVERY == 0 and rate > 0:
+                    self._conn.execute("DELETE FROM rate_buckets WHERE updated_at < ?", (now - burst / rate,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        return await asyncio.to_thread(self._take, key, rate, burst)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# Atomic refill-and-take using the Redis clock so hosts don't need synced clocks
+REDIS_TOKEN_BUCKET = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """Token buckets in Redis, shared by workers on any number of hosts"""
+
+    def __init__(self, url: str):
+        if aioredis is None:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis needs the `redis` package (pip install redis)")
+        self._client = aioredis.from_url(url)
+        self._script = self._client.register_script(REDIS_TOKEN_BUCKET)
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        return float(await self._script(keys=[f"zorifbot:rate:{key}"], args=[rate, burst]))
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+def build_rate_limit_backend() -> RateLimitBackend:
+    backend = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    if backend == "memory":
+        return MemoryRateLimitBackend()
+    if backend == "sqlite":
+        path = os.getenv("RATE_LIMIT_DB_PATH", "rate_limits.db")
+        logger.info(f"Rate limit backend: sqlite at {path}")
+        return SQLiteRateLimitBackend(path)
+    if backend == "redis":
+        logger.info("Rate limit backend: redis")
+        return RedisRateLimitBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    module_name, _, class_name = backend.partition(":")
+    backend_cls = getattr(importlib.import_module(module_name), class_name)
+    logger.info(f"Rate limit backend: {backend}")
+    return backend_cls()
+
+
+# --- Provider gates ---
+
+@dataclass
+class GateStats:
+    admitted: int = 0
+    queued: int = 0
+    rejected: int = 0
+    timed_out: int = 0
+
+
+class ProviderGate:
+    """Concurrency cap with a bounded FIFO wait queue for one provider"""
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.stats = GateStats()
+        self._active = 0
+        self._waiters: deque = deque()
+        # Smoothed slot hold time, used for Retry-After estimates
+        self._avg_hold = 1.0
+
+    def retry_after(self) -> float:
+        return self._avg_hold * (len(self._waiters) + 1) / self.max_concurrent
+
+    def try_acquire(self) -> bool:
+        """Take a slot only if one is free right now, without queueing"""
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            self.stats.admitted += 1
+            return True
+        return False
+
+    async def acquire(self) -> None:
+        if self.try_acquire():
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.stats.rejected += 1
+            raise AdmissionRejected(f"{self.name} is at capacity, try again later", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.stats.queued += 1
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats.timed_out += 1
+            raise AdmissionRejected(f"Timed out waiting for {self.name} capacity", self.retry_after())
+        except asyncio.CancelledError:
+            # The slot may have been handed over just as the caller went away
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        self.stats.admitted += 1
+
+    def release(self, held_for: Optional[float] = None) -> None:
+        if held_for is not None:
+            self._avg_hold = 0.8 * self._avg_hold + 0.2 * held_for
+        # Hand the slot straight to the next live waiter
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    def snapshot(self) -> dict:
+        return {
+            "active": self._active,
+            "waiting": len(self._waiters),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            **asdict(self.stats),
+        }
+
+
+class Ticket:
+    """An admitted request's provider slot; release is idempotent"""
+
+    def __init__(self, gate: Optional[ProviderGate]):
+        self._gate = gate
+        self._start = time.monotonic()
+
+    def release(self) -> None:
+        gate, self._gate = self._gate, None
+        if gate is not None:
+            gate.release(time.monotonic() - self._start)
+
+    def __del__(self):
+        # Call sites release in `finally` blocks; a ticket collected while held is a bug, not a release path
+        if self._gate is not None:
+            logger.error(f"{self._gate.name} admission slot was never released")
+
+
+class AdmissionController:
+    """Per-client and per-user token buckets plus per-provider gates"""
+
+    def __init__(self, backend: RateLimitBackend, rate_per_minute: float = USER_RATE_PER_MINUTE,
+                 burst: float = USER_BURST, max_queue: int = ADMISSION_MAX_QUEUE,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+                 client_rate_per_minute: float = CLIENT_RATE_PER_MINUTE, client_burst: float = CLIENT_BURST):
+        self.backend = backend
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.client_rate = client_rate_per_minute / 60.0
+        self.client_burst = client_burst
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate_limited = 0
+        self._gates: Dict[str, ProviderGate] = {}
+
+    def gate_for(self, provider) -> ProviderGate:
+        gate = self._gates.get(provider.model)
+        if gate is None:
+            max_queue = getattr(provider, "max_queue", None)
+            max_queue = self.max_queue if max_queue is None else max_queue
+            # Each worker gets its share of the deployment-wide caps
+            gate = ProviderGate(
+                provider.name,
+                math.ceil(provider.max_concurrency / WORKER_COUNT),
+                math.ceil(max_queue / WORKER_COUNT),
+                self.queue_timeout,
+            )
+            self._gates[provider.model] = gate
+        return gate
+
+    async def check_rate(self, user_id: str, client: Optional[str] = None) -> None:
+        """Take one request from the client address's bucket, then from the user's"""
+        if client and self.client_rate > 0:
+            wait = await self.backend.take(f"client:{client}", self.client_rate, self.client_burst)
+            if wait > 0:
+                self.rate_limited += 1
+                raise AdmissionRejected("Rate limit exceeded", wait)
+        if self.rate > 0:
+            wait = await self.backend.take(f"user:{user_id}", self.rate, self.burst)
+            if wait > 0:
+                self.rate_limited += 1
+                raise AdmissionRejected("Rate limit exceeded", wait)
+
+    async def acquire_slot(self, provider=None) -> Ticket:
+        """Take (or queue for) a provider slot"""
+        if provider is None:
+            return Ticket(None)
+        gate = self.gate_for(provider)
+        await gate.acquire()
+        return Ticket(gate)
+
+    def try_slot(self, provider) -> Optional[Ticket]:
+        """A provider slot if one is free, for extra work that should not queue (hedged requests)"""
+        gate = self.gate_for(provider)
+        return Ticket(gate) if gate.try_acquire() else None
+
+    async def admit(self, user_id: str, provider=None, client: Optional[str] = None) -> Ticket:
+        """Check the client's and user's rates, then take (or queue for) a provider slot"""
+        await self.check_rate(user_id, client)
+        return await self.acquire_slot(provider)
+
+    def snapshot(self) -> dict:
+        return {
+            "rate_per_minute": self.rate * 60,
+            "burst": self.burst,
+            "client_rate_per_minute": self.client_rate * 60,
+            "client_burst": self.client_burst,
+            "rate_limited": self.rate_limited,
+            "providers": {model: gate.snapshot() for model, gate in self._gates.items()},
+        }
+
+
+# Process-wide admission controller used by the API handlers
+admission = AdmissionController(build_rate_limit_backend())
@@ -1,23 +1,74 @@
 import os
+import asyncio
+import secrets
 import logging
 import time
-from fastapi import FastAPI, HTTPException, Body, UploadFile, File
+from fastapi import FastAPI, HTTPException, Body, Depends, UploadFile, File, Query, Request, Response, Header, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-import httpx
-from fastapi.responses import StreamingResponse
-from typing import Optional
-import json
+from fastapi.responses import JSONResponse, PlainTextResponse
+from typing import Dict, List, Optional
+from contextlib import aclosing, asynccontextmanager
 from dotenv import load_dotenv
-from openai import OpenAI
+from pydantic import ValidationError
+from pydantic_core import from_json, to_json
+from starlette.datastructures import Headers
+from starlette.requests import HTTPConnection
+from starlette.types import Message, Receive, Scope, Send
 
-# Load environment variables from .env file
+# Load environment variables before provider configuration is read
 load_dotenv()
 
+import conversations
+from chat import call_external_ai_api, enhance_prompt, prepare_turn
+from catalog import TemplateCatalog, conditional_response
+from template_store import TEMPLATE_STORE_PATH, TemplateWatcher, load_templates
+import http_clients
+from identity import identity
+import ingestion
+import metrics
+from documents import MAX_UPLOAD_BYTES, UploadTooLarge, blob_store
+from limits import AdmissionRejected, admission
+import providers
+from cache import completion_cache
+from context import build_context_messages
+from providers import Provider
+from resilience import upstream
+from retrieval import retriever
+from schemas import (
+    MAX_JSON_BODY_BYTES, BatchMessageRequest, Category, Conversation, ConversationDeleted,
+    ConversationPage, CreateConversationRequest, DocumentDeleted, DocumentStatus, EnhancePromptRequest,
+    EnhancePromptResponse, MessagePage, MessageRequest, ModelUsageReport, PromptTemplate, TemplateSearchResult,
+    UploadResponse, User, UserUsageReport,
+)
+from singleflight import coalescer
+from streaming import DisconnectAwareStreamingResponse
+from usage import ledger
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared resources at startup and release them at shutdown"""
+    await http_clients.registry.open()
+    await ingestion.pipeline.start()
+    template_watcher.start()
+    identity.start()
+    ledger.start()
+    yield
+    await ledger.stop()
+    await identity.stop()
+    await template_watcher.stop()
+    await ingestion.pipeline.stop()
+    await http_clients.registry.aclose()
+    await conversations.store.close()
+    await admission.backend.close()
+    retriever.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow frontend dev server
 app.add_middleware(
@@ -26,146 +77,68 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Retry-After"],
 )
 
-# Helper: Enhance prompt with category context
-def enhance_prompt(original_prompt: str, selected_category: Optional[str] = None) -> str:
-    enhancement_prefix = (
-        "You are an expert AI assistant. Please provide a detailed, accurate, and helpful response to the following query. Be specific, include examples where appropriate, and structure your response clearly.\n\n"
-    )
-    
-    # Add category-specific context if provided
-    if selected_category:
-        category_context = f"Context: The user is working in the '{selected_category}' domain. Please tailor your response accordingly.\n\n"
-        enhancement_prefix += category_context
-    
-    enhancement_prefix += "Query: "
-    enhancement_suffix = "\n\nPlease ensure your response is:\n- Accurate and well-researched\n- Clear and easy to understand\n- Includes practical examples if relevant\n- Structured with proper formatting\n- Comprehensive yet concise"
-    
-    return enhancement_prefix + original_prompt + enhancement_suffix
+# Batch messages: most prompts run at once (the per-request limit is in schemas.py)
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
 
-# Helper: Generate fallback response
-def generate_fallback_response(prompt: str) -> str:
-    """Generate a helpful fallback response when API is not available"""
-    prompt_lower = prompt.lower().strip()
-    
-    # Simple keyword-based responses
-    if any(word in prompt_lower for word in ['hello', 'hi', 'hey']):
-        return "Hello! I'm your AI assistant. I'm currently in offline mode due to missing API key, but I'm here to help. How can I assist you today?"
-    
-    elif any(word in prompt_lower for word in ['code', 'programming', 'function', 'algorithm']):
-        return f"I see you're asking about code: '{prompt}'. While I'm in offline mode, I can suggest that you:\n\n1. Check the syntax and structure of your code\n2. Look for common programming patterns\n3. Consider edge cases and error handling\n4. Test with different inputs\n\nWould you like me to help you with any specific programming concepts when the API is available?"
-    
-    elif any(word in prompt_lower for word in ['explain', 'what is', 'how does']):
-        return f"You're asking: '{prompt}'. This is a great question! While I'm in offline mode, I'd recommend:\n\n1. Breaking down the concept into smaller parts\n2. Looking for real-world examples\n3. Checking official documentation\n4. Practicing with simple examples\n\nI'll be able to provide more detailed explanations once the API is available."
-    
-    elif any(word in prompt_lower for word in ['help', 'assist', 'support']):
-        return "I'm here to help! While I'm currently in offline mode, I can still guide you. What specific area do you need assistance with? I'll be able to provide more detailed help once the API connection is restored."
-    
-    else:
-        return f"Thank you for your message: '{prompt}'. I'm currently in offline mode due to missing API key, but I'm here to assist you. I'll be able to provide more comprehensive responses once the API connection is available. Is there anything specific I can help you with?"
+# WebSocket chat: most requests one connection may have in flight
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "8"))
 
-# Helper: Call AI API (OpenRouter with Phi-4)
-async def call_external_ai_api(prompt: str, model: str, user_id: str) -> str:
-    logger.info(f"Calling AI API for user {user_id} with model {model}")
-    
-    # OpenRouter API configuration
-    if model == "phi4":
-        api_key = os.getenv("OPENROUTER_API_KEY")
-        if not api_key:
-            logger.warning("OpenRouter API key not configured, using fallback response")
-            return generate_fallback_response(prompt)
-        
-        try:
-            # Initialize OpenAI client with OpenRouter configuration
-            client = OpenAI(
-                base_url="https://openrouter.ai/api/v1",
-                api_key=api_key,
-            )
-            
-            # Create completion using OpenRouter
-            completion = client.chat.completions.create(
-                extra_headers={
-                    "HTTP-Referer": "http://localhost:3000",  # Your frontend URL
-                    "X-Title": "ZorifBot",  # Your app name
-                },
-                model="microsoft/phi-4",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                max_tokens=1000,
-                temperature=0.7
-            )
-            
-            result = completion.choices[0].message.content
-            logger.info(f"Successfully received OpenRouter Phi-4 response for user {user_id}")
-            return result
-            
-        except Exception as e:
-            logger.error(f"Error calling OpenRouter API for user {user_id}: {str(e)}")
-            return generate_fallback_response(prompt)
-    
-    # DeepSeek API configuration (fallback)
-    elif model == "deepseek":
-        url = "https://api.deepseek.com/v1/chat/completions"
-        api_key = os.getenv("DEEPSEEK_API_KEY")
-        
-        if not api_key:
-            logger.warning("DeepSeek API key not configured, using fallback response")
-            return generate_fallback_response(prompt)
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f"Bearer {api_key}"
-        }
-        
-        # DeepSeek expects messages array format
-        payload = {
-            "model": "deepseek-chat",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "max_tokens": 1000,
-            "temperature": 0.7
-        }
-        
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json=payload, headers=headers, timeout=30)
-                
-                # Handle specific error codes
-                if response.status_code == 402:
-                    logger.error("DeepSeek API: Payment required - insufficient credits or billing not set up")
-                    return generate_fallback_response(prompt)
-                
-                response.raise_for_status()
-                
-                # Parse DeepSeek response format
-                response_data = response.json()
-                if 'choices' in response_data and len(response_data['choices']) > 0:
-                    result = response_data['choices'][0]['message']['content']
-                    logger.info(f"Successfully received DeepSeek response for user {user_id}")
-                    return result
-                else:
-                    raise HTTPException(status_code=500, detail="Invalid response format from DeepSeek")
-                    
-        except httpx.HTTPStatusError as e:
-            logger.error(f"DeepSeek API HTTP error: {e.response.status_code} - {e.response.text}")
-            return generate_fallback_response(prompt)
-        except Exception as e:
-            logger.error(f"Error calling DeepSeek API for user {user_id}: {str(e)}")
-            return generate_fallback_response(prompt)
-    
-    # Fallback for other models (placeholder)
-    else:
-        logger.warning(f"Model {model} not implemented, using placeholder response")
-        return f"This is a placeholder response for model {model}. Your prompt was: {prompt}"
+# Usage reports: bearer token for the per-user and per-model reports (unset disables them)
+USAGE_ADMIN_TOKEN = os.getenv("USAGE_ADMIN_TOKEN", "")
+
+# Multipart framing allowance on top of the upload size limit
+UPLOAD_OVERHEAD_BYTES = 64 * 1024
+
+class RequestSizeLimit:
+    """Reject uploads and JSON bodies over the size limit, declared or not
+
+    A declared Content-Length over the limit is refused before the body is read.
+    Otherwise the bytes are counted as the app reads them, so chunked bodies
+    and understated lengths are cut off with the same 413 once they pass it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["path"] == "/api/upload-document":
+            limit = MAX_UPLOAD_BYTES + UPLOAD_OVERHEAD_BYTES
+            detail = f"File too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)}MB)"
+        else:
+            limit = MAX_JSON_BODY_BYTES
+            detail = f"Request body too large (max {MAX_JSON_BODY_BYTES // 1024}KB)"
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            await JSONResponse(status_code=413, content={"detail": detail})(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # FastAPI re-raises HTTPExceptions from body parsing, so this answers 413
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(RequestSizeLimit)
+
+@app.exception_handler(RequestValidationError)
+async def report_validation_errors(request: Request, exc: RequestValidationError):
+    """Report invalid requests without echoing their (possibly oversized) input back"""
+    errors = [{key: value for key, value in error.items() if key != "input"} for error in exc.errors()]
+    return JSONResponse(status_code=422, content={"detail": jsonable_encoder(errors)})
 
 # Helper: Process uploaded document
 async def process_uploaded_document(file: UploadFile, user_id: str) -> dict:
@@ -182,99 +155,289 @@ async def process_uploaded_document(file: UploadFile, user_id: str) -> dict:
         if file.content_type not in allowed_types:
             raise HTTPException(status_code=400, detail="Invalid file type")
         
-        # Validate file size (10MB limit)
-        if file.size and file.size > 10 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File too large (max 10MB)")
-        
-        # Read file content
-        content = await file.read()
+        # Stream to the content-addressed store; the size limit is enforced while reading
+        try:
+            blob = await blob_store.save_upload(file, MAX_UPLOAD_BYTES)
+        except UploadTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
         
-        # In a real implementation, you would:
-        # 1. Save the file to storage
-        # 2. Process the content (extract text, analyze, etc.)
-        # 3. Store metadata in database
-        # 4. Return document ID and metadata
+        # Queue text extraction; content that was already indexed is not processed again
+        doc_type = allowed_types[file.content_type]
+        job = await ingestion.pipeline.submit(user_id, blob.sha256, file.filename or "upload", doc_type, blob.size)
         
-        logger.info(f"Document uploaded by user {user_id}: {file.filename} ({len(content)} bytes)")
+        logger.info(
+            f"Document uploaded by user {user_id}: {file.filename} ({blob.size} bytes, "
+            f"sha256 {blob.sha256[:12]}{', duplicate' if blob.deduplicated else ''}, {job['status']})"
+        )
         
         return {
+            "document_id": job["document_id"],
             "filename": file.filename,
-            "size": len(content),
-            "type": allowed_types[file.content_type],
+            "size": blob.size,
+            "type": doc_type,
+            "checksum": blob.sha256,
+            "deduplicated": blob.deduplicated,
             "user_id": user_id,
-            "status": "uploaded",
+            "status": job["status"],
             "message": "Document uploaded successfully"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing document for user {user_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Document processing error: {str(e)}")
 
+# Helper: Peer address a request's per-client rate limit is keyed on
+def client_address(connection: HTTPConnection) -> Optional[str]:
+    return connection.client.host if connection.client else None
+
 # --- API Endpoints ---
 
 @app.post("/api/message")
 async def send_message(
-    data: dict = Body(...),
+    data: MessageRequest,
+    request: Request,
 ):
     """Enhanced message endpoint with user ID and category support"""
     try:
-        content = data.get("content")
-        is_enhanced = data.get("is_enhanced", False)
-        history = data.get("history", [])
-        model = data.get("model", "phi4")
-        user_id = data.get("user_id")
-        selected_category = data.get("selected_category")
-        
-        # Validate required fields
-        if not content or not isinstance(content, str):
-            raise HTTPException(status_code=400, detail="Content is required")
-        
-        # If no user_id provided, generate a new one
-        if not user_id:
-            user_id = "backend-user-" + str(int(time.time() * 1000))[-8:]
+        turn = await prepare_turn(data, client=client_address(request))
         
-        # Build context from conversation history
-        context = "\n".join([
-            f"{msg['sender']}: {msg['content']}" for msg in history if 'sender' in msg and 'content' in msg
-        ])
+        # Stream the upstream response with user_id included
+        async def stream_response():
+            # First yield the user_id as a special header
+            chunk = f"USER_ID:{turn.user_id}\n".encode("utf-8")
+            turn.bytes_sent += len(chunk)
+            yield chunk
+            # Then relay tokens as the provider produces them
+            async with aclosing(turn.stream()) as tokens:
+                async for token in tokens:
+                    chunk = token.encode("utf-8")
+                    turn.bytes_sent += len(chunk)
+                    yield chunk
+        
+        # The slot is released when the response ends, even if its body never started
+        return DisconnectAwareStreamingResponse(stream_response(), media_type="text/plain", on_close=turn.release)
         
-        # Enhance prompt with category context
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error in send_message: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+# Helper: Run one batch item and describe its result as an NDJSON record
+async def run_batch_item(index: int, content: str, model: str, user_id: str, provider: Optional[Provider],
+                         is_enhanced: bool, selected_category: Optional[str]) -> dict:
+    if not content:
+        return {"index": index, "ok": False, "outcome": "invalid", "error": "Content is required"}
+    try:
+        ticket = await admission.acquire_slot(provider)
+    except AdmissionRejected as e:
+        return {"index": index, "ok": False, "outcome": "rejected", "error": str(e), "retryAfter": e.retry_after}
+    try:
         prompt_to_send = enhance_prompt(content, selected_category) if is_enhanced else content
+        messages = build_context_messages([], prompt_to_send, provider, original_prompt=content)
+        outcome = {"outcome": "ok"}
+        reply = await call_external_ai_api(prompt_to_send, model, user_id, messages, outcome)
+    finally:
+        ticket.release()
+    # Failed or unavailable upstream calls get a canned fallback text, which is no use to a batch caller
+    if outcome["outcome"] in ("error", "402", "fallback"):
+        return {"index": index, "ok": False, "outcome": outcome["outcome"], "error": "Upstream request failed"}
+    return {"index": index, "ok": True, "outcome": outcome["outcome"], "content": reply}
+
+@app.post("/api/message/batch")
+async def send_message_batch(
+    data: BatchMessageRequest,
+    request: Request,
+):
+    """Run many prompts with shared settings; results stream back as NDJSON in completion order"""
+    try:
+        prompts = data.prompts
+        is_enhanced = data.is_enhanced
+        model = data.model
+        selected_category = data.selected_category
+        concurrency = min(data.max_concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY, len(prompts))
         
-        if context:
-            prompt_to_send = f"Previous conversation:\n{context}\n\nCurrent: {prompt_to_send}"
-        
-        # Call external AI API
-        ai_response = await call_external_ai_api(prompt_to_send, model, user_id)
-        
-        # Stream the response with user_id included
-        async def stream_response(text: str):
-            # First yield the user_id as a special header
-            yield f"USER_ID:{user_id}\n"
-            # Then stream the actual response
-            for i in range(0, len(text), 30):
-                yield text[i:i+30]
-                import asyncio
-                await asyncio.sleep(0.05)
+        try:
+            user_id = await identity.resolve(data.user_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        return StreamingResponse(stream_response(ai_response), media_type="text/plain")
+        # The batch is one request for the user's rate limit; each item still takes a provider slot
+        provider = providers.registry.get(model)
+        metric_model = model if provider is not None else "unknown"
+        try:
+            await admission.check_rate(user_id, client_address(request))
+        except AdmissionRejected as e:
+            logger.warning(f"Rejected batch from user {user_id} for model {model}: {str(e)}")
+            metrics.REJECTED_REQUESTS.labels(metric_model).inc()
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": e.retry_after_header})
+        
+        logger.info(f"Running batch of {len(prompts)} prompts for user {user_id} with model {model} ({concurrency} at a time)")
+        
+        async def stream_results():
+            pending = iter(enumerate(prompts))
+            results: asyncio.Queue = asyncio.Queue()
+        
+            async def worker():
+                # Workers pull the next index until the batch is exhausted
+                for index, content in pending:
+                    try:
+                        result = await run_batch_item(index, content, model, user_id, provider, is_enhanced, selected_category)
+                    except Exception as e:
+                        logger.error(f"Batch item {index} failed for user {user_id}: {str(e)}")
+                        result = {"index": index, "ok": False, "outcome": "error", "error": "Internal server error"}
+                    await results.put(result)
+        
+            workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+            failed = 0
+            try:
+                for _ in range(len(prompts)):
+                    result = await results.get()
+                    failed += not result["ok"]
+                    yield to_json(result) + b"\n"
+                yield to_json({"done": True, "userId": user_id, "total": len(prompts), "failed": failed}) + b"\n"
+            finally:
+                # Stop outstanding items if the client goes away
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        
+        return DisconnectAwareStreamingResponse(stream_results(), media_type="application/x-ndjson")
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Unexpected error in send_message: {str(e)}")
+        logger.error(f"Unexpected error in send_message_batch: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
-@app.post("/api/upload-document")
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket, user_id: Optional[str] = None):
+    """Persistent chat connection; several requests are multiplexed over it by ID
+
+    Client frames: `message` (the `/api/message` fields plus an `id`) and
+    `cancel`. Server frames: `hello`, then per request `ack`, `token`...,
+    `done`, or `error` / `cancelled`. A new message for a conversation that
+    already has a request in flight cancels the older one.
+    """
+    await websocket.accept()
+    try:
+        user_id = await identity.resolve(user_id)
+    except ValueError as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+    
+    send_lock = asyncio.Lock()
+    requests: Dict[str, asyncio.Task] = {}
+    # conversation_id -> request ID streaming into it
+    conversation_requests: Dict[str, str] = {}
+    connections = metrics.WS_CONNECTIONS.labels()
+    connections.inc()
+    
+    async def send(frame: dict) -> int:
+        text = to_json(frame).decode("utf-8")
+        try:
+            async with send_lock:
+                await websocket.send_text(text)
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            # Connection already gone; the receive loop cancels what is left
+            return 0
+        return len(text.encode("utf-8"))
+    
+    async def run(request_id: str, data: dict, conversation_id: Optional[str]):
+        turn = None
+        try:
+            try:
+                request = MessageRequest.model_validate(data)
+            except ValidationError as e:
+                raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False, include_input=False))
+            turn = await prepare_turn(request, user_id, client_address(websocket))
+            turn.bytes_sent += await send({"type": "ack", "id": request_id})
+            async with aclosing(turn.stream()) as tokens:
+                async for token in tokens:
+                    turn.bytes_sent += await send({"type": "token", "id": request_id, "text": token})
+            await send({"type": "done", "id": request_id, "outcome": turn.outcome["outcome"]})
+        except HTTPException as e:
+            frame = {"type": "error", "id": request_id, "status": e.status_code, "detail": e.detail}
+            if e.headers and "Retry-After" in e.headers:
+                frame["retryAfter"] = int(e.headers["Retry-After"])
+            await send(frame)
+        except Exception as e:
+            logger.error(f"Unexpected error in chat socket request {request_id}: {str(e)}")
+            await send({"type": "error", "id": request_id, "status": 500, "detail": "Internal server error"})
+        finally:
+            if turn is not None:
+                turn.release()
+            requests.pop(request_id, None)
+            if conversation_id and conversation_requests.get(conversation_id) == request_id:
+                del conversation_requests[conversation_id]
+    
+    async def cancel(request_id: str, reason: str) -> bool:
+        task = requests.get(request_id)
+        if task is None or not task.cancel():
+            return False
+        # Wait for the request to stop so no token frame follows the cancellation
+        await asyncio.gather(task, return_exceptions=True)
+        await send({"type": "cancelled", "id": request_id, "reason": reason})
+        return True
+    
+    try:
+        await send({"type": "hello", "user_id": user_id})
+        while True:
+            try:
+                frame = from_json(await websocket.receive_text())
+            except ValueError:
+                await send({"type": "error", "id": None, "status": 400, "detail": "Frames must be JSON objects"})
+                continue
+            request_id = frame.get("id") if isinstance(frame, dict) else None
+            if not isinstance(request_id, str) or not request_id:
+                await send({"type": "error", "id": None, "status": 400, "detail": "Frame id is required"})
+                continue
+            
+            if frame.get("type") == "message":
+                if request_id in requests:
+                    await send({"type": "error", "id": request_id, "status": 409, "detail": "Request ID already in flight"})
+                    continue
+                conversation_id = frame.get("conversation_id")
+                conversation_id = conversation_id if isinstance(conversation_id, str) else None
+                if conversation_id and conversation_id in conversation_requests:
+                    await cancel(conversation_requests[conversation_id], "superseded")
+                if len(requests) >= WS_MAX_IN_FLIGHT:
+                    await send({"type": "error", "id": request_id, "status": 429,
+                                "detail": f"Too many requests in flight (max {WS_MAX_IN_FLIGHT})"})
+                    continue
+                if conversation_id:
+                    conversation_requests[conversation_id] = request_id
+                requests[request_id] = asyncio.create_task(run(request_id, frame, conversation_id))
+            elif frame.get("type") == "cancel":
+                if not await cancel(request_id, "client"):
+                    await send({"type": "error", "id": request_id, "status": 404, "detail": "No such request in flight"})
+            else:
+                await send({"type": "error", "id": request_id, "status": 400, "detail": "Unknown frame type"})
+    
+    except WebSocketDisconnect:
+        logger.info(f"Chat socket closed for user {user_id}")
+    finally:
+        connections.dec()
+        # In-flight requests stop with the connection, cancelling their upstream calls
+        pending = list(requests.values())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+@app.post("/api/upload-document", response_model=UploadResponse)
 async def upload_document(
     file: UploadFile = File(...),
     user_id: Optional[str] = Body(None, embed=True)
 ):
     """Upload and process document endpoint"""
     try:
-        # If no user_id provided, generate a new one
-        if not user_id:
-            user_id = "backend-user-" + str(int(time.time() * 1000))[-8:]
+        # If no user_id provided, issue a new one; known users refresh their session
+        try:
+            user_id = await identity.resolve(user_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         if not file:
             raise HTTPException(status_code=400, detail="File is required")
@@ -291,151 +454,98 @@ async def upload_document(
         logger.error(f"Unexpected error in upload_document: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
-# Prompt templates data - centralized in backend
-PROMPT_TEMPLATES = [
-    {
-        "id": "custom-1",
-        "category": "Productivity",
-        "title": "Summarize this text",
-        "template": "Please summarize the following text in a concise way:",
-        "icon": "fas fa-align-left"
-    },
-    {
-        "id": "custom-2",
-        "category": "Learning",
-        "title": "Explain this concept simply",
-        "template": "Explain the following concept in simple terms for a beginner:",
-        "icon": "fas fa-graduation-cap"
-    },
-    {
-        "id": "default-1",
-        "category": "Code Analysis",
-        "title": "Analyze this code for optimization opportunities",
-        "template": "Please analyze the following code for optimization opportunities, focusing on performance, memory usage, and algorithmic efficiency. Provide specific suggestions with examples:",
-        "icon": "fas fa-code"
-    },
-    {
-        "id": "default-2",
-        "category": "Code Analysis",
-        "title": "Explain the security implications of this function",
-        "template": "Review the following code for security vulnerabilities and explain potential risks. Include recommendations for secure coding practices:",
-        "icon": "fas fa-shield-alt"
-    },
-    {
-        "id": "default-3",
-        "category": "Code Analysis",
-        "title": "Review code for best practices and conventions",
-        "template": "Please review this code for adherence to best practices, coding conventions, and maintainability. Suggest improvements for readability and structure:",
-        "icon": "fas fa-check-circle"
-    },
-    {
-        "id": "default-4",
-        "category": "Problem Solving",
-        "title": "Break down this complex problem step by step",
-        "template": "Help me break down this complex problem into smaller, manageable steps. Provide a systematic approach to solving:",
-        "icon": "fas fa-puzzle-piece"
-    },
-    {
-        "id": "default-5",
-        "category": "Problem Solving",
-        "title": "What are alternative solutions to this issue?",
-        "template": "Analyze this problem and suggest multiple alternative solutions. Compare the pros and cons of each approach:",
-        "icon": "fas fa-lightbulb"
-    },
-    {
-        "id": "default-6",
-        "category": "Documentation",
-        "title": "Generate comprehensive documentation for this code",
-        "template": "Create comprehensive documentation for the following code, including function descriptions, parameter explanations, return values, and usage examples:",
-        "icon": "fas fa-file-alt"
-    },
-    {
-        "id": "default-7",
-        "category": "Documentation",
-        "title": "Create API documentation with examples",
-        "template": "Generate API documentation for this code including endpoint descriptions, request/response formats, authentication requirements, and practical examples:",
-        "icon": "fas fa-book"
-    },
-    {
-        "id": "default-8",
-        "category": "Research",
-        "title": "Research this topic thoroughly",
-        "template": "Conduct comprehensive research on the following topic, including current trends, best practices, and recent developments:",
-        "icon": "fas fa-search"
-    },
-    {
-        "id": "default-9",
-        "category": "Creative Writing",
-        "title": "Write creatively about this topic",
-        "template": "Write a creative piece about the following topic, using engaging storytelling techniques:",
-        "icon": "fas fa-pen-fancy"
-    }
-]
-
-# Helper function to get category icon
-def get_category_icon(category: str) -> str:
-    """Get icon class for a given category"""
-    category_icons = {
-        "Code Analysis": "fas fa-code",
-        "Problem Solving": "fas fa-puzzle-piece",
-        "Documentation": "fas fa-file-alt",
-        "Productivity": "fas fa-align-left",
-        "Learning": "fas fa-graduation-cap",
-        "Research": "fas fa-search",
-        "Creative Writing": "fas fa-pen-fancy"
-    }
-    return category_icons.get(category, "fas fa-lightbulb")
-
-@app.get("/api/categories")
-def get_categories():
+@app.get("/api/documents/{document_id}", response_model=DocumentStatus)
+async def get_document_status(document_id: str, user_id: str):
+    """Get processing status and metadata for one of the user's uploaded documents"""
+    try:
+        document = await ingestion.pipeline.index.get_document(document_id)
+        if document is None or document["user_id"] != user_id:
+            raise HTTPException(status_code=404, detail="Document not found")
+        return document
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error retrieving document {document_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error retrieving document")
+
+@app.delete("/api/documents/{document_id}", response_model=DocumentDeleted)
+async def delete_document(document_id: str, user_id: str):
+    """Delete an uploaded document and remove it from the user's retrieval index"""
+    try:
+        document = await ingestion.pipeline.index.get_document(document_id)
+        if document is None or document["user_id"] != user_id:
+            raise HTTPException(status_code=404, detail="Document not found")
+        
+        await ingestion.pipeline.index.delete_document(document_id)
+        try:
+            removed = await retriever.remove_document(user_id, document_id)
+        except RuntimeError:
+            # Retrieval not available, so nothing was ever indexed
+            removed = 0
+        logger.info(f"Deleted document {document_id} ({removed} vectors)")
+        return {"message": "Document deleted successfully", "document_id": document_id}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error deleting document {document_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error deleting document")
+
+# Prompt templates are loaded from an external store that reloads when it changes
+PROMPT_TEMPLATES, CATEGORY_ICONS = load_templates(TEMPLATE_STORE_PATH)
+
+# Indexes and pre-serialized responses for the template endpoints
+template_catalog = TemplateCatalog(PROMPT_TEMPLATES, CATEGORY_ICONS)
+template_watcher = TemplateWatcher(TEMPLATE_STORE_PATH, template_catalog.reload)
+
+@app.get("/api/categories", response_model=List[Category])
+def get_categories(if_none_match: Optional[str] = Header(None)):
     """Get all available categories"""
     try:
-        # Extract unique categories from templates
-        categories = list(set(template["category"] for template in PROMPT_TEMPLATES))
-        
-        # Return categories with their icons
-        category_list = [
-            {
-                "name": category,
-                "icon": get_category_icon(category),
-                "count": len([t for t in PROMPT_TEMPLATES if t["category"] == category])
-            }
-            for category in sorted(categories)
-        ]
-        
-        logger.info(f"Retrieved {len(category_list)} categories")
-        return category_list
+        logger.info(f"Retrieved {len(template_catalog.categories)} categories")
+        return conditional_response(template_catalog.categories_body(), if_none_match)
         
     except Exception as e:
         logger.error(f"Error retrieving categories: {str(e)}")
         raise HTTPException(status_code=500, detail="Error retrieving categories")
 
-@app.get("/api/prompt-templates")
-def get_prompt_templates():
+@app.get("/api/prompt-templates", response_model=List[PromptTemplate])
+def get_prompt_templates(if_none_match: Optional[str] = Header(None)):
     """Get all prompt templates"""
     try:
-        logger.info(f"Retrieved {len(PROMPT_TEMPLATES)} prompt templates")
-        return PROMPT_TEMPLATES
+        logger.info(f"Retrieved {len(template_catalog.templates)} prompt templates")
+        return conditional_response(template_catalog.templates_body(), if_none_match)
         
     except Exception as e:
         logger.error(f"Error retrieving prompt templates: {str(e)}")
         raise HTTPException(status_code=500, detail="Error retrieving prompt templates")
 
-@app.get("/api/prompt-templates/{category}")
-def get_prompt_templates_by_category(category: str):
+@app.get("/api/prompt-templates/search", response_model=List[TemplateSearchResult])
+def search_prompt_templates(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    category: Optional[str] = None,
+):
+    """Full-text search over template titles, categories and bodies with prefix matching"""
+    try:
+        results = template_catalog.search(q, limit, category)
+        logger.info(f"Template search '{q}' returned {len(results)} results")
+        return results
+        
+    except Exception as e:
+        logger.error(f"Error searching templates for '{q}': {str(e)}")
+        raise HTTPException(status_code=500, detail="Error searching prompt templates")
+
+@app.get("/api/prompt-templates/{category}", response_model=List[PromptTemplate])
+def get_prompt_templates_by_category(category: str, if_none_match: Optional[str] = Header(None)):
     """Get prompt templates for a specific category"""
     try:
         if not category:
             raise HTTPException(status_code=400, detail="Category is required")
         
-        # Filter templates by category
-        category_templates = [
-            template for template in PROMPT_TEMPLATES 
-            if template["category"].lower() == category.lower()
-        ]
-        
-        logger.info(f"Retrieved {len(category_templates)} templates for category '{category}'")
-        return category_templates
+        logger.info(f"Retrieved {len(template_catalog.for_category(category))} templates for category '{category}'")
+        return conditional_response(template_catalog.category_body(category), if_none_match)
         
     except HTTPException:
         raise
@@ -443,81 +553,70 @@ def get_prompt_templates_by_category(category: str):
         logger.error(f"Error retrieving templates for category '{category}': {str(e)}")
         raise HTTPException(status_code=500, detail="Error retrieving category templates")
 
-@app.post("/api/enhance-prompt")
+@app.post("/api/enhance-prompt", response_model=EnhancePromptResponse)
 def enhance_prompt_endpoint(
-    data: dict = Body(...),
+    data: EnhancePromptRequest,
 ):
     """Enhance prompt endpoint"""
     try:
-        prompt = data.get("prompt")
-        selected_category = data.get("selected_category")
-        
-        if not prompt or not isinstance(prompt, str):
-            raise HTTPException(status_code=400, detail="Prompt is required")
-        
-        enhanced = enhance_prompt(prompt, selected_category)
-        return {"originalPrompt": prompt, "enhancedPrompt": enhanced}
+        enhanced = enhance_prompt(data.prompt, data.selected_category)
+        return {"originalPrompt": data.prompt, "enhancedPrompt": enhanced}
         
-    except HTTPException:
-        raise
     except Exception as e:
         logger.error(f"Unexpected error in enhance_prompt: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 # Conversation endpoints
-@app.get("/api/conversations")
-async def get_user_conversations():
-    """Get all conversations for the current user"""
+@app.post("/api/conversations", response_model=Conversation)
+async def create_conversation(
+    data: CreateConversationRequest,
+):
+    """Create a conversation for a user"""
     try:
-        # Generate a user ID for this request
-        user_id = "backend-user-" + str(int(time.time() * 1000))[-8:]
-        
-        # Mock data for now - in a real implementation, this would query a database
-        mock_conversations = [
-            {
-                "id": "conv_1",
-                "title": "Python Code Optimization",
-                "lastMessage": "How can I optimize this sorting algorithm?",
-                "messageCount": 8,
-                "createdAt": "2024-01-15T10:30:00Z",
-                "updatedAt": "2024-01-15T14:22:00Z",
-                "user_id": user_id
-            },
-            {
-                "id": "conv_2", 
-                "title": "React Component Design",
-                "lastMessage": "What's the best way to structure this component?",
-                "messageCount": 12,
-                "createdAt": "2024-01-14T09:15:00Z",
-                "updatedAt": "2024-01-14T16:45:00Z",
-                "user_id": user_id
-            },
-            {
-                "id": "conv_3",
-                "title": "Database Schema Question",
-                "lastMessage": "Should I use a foreign key here?",
-                "messageCount": 5,
-                "createdAt": "2024-01-13T13:20:00Z",
-                "updatedAt": "2024-01-13T15:10:00Z",
-                "user_id": user_id
-            }
-        ]
-        
-        logger.info(f"Retrieved {len(mock_conversations)} conversations for user {user_id}")
-        return mock_conversations
+        conversation = await conversations.store.create_conversation(data.user_id, data.title)
+        logger.info(f"Created conversation {conversation['id']} for user {data.user_id}")
+        return conversation
         
+    except Exception as e:
+        logger.error(f"Error creating conversation: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error creating conversation")
+
+@app.get("/api/conversations", response_model=ConversationPage)
+async def get_user_conversations(
+    user_id: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+):
+    """Get a page of conversations for a user, most recently updated first"""
+    try:
+        if not user_id:
+            raise HTTPException(status_code=400, detail="User ID is required")
+        
+        items, next_cursor = await conversations.store.list_conversations(user_id, limit, cursor)
+        
+        logger.info(f"Retrieved {len(items)} conversations for user {user_id}")
+        return {"conversations": items, "nextCursor": next_cursor}
+        
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error retrieving conversations: {str(e)}")
         raise HTTPException(status_code=500, detail="Error retrieving conversations")
 
-@app.delete("/api/conversations/{conversation_id}")
-async def delete_conversation(conversation_id: str):
-    """Delete a conversation by ID"""
+@app.delete("/api/conversations/{conversation_id}", response_model=ConversationDeleted)
+async def delete_conversation(conversation_id: str, user_id: str):
+    """Delete one of the user's conversations by ID"""
     try:
         if not conversation_id:
             raise HTTPException(status_code=400, detail="Conversation ID is required")
         
-        # Mock deletion - in a real implementation, this would delete from database
+        conversation = await conversations.store.get_conversation(conversation_id)
+        if conversation is None or conversation["user_id"] != user_id:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        
+        await conversations.store.delete_conversation(conversation_id)
         logger.info(f"Deleted conversation {conversation_id}")
         return {"message": "Conversation deleted successfully", "conversation_id": conversation_id}
         
@@ -527,47 +626,46 @@ async def delete_conversation(conversation_id: str):
         logger.error(f"Error deleting conversation {conversation_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="Error deleting conversation")
 
-@app.get("/api/conversations/{conversation_id}/messages")
-async def get_conversation_messages(conversation_id: str):
-    """Get all messages for a specific conversation"""
+@app.get("/api/conversations/{conversation_id}/messages", response_model=MessagePage)
+async def get_conversation_messages(
+    conversation_id: str,
+    user_id: str,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+):
+    """Get a page of messages for one of the user's conversations, oldest first"""
     try:
         if not conversation_id:
             raise HTTPException(status_code=400, detail="Conversation ID is required")
         
-        # Mock messages - in a real implementation, this would query database
-        mock_messages = [
-            {
-                "id": "msg_1",
-                "content": "How can I optimize this sorting algorithm?",
-                "sender": "user",
-                "timestamp": "2024-01-15T10:30:00Z",
-                "conversation_id": conversation_id
-            },
-            {
-                "id": "msg_2",
-                "content": "Here are several ways to optimize your sorting algorithm...",
-                "sender": "assistant",
-                "timestamp": "2024-01-15T10:31:00Z",
-                "conversation_id": conversation_id
-            }
-        ]
-        
-        logger.info(f"Retrieved {len(mock_messages)} messages for conversation {conversation_id}")
-        return mock_messages
+        conversation = await conversations.store.get_conversation(conversation_id)
+        if conversation is None or conversation["user_id"] != user_id:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        
+        items, next_cursor = await conversations.store.list_messages(conversation_id, limit, cursor)
+        
+        logger.info(f"Retrieved {len(items)} messages for conversation {conversation_id}")
+        return {"messages": items, "nextCursor": next_cursor}
         
     except HTTPException:
         raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error retrieving messages for conversation {conversation_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="Error retrieving conversation messages")
 
 # User management endpoints
-@app.get("/api/user")
-def get_user():
-    """Get user information - always returns a new user"""
+@app.get("/api/user", response_model=User)
+async def get_user(user_id: Optional[str] = None):
+    """Get user information for an existing user ID, or register a new user"""
     try:
-        # Always generate a new user ID
-        user_id = "backend-user-" + str(int(time.time() * 1000))[-8:]
+        # Returning clients keep their identity; everyone else gets a new one
+        try:
+            user_id = await identity.resolve(user_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        created_at, last_seen = await identity.touch(user_id)
         
         # Mock user data - in a real implementation, this would query a database
         user_data = {
@@ -578,15 +676,98 @@ def get_user():
                 "modelPreference": "phi4"
             },
             "source": "backend",
-            "lastActive": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            "createdAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(created_at)),
+            "lastActive": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(last_seen))
         }
         
-        logger.info(f"Generated new user: {user_id}")
+        logger.info(f"Resolved user: {user_id}")
         return user_data
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error resolving user: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error resolving user")
+
+# Helper: Usage reports expose every user's activity, so only the operator may read them
+def require_usage_admin(authorization: Optional[str] = Header(None)):
+    if not USAGE_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Usage reports are disabled")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode("utf-8"), USAGE_ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid usage token", headers={"WWW-Authenticate": "Bearer"})
+
+# Usage accounting endpoints
+@app.get("/api/usage/users/{user_id}", response_model=UserUsageReport, dependencies=[Depends(require_usage_admin)])
+async def get_user_usage(user_id: str, days: int = Query(30, ge=1, le=366)):
+    """Get a user's token usage and estimated cost per model and per day"""
+    try:
+        report = await ledger.user_report(user_id, days)
+        logger.info(f"Retrieved {days}-day usage for user {user_id}")
+        return report
+        
     except Exception as e:
-        logger.error(f"Error generating user: {str(e)}")
-        raise HTTPException(status_code=500, detail="Error generating user")
+        logger.error(f"Error retrieving usage for user {user_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error retrieving usage")
+
+@app.get("/api/usage/models", response_model=ModelUsageReport, dependencies=[Depends(require_usage_admin)])
+async def get_model_usage(days: int = Query(30, ge=1, le=366)):
+    """Get token usage and estimated cost per model across all users"""
+    try:
+        report = await ledger.model_report(days)
+        logger.info(f"Retrieved {days}-day usage for {len(report['models'])} models")
+        return report
+        
+    except Exception as e:
+        logger.error(f"Error retrieving model usage: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error retrieving usage")
+
+# Helper: Name the worker whose in-process counters a stats response shows
+def worker_header(response: Response):
+    response.headers["X-Worker-Pid"] = str(os.getpid())
+
+# Connection pool statistics
+@app.get("/api/stats/pools", dependencies=[Depends(worker_header)])
+def get_pool_stats():
+    """Get upstream HTTP connection pool usage per provider"""
+    return http_clients.registry.stats()
+
+# Completion cache statistics
+@app.get("/api/stats/cache", dependencies=[Depends(worker_header)])
+def get_cache_stats():
+    """Get completion cache hit/miss counters and size"""
+    return completion_cache.snapshot()
+
+# Request coalescing statistics
+@app.get("/api/stats/coalescing", dependencies=[Depends(worker_header)])
+def get_coalescing_stats():
+    """Get single-flight leader/coalesced/cancelled counters"""
+    return coalescer.snapshot()
+
+@app.get("/api/stats/upstream", dependencies=[Depends(worker_header)])
+def get_upstream_stats():
+    """Get circuit-breaker state, retry/hedge counters and first-token latency per provider"""
+    return upstream.snapshot()
+
+@app.get("/api/stats/limits", dependencies=[Depends(worker_header)])
+def get_limit_stats():
+    """Get rate-limit rejections and per-provider admission queue state"""
+    return admission.snapshot()
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text-format metrics for the chat path"""
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/api/stats/usage", dependencies=[Depends(worker_header)])
+def get_usage_stats():
+    """Get usage ledger buffer and flush counters"""
+    return ledger.snapshot()
+
+@app.get("/api/stats/sessions", dependencies=[Depends(worker_header)])
+async def get_session_stats():
+    """Get session registry size and issue/eviction counters"""
+    return await identity.snapshot()
 
 # Health check endpoint
 @app.get("/health")
@@ -595,6 +776,6 @@ def health_check():
     return {"status": "healthy", "message": "Backend is running"}
 
 if __name__ == "__main__":
-    import uvicorn
-
-    uvicorn.run(app, host="0.0.0.0", port=5000) 
+    # Production entry point; see server.py for workers and graceful shutdown
+    import server
+    server.main_cli()
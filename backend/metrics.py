@@ -0,0 +1,185 @@
+"""Minimal Prometheus-style metrics for the chat path.
+
+Counters, gauges and histograms are plain in-process objects: recording a
+sample is a dict lookup plus a bisect, so instrumentation stays negligible on
+the hot path. `render()` produces the Prometheus text exposition format served
+at `/metrics`.
+
+Metrics are per process. Every sample carries a `worker` label with the
+process ID, so a scrape through a multi-worker server can't mix up or
+overwrite one worker's series with another's; sum over `worker` for totals.
+"""
+import bisect
+import os
+from typing import Dict, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Latency buckets in seconds, from cache hits up to slow full completions
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], *extra: str) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self, worker: str) -> List[str]:
+        raise NotImplementedError
+
+    def render(self, worker: str) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples(worker))
+        return "\n".join(lines)
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def _samples(self, worker: str) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, values, worker)} {_format_value(child.value)}"
+            for values, child in self._children.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def _samples(self, worker: str) -> List[str]:
+        lines = []
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le, worker)} {cumulative}")
+            labels = _format_labels(self.labelnames, values, worker)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text format, labelled with this worker"""
+    worker = f'worker="{os.getpid()}"'
+    return "\n".join(metric.render(worker) for metric in REGISTRY) + "\n"
+
+
+# --- Chat path metrics ---
+
+PROMPT_BUILD_SECONDS = Histogram(
+    "chat_prompt_build_seconds", "Time spent loading history and building the upstream messages", ("model",)
+)
+UPSTREAM_TTFT_SECONDS = Histogram(
+    "chat_upstream_first_token_seconds", "Time from the upstream call to its first token", ("model", "outcome")
+)
+UPSTREAM_SECONDS = Histogram(
+    "chat_upstream_seconds", "Total time of the upstream call", ("model", "outcome")
+)
+STREAM_SECONDS = Histogram(
+    "chat_stream_seconds", "Time from the first response byte to the end of the stream", ("model", "outcome")
+)
+STREAM_BYTES = Histogram(
+    "chat_stream_bytes", "Bytes sent in a chat response", ("model", "outcome"), buckets=BYTES_BUCKETS
+)
+FALLBACK_RESPONSES = Counter(
+    "chat_fallback_responses_total", "Offline fallback replies served instead of an upstream answer", ("model", "reason")
+)
+REJECTED_REQUESTS = Counter(
+    "chat_rejected_requests_total", "Chat requests answered 429 by admission control", ("model",)
+)
+IN_FLIGHT = Gauge(
+    "chat_requests_in_flight", "Chat responses currently streaming", ("model",)
+)
+CANCELLED_GENERATIONS = Counter(
+    "chat_cancelled_generations_total", "Upstream generations stopped because the client disconnected", ("model",)
+)
+TOKENS_SAVED = Counter(
+    "chat_cancelled_tokens_saved_total",
+    "Estimated upstream tokens not generated thanks to cancellation (median complete reply minus tokens received)",
+    ("model",),
+)
+WS_CONNECTIONS = Gauge(
+    "chat_websocket_connections", "Open /ws/chat connections"
+)
@@ -0,0 +1,397 @@
+"""Upstream AI provider abstraction and the model registry.
+
+Each provider declares its endpoint, auth, payload shape, streaming parser and
+concurrency limit; the limit is enforced by admission control (`limits.py`)
+before a request reaches the provider. The registry maps the `model` field of a chat request to a
+provider instance. Built-in models are registered below; extra models can be
+added without code changes through a JSON file named by `PROVIDERS_CONFIG`:
+
+    [
+        {"model": "llama3", "type": "openai", "name": "Groq",
+         "base_url": "https://api.groq.com/openai/v1", "api_key_env": "GROQ_API_KEY",
+         "upstream_model": "llama3-70b-8192", "max_concurrency": 8,
+         "prompt_price": 0.59, "completion_price": 0.79,
+         "pool_config": {"max_connections": 50, "read_timeout": 45},
+         "resilience": {"max_retries": 1, "hedge_model": "deepseek"}},
+        {"model": "fake", "type": "fake", "tokens_per_second": 200}
+    ]
+
+Prices are USD per million tokens and only feed the usage ledger's cost
+estimates. Calls report the upstream's token counts into an optional `usage`
+dict (`prompt_tokens`, `completion_tokens` and the serving `model`).
+"""
+import os
+import json
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional
+
+import httpx
+
+import http_clients
+from http_clients import PoolConfig
+
+logger = logging.getLogger(__name__)
+
+# Exact token counts need the optional `tiktoken` package; otherwise estimate from characters
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+DEFAULT_MAX_TOKENS = 1000
+DEFAULT_TEMPERATURE = 0.7
+
+
+class ProviderError(Exception):
+    """Upstream call failed; callers fall back to an offline response"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        # Seconds the upstream asked us to wait (429/503 Retry-After), if given
+        self.retry_after = retry_after
+
+
+class ProviderNotConfigured(ProviderError):
+    """Provider is missing its API key or other required settings"""
+
+
+# Helper: Copy an OpenAI-style `usage` object into a caller's usage dict
+def read_usage(body: dict, usage: Optional[dict]) -> None:
+    counts = body.get("usage")
+    if usage is None or not isinstance(counts, dict):
+        return
+    usage["prompt_tokens"] = int(counts.get("prompt_tokens") or 0)
+    usage["completion_tokens"] = int(counts.get("completion_tokens") or 0)
+
+
+# Helper: Parse an OpenAI-compatible SSE stream into content deltas
+async def iter_sse_deltas(response: httpx.Response, usage: Optional[dict] = None) -> AsyncIterator[str]:
+    """Yield the content of each `data:` event until the `[DONE]` sentinel; token counts go to `usage`"""
+    async for line in response.aiter_lines():
+        line = line.strip()
+        # Skip keep-alive comments and non-data fields
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            logger.warning(f"Skipping malformed SSE event: {data[:100]}")
+            continue
+        # With include_usage the counts arrive in a final event without choices
+        read_usage(event, usage)
+        choices = event.get("choices") or []
+        if not choices:
+            continue
+        content = (choices[0].get("delta") or {}).get("content")
+        if content:
+            yield content
+
+
+class Provider:
+    """Base class for an upstream model endpoint"""
+
+    supports_streaming = False
+
+    def __init__(
+        self,
+        model: str,
+        name: Optional[str] = None,
+        max_concurrency: int = 16,
+        max_queue: Optional[int] = None,
+        max_tokens: int = DEFAULT_MAX_TOKENS,
+        temperature: float = DEFAULT_TEMPERATURE,
+        history_token_budget: Optional[int] = None,
+        tokenizer: Optional[str] = None,
+        chars_per_token: float = 4.0,
+        resilience: Optional[dict] = None,
+        prompt_price: float = 0.0,
+        completion_price: float = 0.0,
+    ):
+        self.model = model
+        self.name = name or model
+        # Concurrent upstream requests, enforced by the admission gate
+        self.max_concurrency = max_concurrency
+        # Requests allowed to wait for a slot before admission answers 429
+        self.max_queue = max_queue
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.history_token_budget = history_token_budget
+        self.chars_per_token = chars_per_token
+        # Overrides for the retry/timeout/circuit/hedging policy (see resilience.py)
+        self.resilience = resilience or {}
+        # USD per million tokens, for usage cost estimates
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self._encoding = None
+        if tokenizer and tiktoken is not None:
+            try:
+                self._encoding = tiktoken.get_encoding(tokenizer)
+            except Exception as e:
+                logger.warning(f"Tokenizer '{tokenizer}' unavailable for {self.name}, estimating tokens: {str(e)}")
+
+    def count_tokens(self, text: str) -> int:
+        """Token count for this provider's tokenizer (estimated when unavailable)"""
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        return int(len(text) / self.chars_per_token) + 1
+
+    def estimate_cost(self, prompt_tokens: int, completion_tokens: int) -> float:
+        """Estimated USD cost of a call from its token counts"""
+        return (prompt_tokens * self.prompt_price + completion_tokens * self.completion_price) / 1_000_000
+
+    async def complete(self, messages: List[dict], user_id: str, usage: Optional[dict] = None) -> str:
+        """Return the full completion for a messages array"""
+        raise NotImplementedError
+
+    async def stream(self, messages: List[dict], user_id: str, usage: Optional[dict] = None) -> AsyncIterator[str]:
+        """Yield completion tokens; non-streaming providers send one chunk"""
+        yield await self.complete(messages, user_id, usage)
+
+
+class OpenAICompatibleProvider(Provider):
+    """Provider speaking the OpenAI chat completions protocol over a pooled client"""
+
+    supports_streaming = True
+
+    def __init__(
+        self,
+        model: str,
+        base_url: str,
+        api_key_env: str,
+        upstream_model: str,
+        pool: Optional[str] = None,
+        extra_headers: Optional[Dict[str, str]] = None,
+        stream: bool = True,
+        stream_usage: bool = True,
+        **kwargs,
+    ):
+        super().__init__(model, **kwargs)
+        self.base_url = base_url.rstrip("/")
+        self.api_key_env = api_key_env
+        self.upstream_model = upstream_model
+        self.pool = pool or model
+        self.extra_headers = extra_headers or {}
+        self.supports_streaming = stream
+        # Ask for token counts at the end of a stream (`stream_options.include_usage`)
+        self.stream_usage = stream_usage
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/chat/completions"
+
+    def build_headers(self) -> Dict[str, str]:
+        api_key = os.getenv(self.api_key_env)
+        if not api_key:
+            raise ProviderNotConfigured(f"{self.name} API key not configured")
+        return {
+            'Content-Type': 'application/json',
+            'Authorization': f"Bearer {api_key}",
+            **self.extra_headers,
+        }
+
+    def build_payload(self, messages: List[dict], stream: bool) -> dict:
+        payload = {
+            "model": self.upstream_model,
+            "messages": messages,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+        }
+        if stream:
+            payload["stream"] = True
+            if self.stream_usage:
+                payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def parse_completion(self, data: dict) -> str:
+        choices = data.get("choices") or []
+        if not choices:
+            raise ProviderError(f"Invalid response format from {self.name}")
+        return choices[0]["message"]["content"]
+
+    def parse_stream(self, response: httpx.Response, usage: Optional[dict] = None) -> AsyncIterator[str]:
+        return iter_sse_deltas(response, usage)
+
+    def _check_status(self, response: httpx.Response, body: bytes) -> None:
+        if response.status_code == 402:
+            raise ProviderError(
+                f"{self.name} API: Payment required - insufficient credits or billing not set up",
+                status_code=402,
+            )
+        if response.status_code >= 400:
+            retry_after = response.headers.get("retry-after", "")
+            raise ProviderError(
+                f"{self.name} API HTTP error: {response.status_code} - {body[:500]!r}",
+                status_code=response.status_code,
+                retry_after=float(retry_after) if retry_after.replace(".", "", 1).isdigit() else None,
+            )
+
+    async def complete(self, messages: List[dict], user_id: str, usage: Optional[dict] = None) -> str:
+        headers = self.build_headers()
+        client = http_clients.registry.get(self.pool)
+        response = await client.post(self.url, json=self.build_payload(messages, stream=False), headers=headers)
+        self._check_status(response, response.content)
+        data = response.json()
+        content = self.parse_completion(data)
+        read_usage(data, usage)
+        if usage is not None:
+            usage["model"] = self.model
+        return content
+
+    async def stream(self, messages: List[dict], user_id: str, usage: Optional[dict] = None) -> AsyncIterator[str]:
+        if not self.supports_streaming:
+            yield await self.complete(messages, user_id, usage)
+            return
+
+        headers = self.build_headers()
+        client = http_clients.registry.get(self.pool)
+        async with client.stream("POST", self.url, json=self.build_payload(messages, stream=True), headers=headers) as response:
+            if response.status_code >= 400:
+                self._check_status(response, await response.aread())
+            async for token in self.parse_stream(response, usage):
+                yield token
+        if usage is not None:
+            usage["model"] = self.model
+
+
+class FakeProvider(Provider):
+    """Offline provider that emits deterministic tokens at a configurable rate"""
+
+    supports_streaming = True
+
+    def __init__(
+        self,
+        model: str = "fake",
+        first_token_latency: float = 0.05,
+        tokens_per_second: float = 100.0,
+        response_tokens: int = 50,
+        error_rate: float = 0.0,
+        **kwargs,
+    ):
+        kwargs.setdefault("name", "Fake")
+        super().__init__(model, **kwargs)
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.error_rate = error_rate
+        self._calls = 0
+
+    def _tokens(self, messages: List[dict]) -> List[str]:
+        words = (messages[-1]["content"] if messages else "").split() or ["ok"]
+        return [f"{words[i % len(words)]} " for i in range(self.response_tokens)]
+
+    def _maybe_fail(self) -> None:
+        # Deterministic error injection: every Nth call fails
+        self._calls += 1
+        if self.error_rate > 0 and self._calls % max(1, round(1 / self.error_rate)) == 0:
+            raise ProviderError(f"{self.name} injected failure", status_code=500)
+
+    async def complete(self, messages: List[dict], user_id: str, usage: Optional[dict] = None) -> str:
+        return "".join([token async for token in self.stream(messages, user_id, usage)])
+
+    async def stream(self, messages: List[dict], user_id: str, usage: Optional[dict] = None) -> AsyncIterator[str]:
+        self._maybe_fail()
+        await asyncio.sleep(self.first_token_latency)
+        delay = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        for token in self._tokens(messages):
+            yield token
+            if delay:
+                await asyncio.sleep(delay)
+        if usage is not None:
+            usage["prompt_tokens"] = sum(self.count_tokens(m["content"]) for m in messages)
+            usage["completion_tokens"] = self.response_tokens
+            usage["model"] = self.model
+
+
+PROVIDER_TYPES = {
+    "openai": OpenAICompatibleProvider,
+    "fake": FakeProvider,
+}
+
+
+class ProviderRegistry:
+    """Maps request model names to provider instances"""
+
+    def __init__(self):
+        self._providers: Dict[str, Provider] = {}
+
+    def register(self, provider: Provider, pool_config: Optional[PoolConfig] = None) -> None:
+        if isinstance(provider, OpenAICompatibleProvider):
+            http_clients.registry.configure(provider.pool, pool_config or PoolConfig.from_env(provider.pool))
+        self._providers[provider.model] = provider
+        logger.info(f"Registered provider '{provider.name}' for model '{provider.model}'")
+
+    def get(self, model: str) -> Optional[Provider]:
+        return self._providers.get(model)
+
+    def models(self) -> List[str]:
+        return sorted(self._providers)
+
+    def load_config(self, path: str) -> None:
+        """Register (or override) providers from a JSON config file"""
+        with open(path) as f:
+            entries = json.load(f)
+        for entry in entries:
+            entry = dict(entry)
+            provider_type = entry.pop("type", "openai")
+            pool_overrides = entry.pop("pool_config", None)
+            provider_cls = PROVIDER_TYPES.get(provider_type)
+            if provider_cls is None:
+                raise ValueError(f"Unknown provider type '{provider_type}' for model '{entry.get('model')}'")
+            pool_config = None
+            if pool_overrides is not None:
+                pool_config = PoolConfig.from_env(entry.get("pool") or entry["model"], **pool_overrides)
+            self.register(provider_cls(**entry), pool_config)
+
+
+def build_default_registry() -> ProviderRegistry:
+    """Registry with the built-in models plus any configured extras"""
+    providers = ProviderRegistry()
+    providers.register(
+        OpenAICompatibleProvider(
+            model="phi4",
+            name="OpenRouter",
+            base_url=os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1"),
+            api_key_env="OPENROUTER_API_KEY",
+            upstream_model="microsoft/phi-4",
+            pool="openrouter",
+            extra_headers={
+                "HTTP-Referer": "http://localhost:3000",  # Your frontend URL
+                "X-Title": "ZorifBot",  # Your app name
+            },
+            max_concurrency=int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "32")),
+            tokenizer="cl100k_base",
+            prompt_price=float(os.getenv("OPENROUTER_PROMPT_PRICE", "0.07")),
+            completion_price=float(os.getenv("OPENROUTER_COMPLETION_PRICE", "0.14")),
+        )
+    )
+    providers.register(
+        OpenAICompatibleProvider(
+            model="deepseek",
+            name="DeepSeek",
+            base_url=os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1"),
+            api_key_env="DEEPSEEK_API_KEY",
+            upstream_model="deepseek-chat",
+            pool="deepseek",
+            max_concurrency=int(os.getenv("DEEPSEEK_MAX_CONCURRENCY", "32")),
+            chars_per_token=3.5,
+            prompt_price=float(os.getenv("DEEPSEEK_PROMPT_PRICE", "0.27")),
+            completion_price=float(os.getenv("DEEPSEEK_COMPLETION_PRICE", "1.10")),
+        ),
+        PoolConfig.from_env("deepseek", read_timeout=30.0),
+    )
+    if os.getenv("FAKE_PROVIDER_ENABLED", "").lower() in ("1", "true", "yes"):
+        providers.register(FakeProvider())
+
+    config_path = os.getenv("PROVIDERS_CONFIG")
+    if config_path:
+        providers.load_config(config_path)
+    return providers
+
+
+# Process-wide provider registry used by the API handlers
+registry = build_default_registry()
@@ -0,0 +1,434 @@
+"""Resilient upstream calls: timeouts, retries, circuit breakers and hedging.
+
+Every provider call made by the chat path goes through `upstream`, which
+applies a per-provider `ResiliencePolicy`:
+
+- Timeouts: connecting is bounded by the pool's `<PROVIDER>_CONNECT_TIMEOUT`;
+  the first token must arrive within `first_token_timeout`, gaps between
+  chunks are bounded by the pool's read timeout and the whole call must
+  finish within `total_timeout`.
+- Retries: 429, 5xx, transport errors and first-token timeouts are retried up
+  to `max_retries` times with full-jitter exponential backoff (honouring the
+  upstream's Retry-After). A stream is never retried once tokens were relayed.
+- Circuit breaker: after `circuit_threshold` consecutive failures the provider
+  is skipped for `circuit_reset` seconds, then a single probe call decides
+  whether it is healthy again. Calls to an open circuit fail at once.
+- Hedging: when `hedge_model` is set, a stream that has not produced its first
+  token after `hedge_delay` seconds (default: the provider's observed p95
+  time-to-first-token) is raced against the hedge model; whichever answers
+  first is relayed and the other is cancelled. The hedge takes a free slot of
+  the hedge model's admission gate and is skipped when there is none, so
+  hedging never pushes a provider past its concurrency cap.
+
+Closing a stream (e.g. when the client disconnects) closes every layer below
+it right away, releasing the upstream connection.
+
+Policies come from `<POOL>_FIRST_TOKEN_TIMEOUT`, `<POOL>_TOTAL_TIMEOUT`,
+`<POOL>_MAX_RETRIES`, `<POOL>_CIRCUIT_THRESHOLD`, `<POOL>_CIRCUIT_RESET`,
+`<POOL>_HEDGE_MODEL` and `<POOL>_HEDGE_DELAY`, overridden by a provider's
+`resilience` settings in `PROVIDERS_CONFIG`.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from contextlib import aclosing
+from dataclasses import dataclass, asdict
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+import httpx
+
+import providers
+from limits import Ticket, admission
+from providers import Provider, ProviderError, ProviderNotConfigured
+
+logger = logging.getLogger(__name__)
+
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+LATENCY_WINDOW = 200
+
+
+class UpstreamTimeout(ProviderError):
+    """Provider missed its first-token or total deadline"""
+
+
+class CircuitOpen(ProviderError):
+    """Provider is failing and calls are short-circuited"""
+
+
+# Policy fields settable per provider from the environment
+POLICY_ENV = {
+    "first_token_timeout": ("FIRST_TOKEN_TIMEOUT", float),
+    "total_timeout": ("TOTAL_TIMEOUT", float),
+    "max_retries": ("MAX_RETRIES", int),
+    "circuit_threshold": ("CIRCUIT_THRESHOLD", int),
+    "circuit_reset": ("CIRCUIT_RESET", float),
+    "hedge_model": ("HEDGE_MODEL", str),
+    "hedge_delay": ("HEDGE_DELAY", float),
+}
+
+
+@dataclass
+class ResiliencePolicy:
+    """Timeouts, retry, circuit-breaker and hedging settings for one provider"""
+    first_token_timeout: float = 20.0
+    total_timeout: float = 120.0
+    max_retries: int = 2
+    backoff_base: float = 0.25
+    backoff_max: float = 4.0
+    circuit_threshold: int = 5
+    circuit_reset: float = 30.0
+    hedge_model: Optional[str] = None
+    hedge_delay: Optional[float] = None
+
+    @classmethod
+    def from_env(cls, name: str, **overrides) -> "ResiliencePolicy":
+        """Defaults, then `<NAME>_*` variables, then explicit overrides"""
+        prefix = name.upper()
+        values = {}
+        for field, (suffix, parse) in POLICY_ENV.items():
+            raw = os.getenv(f"{prefix}_{suffix}")
+            if raw:
+                values[field] = parse(raw)
+        values.update(overrides)
+        return cls(**values)
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (ProviderNotConfigured, CircuitOpen)):
+        return False
+    if isinstance(error, UpstreamTimeout) or isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, ProviderError):
+        return error.status_code == 429 or (error.status_code or 0) >= 500
+    return False
+
+
+def counts_against_circuit(error: BaseException) -> bool:
+    # Payment failures won't clear up on their own either, so they trip the breaker
+    return is_retryable(error) or (isinstance(error, ProviderError) and error.status_code == 402)
+
+
+class CircuitBreaker:
+    """Closed → open after N consecutive failures → half-open single probe"""
+
+    def __init__(self, name: str, threshold: int, reset_timeout: float):
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self.short_circuited = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def before_call(self) -> None:
+        if self.state == "closed":
+            return
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return
+        self.short_circuited += 1
+        raise CircuitOpen(f"{self.name} circuit is open", status_code=503)
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.opened += 1
+                logger.warning(f"Opening circuit for {self.name} after {self.failures} failures")
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        # A probe that ended without a verdict (e.g. client went away) frees the slot
+        self._probing = False
+
+
+class LatencyTracker:
+    """Sliding window of time-to-first-token samples"""
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+@dataclass
+class UpstreamStats:
+    calls: int = 0
+    retries: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    hedges_skipped: int = 0
+
+
+class _ProviderState:
+    def __init__(self, provider: Provider):
+        self.policy = ResiliencePolicy.from_env(getattr(provider, "pool", provider.model), **provider.resilience)
+        self.breaker = CircuitBreaker(provider.name, self.policy.circuit_threshold, self.policy.circuit_reset)
+        self.ttft = LatencyTracker()
+        # Tokens in recently completed streams, to estimate what a cancelled stream would have cost
+        self.reply_tokens = LatencyTracker()
+        self.stats = UpstreamStats()
+
+
+async def _cancel(task: Optional[asyncio.Task]) -> None:
+    if task is not None and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+class UpstreamGuard:
+    """Applies each provider's resilience policy to its calls"""
+
+    def __init__(self, resolve: Callable[[str], Optional[Provider]],
+                 try_slot: Callable[[Provider], Optional[Ticket]] = lambda provider: Ticket(None)):
+        self._resolve = resolve
+        # Hedged requests only run in a free slot of the hedge provider
+        self._try_slot = try_slot
+        self._states: Dict[str, _ProviderState] = {}
+
+    def state_for(self, provider: Provider) -> _ProviderState:
+        state = self._states.get(provider.model)
+        if state is None:
+            state = self._states[provider.model] = _ProviderState(provider)
+        return state
+
+    def _backoff(self, policy: ResiliencePolicy, attempt: int, error: BaseException) -> float:
+        delay = random.uniform(0, min(policy.backoff_max, policy.backoff_base * (2 ** attempt)))
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after:
+            delay = max(delay, min(retry_after, policy.backoff_max))
+        return delay
+
+    def _on_failure(self, state: _ProviderState, error: BaseException) -> None:
+        if isinstance(error, CircuitOpen):
+            return
+        if counts_against_circuit(error):
+            state.stats.failures += 1
+            state.breaker.record_failure()
+        else:
+            state.breaker.release_probe()
+
+    async def complete(self, provider: Provider, messages: List[dict], user_id: str,
+                       usage: Optional[dict] = None) -> str:
+        """Non-streaming call with retries, a total timeout and the circuit breaker"""
+        state = self.state_for(provider)
+        policy = state.policy
+        deadline = time.monotonic() + policy.total_timeout
+        attempt = 0
+        while True:
+            state.breaker.before_call()
+            state.stats.calls += 1
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise UpstreamTimeout(f"{provider.name} exceeded its total timeout", status_code=504)
+                try:
+                    result = await asyncio.wait_for(provider.complete(messages, user_id, usage), remaining)
+                except asyncio.TimeoutError:
+                    state.stats.timeouts += 1
+                    raise UpstreamTimeout(f"{provider.name} exceeded its total timeout", status_code=504)
+                state.breaker.record_success()
+                return result
+            except asyncio.CancelledError:
+                state.breaker.release_probe()
+                raise
+            except Exception as e:
+                self._on_failure(state, e)
+                delay = self._backoff(policy, attempt, e)
+                if (not is_retryable(e) or attempt >= policy.max_retries or state.breaker.state == "open"
+                        or time.monotonic() + delay >= deadline):
+                    raise
+                attempt += 1
+                state.stats.retries += 1
+                logger.warning(f"Retrying {provider.name} in {delay:.2f}s (attempt {attempt}): {str(e)}")
+                await asyncio.sleep(delay)
+
+    async def _attempt(self, provider: Provider, state: _ProviderState, messages: List[dict], user_id: str,
+                       deadline: float, relayed: List[int], usage: Optional[dict]) -> AsyncIterator[str]:
+        """One upstream stream with first-token and total deadlines"""
+        policy = state.policy
+        started = time.monotonic()
+        tokens = provider.stream(messages, user_id, usage)
+        try:
+            # Only the first token is awaited under wait_for; later stalls are bounded by the
+            # pool's read timeout and the total deadline is checked as tokens arrive
+            timeout = min(policy.first_token_timeout, deadline - started)
+            try:
+                token = await asyncio.wait_for(tokens.__anext__(), max(0.0, timeout))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                state.stats.timeouts += 1
+                raise UpstreamTimeout(f"{provider.name} exceeded its first-token timeout", status_code=504)
+            state.ttft.add(time.monotonic() - started)
+            relayed[0] += 1
+            yield token
+            async for token in tokens:
+                if time.monotonic() > deadline:
+                    state.stats.timeouts += 1
+                    raise UpstreamTimeout(f"{provider.name} exceeded its total timeout", status_code=504)
+                relayed[0] += 1
+                yield token
+        finally:
+            await tokens.aclose()
+
+    async def _stream_with_retries(self, provider: Provider, messages: List[dict], user_id: str,
+                                   usage: Optional[dict] = None) -> AsyncIterator[str]:
+        state = self.state_for(provider)
+        policy = state.policy
+        deadline = time.monotonic() + policy.total_timeout
+        attempt = 0
+        while True:
+            state.breaker.before_call()
+            state.stats.calls += 1
+            relayed = [0]
+            try:
+                async with aclosing(self._attempt(provider, state, messages, user_id, deadline, relayed, usage)) as tokens:
+                    async for token in tokens:
+                        yield token
+                state.breaker.record_success()
+                state.reply_tokens.add(relayed[0])
+                return
+            except (asyncio.CancelledError, GeneratorExit):
+                state.breaker.release_probe()
+                raise
+            except Exception as e:
+                self._on_failure(state, e)
+                delay = self._backoff(policy, attempt, e)
+                # Tokens already sent can't be taken back, so only clean failures are retried
+                if (relayed[0] or not is_retryable(e) or attempt >= policy.max_retries
+                        or state.breaker.state == "open" or time.monotonic() + delay >= deadline):
+                    raise
+                attempt += 1
+                state.stats.retries += 1
+                logger.warning(f"Retrying {provider.name} stream in {delay:.2f}s (attempt {attempt}): {str(e)}")
+                await asyncio.sleep(delay)
+
+    def hedge_delay(self, provider: Provider) -> Optional[float]:
+        """Seconds to wait for a first token before hedging, or None to not hedge"""
+        state = self.state_for(provider)
+        if state.policy.hedge_delay is not None:
+            return state.policy.hedge_delay
+        if len(state.ttft) < HEDGE_MIN_SAMPLES:
+            return None
+        return state.ttft.percentile(0.95)
+
+    async def stream(self, provider: Provider, messages: List[dict], user_id: str,
+                     usage: Optional[dict] = None) -> AsyncIterator[str]:
+        """Relay a provider stream, hedging to a second provider when it is slow to start
+
+        Token counts reported by whichever provider finishes the stream go to `usage`.
+        """
+        state = self.state_for(provider)
+        hedge = self._resolve(state.policy.hedge_model) if state.policy.hedge_model else None
+        delay = self.hedge_delay(provider) if hedge is not None and hedge is not provider else None
+        if delay is None:
+            async with aclosing(self._stream_with_retries(provider, messages, user_id, usage)) as tokens:
+                async for token in tokens:
+                    yield token
+            return
+
+        primary = self._stream_with_retries(provider, messages, user_id, usage)
+        secondary = None
+        hedge_ticket = None
+        first_tasks = {asyncio.ensure_future(primary.__anext__()): primary}
+        winner = None
+        first_token = None
+        errors = []
+        try:
+            done, _ = await asyncio.wait(first_tasks, timeout=delay)
+            if not done or next(iter(done)).exception() is not None:
+                # Primary is slow (or already failed): race the hedge model for the first token
+                hedge_ticket = self._try_slot(hedge)
+                if hedge_ticket is None:
+                    state.stats.hedges_skipped += 1
+                    logger.info(f"Not hedging {provider.name} request: {hedge.name} has no free slot")
+                else:
+                    state.stats.hedges += 1
+                    logger.info(f"Hedging {provider.name} request to {hedge.name} after {delay:.2f}s")
+                    secondary = self._stream_with_retries(hedge, messages, user_id, usage)
+                    first_tasks[asyncio.ensure_future(secondary.__anext__())] = secondary
+
+            pending = set(first_tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    if error is None and winner is None:
+                        winner, first_token = first_tasks[task], task.result()
+                    elif error is not None and not isinstance(error, StopAsyncIteration):
+                        errors.append(error)
+            for task in pending:
+                await _cancel(task)
+            if secondary is not None and winner is not secondary:
+                # A losing hedge gives its slot back now rather than when the primary finishes
+                await secondary.aclose()
+                hedge_ticket.release()
+            if winner is None:
+                if errors:
+                    raise errors[0]
+                return
+            if winner is secondary:
+                state.stats.hedge_wins += 1
+
+            yield first_token
+            async for token in winner:
+                yield token
+        finally:
+            for task in first_tasks:
+                await _cancel(task)
+            for source in (primary, secondary):
+                if source is not None:
+                    await source.aclose()
+            if hedge_ticket is not None:
+                hedge_ticket.release()
+
+    def expected_reply_tokens(self, provider: Provider) -> Optional[float]:
+        """Median length of the provider's recent complete streams, if any were seen"""
+        return self.state_for(provider).reply_tokens.percentile(0.5)
+
+    def snapshot(self) -> dict:
+        return {
+            model: {
+                "circuit": state.breaker.state,
+                "consecutive_failures": state.breaker.failures,
+                "circuit_opened": state.breaker.opened,
+                "short_circuited": state.breaker.short_circuited,
+                "ttft_p50": state.ttft.percentile(0.5),
+                "ttft_p95": state.ttft.percentile(0.95),
+                **asdict(state.stats),
+                "policy": asdict(state.policy),
+            }
+            for model, state in self._states.items()
+        }
+
+
+# Process-wide guard used by the API handlers; hedge targets resolve through the provider registry
+# and take their slots from the admission gates
+upstream = UpstreamGuard(providers.registry.get, admission.try_slot)
@@ -0,0 +1,384 @@
+"""Per-user vector index over uploaded document chunks.
+
+Chunks are embedded by a local embedding function and stored as rows of a
+float32 matrix, one file per user, memory-mapped from `VECTOR_INDEX_DIR`
+(default `vectors`). Vectors are L2-normalised when stored, so cosine
+similarity is a matrix product: a query is scored against a user's rows in
+blocks of `RETRIEVAL_BLOCK_ROWS` and the best `RETRIEVAL_TOP_K` chunks are
+kept.
+
+Row ownership (which document and chunk each row holds) lives in SQLite next
+to the document records. Adding a document writes its rows into free slots
+or at the end of the file, growing it geometrically; deleting one just frees
+its rows for reuse, so the index is never rebuilt. Row allocation and file
+growth happen in one `BEGIN IMMEDIATE` transaction, so server workers can
+index documents for the same user concurrently.
+
+`EMBEDDING_BACKEND=hashing` (default) is a dependency-free feature-hashing
+embedder of `EMBEDDING_DIM` dimensions; `package.module:ClassName` loads any
+`Embedder`, e.g. a local sentence-transformer. Needs the `numpy` package.
+"""
+import os
+import re
+import math
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import importlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import ingestion
+
+logger = logging.getLogger(__name__)
+
+# Vector search needs the optional `numpy` package
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "vectors")
+VECTOR_DB_PATH = os.getenv("VECTOR_DB_PATH", ingestion.DOCUMENT_DB_PATH)
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "512"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+RETRIEVAL_BLOCK_ROWS = int(os.getenv("RETRIEVAL_BLOCK_ROWS", "8192"))
+
+# Smallest allocation for a user's matrix, in rows
+MIN_CAPACITY = 256
+# Most memory maps kept open at once
+OPEN_MATRICES = 64
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise RuntimeError("Document retrieval needs the `numpy` package (pip install numpy)")
+
+
+# --- Embedders ---
+
+class Embedder:
+    """Interface for local embedding functions; `name` identifies the vector space"""
+
+    name = "embedder"
+    dim = 0
+
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        """Return a float32 matrix with one row per text"""
+        raise NotImplementedError
+
+
+@lru_cache(maxsize=65536)
+def _hash_feature(token: str, dim: int) -> Tuple[int, float]:
+    digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+    value = int.from_bytes(digest, "little")
+    return value % dim, 1.0 if value >> 63 else -1.0
+
+
+class HashingEmbedder(Embedder):
+    """Signed feature hashing of words and word pairs with sublinear term weights"""
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        _require_numpy()
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = TOKEN_PATTERN.findall(text.lower())
+            counts: Dict[str, int] = {}
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                counts[feature] = counts.get(feature, 0) + 1
+            for feature, count in counts.items():
+                column, sign = _hash_feature(feature, self.dim)
+                matrix[row, column] += sign * (1.0 + math.log(count))
+        return matrix
+
+
+def build_embedder_from_env() -> Embedder:
+    backend = os.getenv("EMBEDDING_BACKEND", "hashing")
+    if backend == "hashing":
+        return HashingEmbedder()
+    module_name, _, class_name = backend.partition(":")
+    embedder_cls = getattr(importlib.import_module(module_name), class_name)
+    logger.info(f"Embedding backend: {backend}")
+    return embedder_cls()
+
+
+def normalize_rows(matrix: "np.ndarray") -> "np.ndarray":
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+# --- Vector index ---
+
+class VectorIndex:
+    """Per-user memory-mapped embedding matrices with row ownership in SQLite"""
+
+    def __init__(self, db_path: str, directory: str, space: str, dim: int):
+        self.directory = directory
+        self.space = space
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._matrices: "OrderedDict[str, Tuple[int, object]]" = OrderedDict()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10.0, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS vector_rows (
+                space TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                document_id TEXT,
+                chunk_idx INTEGER,
+                PRIMARY KEY (space, user_id, row)
+            );
+            CREATE INDEX IF NOT EXISTS idx_vector_rows_document ON vector_rows(space, user_id, document_id);
+            """
+        )
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, user_id: str) -> str:
+        # User IDs are client-supplied, so file names are derived from a hash
+        digest = hashlib.sha256(f"{self.space}:{user_id}".encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.directory, f"{digest}.f32")
+
+    def _ensure_capacity(self, path: str, rows: int) -> None:
+        row_bytes = self.dim * 4
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size >= rows * row_bytes:
+            return
+        capacity = max(MIN_CAPACITY, size // row_bytes)
+        while capacity < rows:
+            capacity *= 2
+        with open(path, "ab") as f:
+            f.truncate(capacity * row_bytes)
+
+    def _matrix(self, user_id: str):
+        """Read-only map of a user's matrix, reopened when another writer grew the file"""
+        path = self._path(user_id)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        with self._lock:
+            cached = self._matrices.get(user_id)
+            if cached is not None and cached[0] == size:
+                self._matrices.move_to_end(user_id)
+                return cached[1]
+        if size == 0:
+            return None
+        matrix = np.memmap(path, dtype=np.float32, mode="r", shape=(size // (self.dim * 4), self.dim))
+        with self._lock:
+            self._matrices[user_id] = (size, matrix)
+            while len(self._matrices) > OPEN_MATRICES:
+                self._matrices.popitem(last=False)
+        return matrix
+
+    def _add(self, user_id: str, document_id: str, vectors: "np.ndarray") -> int:
+        vectors = normalize_rows(vectors)
+        path = self._path(user_id)
+        with self._lock:
+            # IMMEDIATE serialises allocation and file growth across processes
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                existing = self._conn.execute(
+                    "SELECT COUNT(*) FROM vector_rows WHERE space = ? AND user_id = ? AND document_id = ?",
+                    (self.space, user_id, document_id),
+                ).fetchone()[0]
+                if existing:
+                    self._conn.execute("COMMIT")
+                    return 0
+                free = [row for (row,) in self._conn.execute(
+                    "SELECT row FROM vector_rows WHERE space = ? AND user_id = ? AND document_id IS NULL"
+                    " ORDER BY row LIMIT ?",
+                    (self.space, user_id, len(vectors)),
+                )]
+                next_row = self._conn.execute(
+                    "SELECT COALESCE(MAX(row) + 1, 0) FROM vector_rows WHERE space = ? AND user_id = ?",
+                    (self.space, user_id),
+                ).fetchone()[0]
+                rows = free + list(range(next_row, next_row + len(vectors) - len(free)))
+                self._ensure_capacity(path, max(rows) + 1)
+                matrix = np.memmap(path, dtype=np.float32, mode="r+",
+                                   shape=(os.path.getsize(path) // (self.dim * 4), self.dim))
+                matrix[rows] = vectors
+                matrix.flush()
+                del matrix
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO vector_rows (space, user_id, row, document_id, chunk_idx)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    [(self.space, user_id, row, document_id, idx) for idx, row in enumerate(rows)],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def _delete(self, user_id: str, document_id: str) -> int:
+        # Freed rows are reused by the next add; the file never shrinks
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE vector_rows SET document_id = NULL, chunk_idx = NULL"
+                " WHERE space = ? AND user_id = ? AND document_id = ?",
+                (self.space, user_id, document_id),
+            ).rowcount
+
+    def _has_document(self, user_id: str, document_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM vector_rows WHERE space = ? AND user_id = ? AND document_id = ? LIMIT 1",
+                (self.space, user_id, document_id),
+            ).fetchone() is not None
+
+    def _search(self, user_id: str, document_ids: List[str], queries: "np.ndarray", k: int) -> List[List[tuple]]:
+        """Top-k (score, document_id, chunk_idx) per query over the given documents"""
+        placeholders = ",".join("?" * len(document_ids))
+        with self._lock:
+            owned = self._conn.execute(
+                "SELECT row, document_id, chunk_idx FROM vector_rows WHERE space = ? AND user_id = ?"
+                f" AND document_id IN ({placeholders}) ORDER BY row",
+                (self.space, user_id, *document_ids),
+            ).fetchall()
+        matrix = self._matrix(user_id) if owned else None
+        if matrix is None:
+            return [[] for _ in range(len(queries))]
+
+        queries = normalize_rows(queries)
+        rows = np.fromiter((row for row, _, _ in owned), dtype=np.int64, count=len(owned))
+        k = max(1, min(k, len(rows)))
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_positions = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(rows), RETRIEVAL_BLOCK_ROWS):
+            block = rows[start:start + RETRIEVAL_BLOCK_ROWS]
+            # (queries x block) cosine scores in one matrix product
+            scores = queries @ matrix[block].T
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_positions = np.concatenate(
+                [best_positions, np.broadcast_to(np.arange(start, start + len(block)), scores.shape)], axis=1
+            )
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_positions = np.take_along_axis(best_positions, keep, axis=1)
+
+        results = []
+        for scores, positions in zip(best_scores, best_positions):
+            order = np.argsort(-scores)
+            results.append([
+                (float(scores[i]), owned[positions[i]][1], owned[positions[i]][2]) for i in order
+            ])
+        return results
+
+    async def add(self, user_id: str, document_id: str, vectors: "np.ndarray") -> int:
+        return await asyncio.to_thread(self._add, user_id, document_id, vectors)
+
+    async def delete(self, user_id: str, document_id: str) -> int:
+        return await asyncio.to_thread(self._delete, user_id, document_id)
+
+    async def has_document(self, user_id: str, document_id: str) -> bool:
+        return await asyncio.to_thread(self._has_document, user_id, document_id)
+
+    async def search(self, user_id: str, document_ids: List[str], queries: "np.ndarray", k: int) -> List[List[tuple]]:
+        return await asyncio.to_thread(self._search, user_id, document_ids, queries, k)
+
+    def close(self) -> None:
+        with self._lock:
+            self._matrices.clear()
+            self._conn.close()
+
+
+# --- Retrieval service ---
+
+class Retriever:
+    """Embeds ingested chunks and finds the ones most relevant to a message"""
+
+    def __init__(self, documents: "ingestion.DocumentIndex", embedder: Embedder,
+                 directory: str = VECTOR_INDEX_DIR, db_path: str = VECTOR_DB_PATH, top_k: int = RETRIEVAL_TOP_K):
+        self.documents = documents
+        self.embedder = embedder
+        self.directory = directory
+        self.db_path = db_path
+        self.top_k = top_k
+        self._vectors: Optional[VectorIndex] = None
+
+    @property
+    def vectors(self) -> VectorIndex:
+        # Opened on first use so the app starts without numpy when retrieval is unused
+        if self._vectors is None:
+            _require_numpy()
+            self._vectors = VectorIndex(self.db_path, self.directory, self.embedder.name, self.embedder.dim)
+        return self._vectors
+
+    def close(self) -> None:
+        if self._vectors is not None:
+            self._vectors.close()
+            self._vectors = None
+
+    async def embed(self, texts: List[str]) -> "np.ndarray":
+        _require_numpy()
+        return await asyncio.to_thread(self.embedder.embed, texts)
+
+    async def index_chunks(self, documents: List[Tuple[str, str]], chunks: List[str]) -> None:
+        """Add one content's chunks to the index of every (document_id, user_id) sharing it"""
+        vectors = await self.embed(chunks)
+        for document_id, user_id in documents:
+            added = await self.vectors.add(user_id, document_id, vectors)
+            if added:
+                logger.info(f"Added {added} vectors for document {document_id} of user {user_id}")
+
+    async def remove_document(self, user_id: str, document_id: str) -> int:
+        return await self.vectors.delete(user_id, document_id)
+
+    async def retrieve(self, user_id: str, documents: List[dict], query: str, k: Optional[int] = None) -> List[dict]:
+        """Most relevant chunks of the given ready documents for `query`"""
+        for document in documents:
+            # Documents ingested before vectors existed (or whose hook failed) are indexed now
+            if not await self.vectors.has_document(user_id, document["document_id"]):
+                chunks = await self.documents.get_chunks(document["checksum"])
+                if chunks:
+                    await self.index_chunks([(document["document_id"], user_id)], chunks)
+
+        by_id = {document["document_id"]: document for document in documents}
+        queries = await self.embed([query])
+        hits = (await self.vectors.search(user_id, list(by_id), queries, k or self.top_k))[0]
+
+        texts: Dict[tuple, str] = {}
+        for document_id in {document_id for _, document_id, _ in hits}:
+            idxs = [idx for _, hit_id, idx in hits if hit_id == document_id]
+            checksum = by_id[document_id]["checksum"]
+            for idx, text in (await self.documents.get_chunk_texts(checksum, idxs)).items():
+                texts[(document_id, idx)] = text
+        return [
+            {
+                "document_id": document_id,
+                "filename": by_id[document_id]["filename"],
+                "chunk": idx,
+                "score": score,
+                "text": texts[(document_id, idx)],
+            }
+            for score, document_id, idx in hits
+            if (document_id, idx) in texts
+        ]
+
+
+def format_document_context(prompt: str, hits: List[dict]) -> str:
+    """Prefix a prompt with the retrieved excerpts"""
+    if not hits:
+        return prompt
+    excerpts = "\n\n".join(f"[{i}] {hit['filename']}:\n{hit['text']}" for i, hit in enumerate(hits, 1))
+    return (
+        "Use the following excerpts from the user's documents where they are relevant.\n\n"
+        f"{excerpts}\n\nQuestion: {prompt}"
+    )
+
+
+# Process-wide retriever; ingestion hands it each document's chunks once stored
+retriever = Retriever(ingestion.pipeline.index, build_embedder_from_env())
+ingestion.pipeline.on_ready = retriever.index_chunks
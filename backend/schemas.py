@@ -1 +1,222 @@
-# No schemas needed. Database and user/message models removed; backend is now stateless. 
\ No newline at end of file
+"""Request and response models for the API.
+
+Request models carry hard size limits so oversized payloads are rejected
+while the body is parsed, before a user is resolved, admitted or a prompt
+is built. Unknown fields are ignored, as the hand-written checks did.
+
+Response models let FastAPI serialize handler results straight to JSON
+bytes in pydantic-core instead of going through `jsonable_encoder` and
+`json.dumps`; they also document every payload in the OpenAPI schema.
+"""
+import os
+from typing import Annotated, List, Optional
+
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints, model_validator
+
+from identity import MAX_USER_ID_CHARS
+
+# Longest message or prompt, in characters
+MAX_CONTENT_CHARS = int(os.getenv("MAX_CONTENT_CHARS", "32000"))
+# Most client-sent history entries, and their combined length in characters
+MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", "100"))
+MAX_HISTORY_CHARS = int(os.getenv("MAX_HISTORY_CHARS", "128000"))
+# Most prompts in one batch request
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+# Largest JSON request body, checked against Content-Length before it is read
+MAX_JSON_BODY_BYTES = int(os.getenv("MAX_JSON_BODY_BYTES", str(2 * 1024 * 1024)))
+# Most documents a single message may be grounded on
+MAX_DOCUMENTS_PER_MESSAGE = int(os.getenv("MAX_DOCUMENTS_PER_MESSAGE", "10"))
+
+MAX_TITLE_CHARS = 200
+MAX_MODEL_CHARS = 64
+MAX_CATEGORY_CHARS = 100
+MAX_SENDER_CHARS = 32
+MAX_ID_CHARS = 128
+
+PromptText = Annotated[str, StringConstraints(max_length=MAX_CONTENT_CHARS)]
+ResourceId = Annotated[str, StringConstraints(max_length=MAX_ID_CHARS)]
+
+
+class RequestModel(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+
+# --- Requests ---
+
+class HistoryMessage(RequestModel):
+    sender: str = Field(..., max_length=MAX_SENDER_CHARS)
+    content: str = Field(..., max_length=MAX_CONTENT_CHARS)
+
+
+class MessageRequest(RequestModel):
+    content: str = Field(..., min_length=1, max_length=MAX_CONTENT_CHARS)
+    is_enhanced: bool = False
+    history: List[HistoryMessage] = Field(default_factory=list, max_length=MAX_HISTORY_MESSAGES)
+    model: str = Field("phi4", max_length=MAX_MODEL_CHARS)
+    user_id: Optional[str] = Field(None, max_length=MAX_USER_ID_CHARS)
+    selected_category: Optional[str] = Field(None, max_length=MAX_CATEGORY_CHARS)
+    conversation_id: Optional[ResourceId] = None
+    document_ids: List[ResourceId] = Field(default_factory=list, max_length=MAX_DOCUMENTS_PER_MESSAGE)
+
+    @model_validator(mode="after")
+    def check_history_size(self):
+        if sum(len(msg.content) for msg in self.history) > MAX_HISTORY_CHARS:
+            raise ValueError(f"History too long (max {MAX_HISTORY_CHARS} characters)")
+        return self
+
+
+class BatchMessageRequest(RequestModel):
+    # Empty prompts are reported per item rather than failing the whole batch
+    prompts: List[PromptText] = Field(..., min_length=1, max_length=BATCH_MAX_ITEMS)
+    is_enhanced: bool = False
+    model: str = Field("phi4", max_length=MAX_MODEL_CHARS)
+    user_id: Optional[str] = Field(None, max_length=MAX_USER_ID_CHARS)
+    selected_category: Optional[str] = Field(None, max_length=MAX_CATEGORY_CHARS)
+    max_concurrency: Optional[int] = Field(None, ge=1)
+
+
+class EnhancePromptRequest(RequestModel):
+    prompt: str = Field(..., min_length=1, max_length=MAX_CONTENT_CHARS)
+    selected_category: Optional[str] = Field(None, max_length=MAX_CATEGORY_CHARS)
+
+
+class CreateConversationRequest(RequestModel):
+    user_id: str = Field(..., min_length=1, max_length=MAX_USER_ID_CHARS)
+    title: Optional[str] = Field(None, max_length=MAX_TITLE_CHARS)
+
+
+# --- Responses ---
+
+class EnhancePromptResponse(BaseModel):
+    originalPrompt: str
+    enhancedPrompt: str
+
+
+class Conversation(BaseModel):
+    id: str
+    title: str
+    lastMessage: Optional[str] = None
+    messageCount: int
+    createdAt: str
+    updatedAt: str
+    user_id: str
+
+
+class ConversationPage(BaseModel):
+    conversations: List[Conversation]
+    nextCursor: Optional[str] = None
+
+
+class Message(BaseModel):
+    id: str
+    content: str
+    sender: str
+    timestamp: str
+    conversation_id: str
+
+
+class MessagePage(BaseModel):
+    messages: List[Message]
+    nextCursor: Optional[str] = None
+
+
+class ConversationDeleted(BaseModel):
+    message: str
+    conversation_id: str
+
+
+class UploadResponse(BaseModel):
+    document_id: str
+    filename: Optional[str] = None
+    size: int
+    type: str
+    checksum: str
+    deduplicated: bool
+    user_id: str
+    status: str
+    message: str
+
+
+class DocumentStatus(BaseModel):
+    document_id: str
+    user_id: str
+    filename: str
+    type: str
+    size: int
+    checksum: str
+    status: str
+    error: Optional[str] = None
+    chunk_count: int
+
+
+class DocumentDeleted(BaseModel):
+    message: str
+    document_id: str
+
+
+class UserPreferences(BaseModel):
+    selectedCategory: Optional[str] = None
+    modelPreference: str
+
+
+class User(BaseModel):
+    id: str
+    name: str
+    preferences: UserPreferences
+    source: str
+    createdAt: str
+    lastActive: str
+
+
+# Template endpoints answer with pre-serialized bodies; these models document them
+class Category(BaseModel):
+    name: str
+    icon: str
+    count: int
+
+
+class PromptTemplate(BaseModel):
+    id: str
+    category: str
+    title: str
+    template: str
+    icon: str
+
+
+class TemplateSearchResult(PromptTemplate):
+    score: float
+
+
+class UsageTotals(BaseModel):
+    requests: int
+    cached: int
+    errors: int
+    cancelled: int
+    estimated: int
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+    cost_usd: float
+    avg_latency_ms: Optional[float] = None
+
+
+class ModelUsage(UsageTotals):
+    model: str
+
+
+class DailyUsage(UsageTotals):
+    day: str
+
+
+class UserUsageReport(BaseModel):
+    user_id: str
+    since: str
+    totals: UsageTotals
+    models: List[ModelUsage]
+    days: List[DailyUsage]
+
+
+class ModelUsageReport(BaseModel):
+    since: str
+    totals: UsageTotals
+    models: List[ModelUsage]
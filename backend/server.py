@@ -0,0 +1,84 @@
+"""Production launcher: N uvicorn workers with shared state and graceful drain.
+
+    cd backend
+    python server.py --workers 4 --port 5000
+
+Workers default to `WEB_CONCURRENCY` or the machine's core count. On SIGTERM
+(or Ctrl+C) each worker stops accepting connections and lets in-flight
+requests, including streaming chat replies, finish for up to `DRAIN_TIMEOUT`
+seconds before the app's shutdown hooks close pools and stores.
+
+With more than one worker, process-local state is switched to shared
+backends unless configured explicitly: rate-limit buckets go to SQLite
+(`RATE_LIMIT_BACKEND=sqlite`, or `redis` across hosts), and completion
+caching and the user session registry to SQLite. Conversations, document
+indexes and the usage ledger already live in SQLite files that all workers
+share. Provider concurrency caps are divided between the workers.
+
+Circuit breakers, request coalescing, admission queues and the counters
+behind `/metrics` and `/api/stats/*` stay per worker. Metrics are labelled
+with the worker's process ID and stats responses name it in `X-Worker-Pid`.
+"""
+import argparse
+import logging
+import os
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+# Settings that must be shared by every worker, applied unless already set
+SHARED_STATE_DEFAULTS = {
+    "RATE_LIMIT_BACKEND": "sqlite",
+    "COMPLETION_CACHE_BACKEND": "sqlite",
+    "SESSION_STORE": "sqlite",
+}
+
+# Process-local choices that would make workers disagree with each other
+PROCESS_LOCAL_SETTINGS = {
+    "RATE_LIMIT_BACKEND": "memory",
+    "COMPLETION_CACHE_BACKEND": "memory",
+    "CONVERSATION_STORE": "memory",
+    "SESSION_STORE": "memory",
+    "USAGE_STORE": "memory",
+}
+
+
+def configure_shared_state(workers: int) -> None:
+    """Point process-wide state at shared backends before workers start"""
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    if workers <= 1:
+        return
+    for name, value in SHARED_STATE_DEFAULTS.items():
+        os.environ.setdefault(name, value)
+    for name, value in PROCESS_LOCAL_SETTINGS.items():
+        if os.getenv(name, "").lower() == value:
+            logger.warning(f"{name}={value} keeps state per worker; behaviour will differ between the {workers} workers")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "5000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "0")) or os.cpu_count() or 1)
+    parser.add_argument("--drain-timeout", type=float, default=float(os.getenv("DRAIN_TIMEOUT", "30")),
+                        help="Seconds in-flight requests may take to finish after SIGTERM")
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    configure_shared_state(args.workers)
+    logger.info(f"Starting {args.workers} workers on {args.host}:{args.port} (drain timeout {args.drain_timeout}s)")
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_graceful_shutdown=args.drain_timeout,
+        log_level=args.log_level,
+        proxy_headers=True,
+    )
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,166 @@
+"""Single-flight coalescing of concurrent identical upstream calls.
+
+When several requests with the same key arrive while an upstream call is
+already running, they attach to that call instead of starting their own.
+Streamed tokens fan out to every subscriber (late joiners first receive the
+tokens produced so far). A subscriber that disconnects only detaches itself;
+the shared upstream call is cancelled once its last subscriber is gone.
+"""
+import os
+import asyncio
+import logging
+from contextlib import aclosing
+from dataclasses import dataclass, asdict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Set
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class _Failure:
+    """Queue item carrying an upstream exception to subscribers"""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+@dataclass
+class SingleFlightStats:
+    leaders: int = 0
+    coalesced: int = 0
+    cancelled: int = 0
+
+
+class _StreamFlight:
+    def __init__(self):
+        self.buffer: List[str] = []
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.finished = False
+        self.task: asyncio.Task = None
+
+
+class _CallFlight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Share one in-flight upstream call between concurrent identical requests"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stats = SingleFlightStats()
+        self._streams: Dict[str, _StreamFlight] = {}
+        self._calls: Dict[str, _CallFlight] = {}
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Yield the tokens of the shared stream for `key`, starting it if needed"""
+        if not self.enabled:
+            async with aclosing(factory()) as tokens:
+                async for token in tokens:
+                    yield token
+            return
+
+        flight = self._streams.get(key)
+        if flight is None:
+            flight = _StreamFlight()
+            self._streams[key] = flight
+            flight.task = asyncio.create_task(self._run_stream(key, flight, factory))
+            self.stats.leaders += 1
+        else:
+            self.stats.coalesced += 1
+            logger.info(f"Coalesced request onto in-flight upstream stream {key[:12]}")
+
+        # Replay what has been produced so far, then follow the live stream
+        queue: asyncio.Queue = asyncio.Queue()
+        for token in flight.buffer:
+            queue.put_nowait(token)
+        flight.subscribers.add(queue)
+
+        try:
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            flight.subscribers.discard(queue)
+            if not flight.subscribers and not flight.finished:
+                # Last subscriber left: stop paying for the upstream generation
+                self.stats.cancelled += 1
+                flight.task.cancel()
+                self._forget(self._streams, key, flight)
+
+    async def _run_stream(self, key: str, flight: _StreamFlight, factory: Callable[[], AsyncIterator[str]]) -> None:
+        upstream = factory()
+        try:
+            async for token in upstream:
+                flight.buffer.append(token)
+                for queue in flight.subscribers:
+                    queue.put_nowait(token)
+            final = _DONE
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            final = _Failure(e)
+        finally:
+            flight.finished = True
+            self._forget(self._streams, key, flight)
+            await upstream.aclose()
+
+        for queue in flight.subscribers:
+            queue.put_nowait(final)
+
+    async def call(self, key: str, factory: Callable[[], Awaitable]):
+        """Await the shared result for `key`, starting the call if needed"""
+        if not self.enabled:
+            return await factory()
+
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = _CallFlight(asyncio.ensure_future(factory()))
+            self._calls[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(self._calls, key, flight))
+            self.stats.leaders += 1
+        else:
+            self.stats.coalesced += 1
+            logger.info(f"Coalesced request onto in-flight upstream call {key[:12]}")
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                self.stats.cancelled += 1
+                flight.task.cancel()
+
+    def followers(self, key: str) -> int:
+        """Requests still attached to the in-flight call or stream for `key`"""
+        flight = self._streams.get(key)
+        if flight is not None:
+            return len(flight.subscribers)
+        call = self._calls.get(key)
+        return call.waiters if call is not None else 0
+
+    @staticmethod
+    def _forget(flights: dict, key: str, flight) -> None:
+        # Only remove the entry if a newer flight hasn't replaced it
+        if flights.get(key) is flight:
+            del flights[key]
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            **asdict(self.stats),
+            "in_flight_streams": len(self._streams),
+            "in_flight_calls": len(self._calls),
+        }
+
+
+# Process-wide coalescer used by the API handlers (REQUEST_COALESCING_ENABLED=0 disables it)
+coalescer = SingleFlight(enabled=os.getenv("REQUEST_COALESCING_ENABLED", "1").lower() in ("1", "true", "yes"))
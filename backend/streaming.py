@@ -0,0 +1,60 @@
+"""Streaming responses that stop generating as soon as the client goes away.
+
+Starlette's `StreamingResponse` only watches for `http.disconnect` on servers
+speaking ASGI spec < 2.4; on newer servers a disconnect is only noticed at the
+next write, which may be many seconds away while an upstream model is still
+thinking. Either way, the body generator is left for the garbage collector to
+close.
+
+`DisconnectAwareStreamingResponse` always watches for the disconnect, cancels
+the body the moment it arrives and closes the generator on the way out. The
+generator's `finally` blocks then run at once: upstream calls are cancelled,
+pool connections and admission slots are released. A generator that never
+started has no `finally` to run, so `on_close` is called on the way out too,
+whether the body ran, was cancelled or never began.
+"""
+import asyncio
+import logging
+from typing import Callable, Optional
+
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+
+class DisconnectAwareStreamingResponse(StreamingResponse):
+    """StreamingResponse that cancels its body when the client disconnects"""
+
+    def __init__(self, content, *args, on_close: Optional[Callable[[], None]] = None, **kwargs):
+        super().__init__(content, *args, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        body = asyncio.ensure_future(self.stream_response(send))
+        watcher = asyncio.ensure_future(self.listen_for_disconnect(receive))
+        try:
+            await asyncio.wait({body, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (body, watcher):
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(body, watcher, return_exceptions=True)
+            try:
+                aclose = getattr(self.body_iterator, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+            finally:
+                if self.on_close is not None:
+                    self.on_close()
+
+        if not body.cancelled() and body.exception() is not None:
+            if isinstance(body.exception(), OSError):
+                # Write to a closed connection (ASGI 2.4 servers): same as a disconnect
+                logger.info("Client disconnected during streaming response")
+            else:
+                raise body.exception()
+        elif body.cancelled():
+            logger.info("Client disconnected, streaming response cancelled")
+        if self.background is not None and not body.cancelled():
+            await self.background()
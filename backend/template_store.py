@@ -0,0 +1,147 @@
+"""External, hot-reloadable prompt-template store.
+
+Templates and category icons are loaded from `TEMPLATE_STORE_PATH`, either a
+JSON file (default `prompt_templates.json` next to this module):
+
+    {"categories": {"Code Analysis": "fas fa-code", ...},
+     "templates": [{"id": "...", "category": "...", "title": "...",
+                    "template": "...", "icon": "..."}, ...]}
+
+or a SQLite database (`.db`/`.sqlite`) with `prompt_templates(id, category,
+title, template, icon)` and `template_categories(name, icon)` tables.
+
+A watcher polls the file's modification time every `TEMPLATE_RELOAD_INTERVAL`
+seconds. A changed file is loaded and validated completely before the catalog
+swaps to it, so readers never see a partial update and a broken edit leaves the
+previous templates in place.
+"""
+import os
+import json
+import sqlite3
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_STORE_PATH = os.getenv(
+    "TEMPLATE_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_templates.json"),
+)
+TEMPLATE_RELOAD_INTERVAL = float(os.getenv("TEMPLATE_RELOAD_INTERVAL", "2"))
+
+REQUIRED_FIELDS = ("id", "category", "title", "template")
+DEFAULT_TEMPLATE_ICON = "fas fa-lightbulb"
+
+
+class TemplateStoreError(Exception):
+    """Template source is missing or invalid"""
+
+
+def _validate(templates: List[dict], icons: Dict[str, str]) -> Tuple[List[dict], Dict[str, str]]:
+    seen = set()
+    cleaned = []
+    for i, template in enumerate(templates):
+        if not isinstance(template, dict):
+            raise TemplateStoreError(f"Template #{i} is not an object")
+        missing = [field for field in REQUIRED_FIELDS if not isinstance(template.get(field), str) or not template[field]]
+        if missing:
+            raise TemplateStoreError(f"Template #{i} is missing {', '.join(missing)}")
+        if template["id"] in seen:
+            raise TemplateStoreError(f"Duplicate template id '{template['id']}'")
+        seen.add(template["id"])
+        cleaned.append({
+            "id": template["id"],
+            "category": template["category"],
+            "title": template["title"],
+            "template": template["template"],
+            "icon": template.get("icon") or icons.get(template["category"], DEFAULT_TEMPLATE_ICON),
+        })
+    return cleaned, dict(icons)
+
+
+def _load_json(path: str) -> Tuple[List[dict], Dict[str, str]]:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return data, {}
+    return data.get("templates", []), data.get("categories", {})
+
+
+def _load_sqlite(path: str) -> Tuple[List[dict], Dict[str, str]]:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        conn.row_factory = sqlite3.Row
+        templates = [dict(row) for row in conn.execute(
+            "SELECT id, category, title, template, icon FROM prompt_templates ORDER BY rowid"
+        )]
+        icons = {row["name"]: row["icon"] for row in conn.execute("SELECT name, icon FROM template_categories")}
+    finally:
+        conn.close()
+    return templates, icons
+
+
+def load_templates(path: str = TEMPLATE_STORE_PATH) -> Tuple[List[dict], Dict[str, str]]:
+    """Load and validate (templates, category icons) from a JSON or SQLite store"""
+    try:
+        if path.endswith((".db", ".sqlite", ".sqlite3")):
+            templates, icons = _load_sqlite(path)
+        else:
+            templates, icons = _load_json(path)
+    except TemplateStoreError:
+        raise
+    except Exception as e:
+        raise TemplateStoreError(f"Could not read template store {path}: {str(e)}")
+    return _validate(templates, icons)
+
+
+class TemplateWatcher:
+    """Polls the store's mtime and reloads the catalog when it changes"""
+
+    def __init__(self, path: str, on_change: Callable[[List[dict], Dict[str, str]], None],
+                 interval: float = TEMPLATE_RELOAD_INTERVAL):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._mtime: Optional[float] = self._current_mtime()
+        self._task: Optional[asyncio.Task] = None
+
+    def _current_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self) -> bool:
+        """Reload if the store changed; returns True when a new catalog was applied"""
+        mtime = self._current_mtime()
+        if mtime is None or mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        try:
+            templates, icons = load_templates(self.path)
+        except TemplateStoreError as e:
+            logger.error(f"Keeping previous templates: {str(e)}")
+            return False
+        self.on_change(templates, icons)
+        logger.info(f"Reloaded {len(templates)} prompt templates from {self.path}")
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # Parsing a large store happens off the event loop
+                await asyncio.to_thread(self.check)
+            except Exception as e:
+                logger.error(f"Template reload failed: {str(e)}")
+
+    def start(self) -> None:
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
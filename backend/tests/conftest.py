@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Modules build their singletons from the environment at import time, so point
+# every store at a scratch directory before anything from the backend is imported
+_STATE_DIR = tempfile.mkdtemp(prefix="backend-tests-")
+os.environ.update({
+    "CONVERSATION_STORE": "memory",
+    "SESSION_STORE": "memory",
+    "USAGE_STORE": "memory",
+    "RATE_LIMIT_BACKEND": "memory",
+    "COMPLETION_CACHE_BACKEND": "memory",
+    "DOCUMENT_DB_PATH": os.path.join(_STATE_DIR, "documents.db"),
+    "UPLOAD_DIR": os.path.join(_STATE_DIR, "uploads"),
+    "VECTOR_INDEX_DIR": os.path.join(_STATE_DIR, "vectors"),
+    "FAKE_PROVIDER_ENABLED": "1",
+})
+for key in ("OPENROUTER_API_KEY", "DEEPSEEK_API_KEY", "PROVIDERS_CONFIG"):
+    os.environ.pop(key, None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def client():
+    """One app lifespan for the whole run; shutdown closes the module-level stores"""
+    from fastapi.testclient import TestClient
+    from main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
@@ -0,0 +1,31 @@
+import json
+
+
+def run_batch(client, **body):
+    response = client.post("/api/message/batch", json=body)
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines() if line]
+    return {item["index"]: item for item in lines if "index" in item}, lines[-1]
+
+
+def test_batch_reports_ok_items(client):
+    items, summary = run_batch(client, prompts=["hello", "world"], model="fake")
+    assert all(item["ok"] for item in items.values())
+    assert summary == {"done": True, "userId": summary["userId"], "total": 2, "failed": 0}
+
+
+def test_batch_fallback_items_fail(client):
+    # phi4 has no API key here, so every item would get the canned fallback text
+    items, summary = run_batch(client, prompts=["hello", "", "there"], model="phi4")
+    assert items[0] == {"index": 0, "ok": False, "outcome": "fallback", "error": "Upstream request failed"}
+    assert items[1]["outcome"] == "invalid"
+    assert items[2]["outcome"] == "fallback"
+    assert "content" not in items[2]
+    assert summary["failed"] == 3
+
+
+def test_batch_unknown_model_fails(client):
+    items, summary = run_batch(client, prompts=["hello"], model="no-such-model")
+    assert items[0]["ok"] is False
+    assert items[0]["outcome"] == "fallback"
+    assert summary["failed"] == 1
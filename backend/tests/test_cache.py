@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from cache import CompletionCache, MemoryBackend, SQLiteBackend, make_key
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_backend(request, tmp_path):
+    def build(max_entries=100, max_bytes=1_000_000):
+        if request.param == "memory":
+            return MemoryBackend(max_entries, max_bytes)
+        return SQLiteBackend(str(tmp_path / "cache.db"), max_entries, max_bytes)
+    return build
+
+
+def test_key_covers_every_completion_setting():
+    key = make_key("phi4", [{"role": "user", "content": "hi"}], 0.7, 1000)
+    assert key == make_key("phi4", [{"role": "user", "content": "hi"}], 0.7, 1000)
+    assert key != make_key("deepseek", [{"role": "user", "content": "hi"}], 0.7, 1000)
+    assert key != make_key("phi4", [{"role": "user", "content": "hi"}], 0.2, 1000)
+    assert key != make_key("phi4", [{"role": "user", "content": "hi"}], 0.7, 500)
+
+
+def test_expired_entries_are_dropped(make_backend, monkeypatch):
+    monkeypatch.setattr("cache.time.time", lambda: 0.0)
+    backend = make_backend()
+    backend.set("a", "value", expires_at=100.0)
+    assert backend.get("a", now=99.0) == ("value", False)
+    assert backend.get("a", now=100.0) == (None, True)
+    # The expired entry is gone, not just hidden
+    assert backend.get("a", now=50.0) == (None, False)
+    assert backend.size() == {"entries": 0, "bytes": 0}
+
+
+def test_least_recently_used_entry_is_evicted_first(make_backend, monkeypatch):
+    backend = make_backend(max_entries=2)
+    clock = iter(range(1, 100))
+    monkeypatch.setattr("cache.time.time", lambda: float(next(clock)))
+    backend.set("a", "1", expires_at=1e12)
+    backend.set("b", "2", expires_at=1e12)
+    assert backend.get("a", now=float(next(clock)))[0] == "1"
+    assert backend.set("c", "3", expires_at=1e12) == 1
+    assert backend.get("b", now=float(next(clock))) == (None, False)
+    assert backend.get("a", now=float(next(clock)))[0] == "1"
+    assert backend.get("c", now=float(next(clock)))[0] == "3"
+
+
+def test_byte_bound_evicts_until_it_holds(make_backend):
+    backend = make_backend(max_bytes=10)
+    backend.set("a", "x" * 4, expires_at=1e12)
+    backend.set("b", "x" * 4, expires_at=1e12)
+    assert backend.set("c", "x" * 2, expires_at=1e12) == 0
+    assert backend.set("d", "x" * 7, expires_at=1e12) == 2
+    assert backend.size() == {"entries": 2, "bytes": 9}
+
+
+def test_completion_cache_counts_hits_misses_and_expirations(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("cache.time.time", lambda: now[0])
+    cache = CompletionCache(MemoryBackend(10, 1000), ttl=60)
+
+    async def scenario():
+        assert await cache.get("k") is None
+        await cache.set("k", "reply")
+        await cache.set("empty", "")
+        assert await cache.get("k") == "reply"
+        now[0] += 61
+        assert await cache.get("k") is None
+
+    asyncio.run(scenario())
+    snapshot = cache.snapshot()
+    assert (snapshot["hits"], snapshot["misses"], snapshot["expirations"], snapshot["stores"]) == (1, 2, 1, 1)
+    assert snapshot["entries"] == 0
+
+
+def test_disabled_cache_stores_nothing():
+    cache = CompletionCache(MemoryBackend(10, 1000), ttl=60, enabled=False)
+
+    async def scenario():
+        await cache.set("k", "reply")
+        return await cache.get("k")
+
+    assert asyncio.run(scenario()) is None
+    assert cache.snapshot()["entries"] == 0
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+import chat
+
+
+class RecordingLedger:
+    def __init__(self):
+        self.records = []
+
+    def record(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    recording = RecordingLedger()
+    monkeypatch.setattr(chat, "ledger", recording)
+    return recording
+
+
+def test_shared_stream_is_billed_once_after_its_leader_disconnects(ledger):
+    messages = [{"role": "user", "content": "coalesced usage test prompt"}]
+
+    async def scenario():
+        leader = chat.stream_external_ai_api("prompt", "fake", "user_leader", messages)
+        assert await leader.__anext__()
+        follower = chat.stream_external_ai_api("prompt", "fake", "user_follower", messages)
+        tokens = [await follower.__anext__()]
+        # The leader's client goes away; the follower keeps the generation alive
+        await leader.aclose()
+        tokens.extend([token async for token in follower])
+        return tokens
+
+    tokens = asyncio.run(scenario())
+    assert len(tokens) == 50
+    upstream = [record for record in ledger.records if record.source == "upstream"]
+    coalesced = [record for record in ledger.records if record.source == "coalesced"]
+    assert len(upstream) == 1
+    assert upstream[0].user_id == "user_leader"
+    assert upstream[0].outcome == "ok"
+    assert upstream[0].completion_tokens == 50
+    assert not upstream[0].estimated
+    assert [record.user_id for record in coalesced] == ["user_follower"]
+    assert coalesced[0].completion_tokens == 0
+
+
+def test_abandoned_stream_is_billed_as_cancelled(ledger):
+    messages = [{"role": "user", "content": "abandoned usage test prompt"}]
+
+    async def scenario():
+        stream = chat.stream_external_ai_api("prompt", "fake", "user_alone", messages)
+        assert await stream.__anext__()
+        await stream.aclose()
+        # Let the cancelled upstream task run its cleanup
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+    assert len(ledger.records) == 1
+    record = ledger.records[0]
+    assert (record.source, record.outcome, record.estimated) == ("upstream", "cancelled", True)
+    assert record.completion_tokens >= 1
+
+
+def test_shared_call_is_billed_once(ledger):
+    messages = [{"role": "user", "content": "coalesced call usage test prompt"}]
+
+    async def scenario():
+        return await asyncio.gather(
+            chat.call_external_ai_api("prompt", "fake", "user_a", messages),
+            chat.call_external_ai_api("prompt", "fake", "user_b", messages),
+        )
+
+    first, second = asyncio.run(scenario())
+    assert first == second
+    assert sorted(record.source for record in ledger.records) == ["coalesced", "upstream"]
+    upstream = next(record for record in ledger.records if record.source == "upstream")
+    assert upstream.completion_tokens == 50
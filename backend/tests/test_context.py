@@ -0,0 +1,83 @@
+from context import build_context_messages, estimate_tokens, normalize_history
+
+# Each turn costs 26 tokens under the fallback estimate
+TURN_TEXT = "x" * 100
+
+
+def history(n):
+    return [{"sender": "user" if i % 2 == 0 else "ai", "content": f"{i:03d}{TURN_TEXT}"} for i in range(n)]
+
+
+def turn_tokens(messages):
+    return sum(estimate_tokens(m["content"]) for m in messages)
+
+
+def test_history_within_budget_is_kept_verbatim():
+    messages = build_context_messages(history(4), "question", budget=1000)
+    assert [m["role"] for m in messages] == ["user", "assistant", "user", "assistant", "user"]
+    assert messages[-1] == {"role": "user", "content": "question"}
+    assert messages[0]["content"].startswith("000")
+
+
+def test_normalize_skips_malformed_entries_and_the_echoed_prompt():
+    raw = [
+        {"sender": "user", "content": "hi"},
+        {"sender": "ai"},
+        {"sender": "ai", "content": ""},
+        "junk",
+        {"sender": "ai", "content": "hello"},
+        {"sender": "user", "content": "question"},
+    ]
+    assert normalize_history(raw, "question") == [
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": "hello"},
+    ]
+
+
+def test_drop_keeps_the_newest_turns_that_fit():
+    messages = build_context_messages(history(20), "question", budget=200, overflow="drop", step=1)
+    kept = messages[:-1]
+    assert turn_tokens(kept) <= 200
+    assert len(kept) == 200 // 26
+    assert kept[-1]["content"].startswith("019")
+    assert all(m["role"] != "system" for m in kept)
+
+
+def test_drop_happens_in_whole_steps():
+    messages = build_context_messages(history(20), "question", budget=200, overflow="drop", step=4)
+    kept = messages[:-1]
+    # 13 turns must go to fit; rounding up to a step of 4 drops 16
+    assert len(kept) == 4
+    assert kept[0]["content"].startswith("016")
+
+
+def test_kept_prefix_is_stable_across_consecutive_requests():
+    first = build_context_messages(history(20), "question", budget=300, overflow="drop", step=4)
+    second = build_context_messages(history(21), "question", budget=300, overflow="drop", step=4)
+    assert first[0] == second[0]
+
+
+def test_summarize_folds_dropped_user_turns_into_a_system_message():
+    budget = 400
+    messages = build_context_messages(history(30), "question", budget=budget, overflow="summarize", step=1)
+    summary = messages[0]
+    assert summary["role"] == "system"
+    assert summary["content"].startswith("Summary of earlier conversation:")
+    assert "The user asked:" in summary["content"]
+    assert estimate_tokens(summary["content"]) <= int(budget * 0.15) + 1
+    kept = messages[1:-1]
+    assert turn_tokens(kept) <= budget - int(budget * 0.15)
+    assert kept[-1]["content"].startswith("029")
+
+
+def test_provider_budget_and_tokenizer_are_used():
+    class Provider:
+        history_token_budget = 50
+
+        @staticmethod
+        def count_tokens(text):
+            return len(text)
+
+    messages = build_context_messages(history(5), "question", provider=Provider(), overflow="drop", step=1)
+    # Every 103-character turn is over the 50-token budget on its own
+    assert messages == [{"role": "user", "content": "question"}]
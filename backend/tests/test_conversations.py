@@ -0,0 +1,57 @@
+def create_conversation(client, user_id):
+    response = client.post("/api/conversations", json={"user_id": user_id, "title": "Test"})
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+def test_messages_require_the_owner(client):
+    owner = client.get("/api/user").json()["id"]
+    other = client.get("/api/user").json()["id"]
+    conversation_id = create_conversation(client, owner)
+
+    response = client.get(f"/api/conversations/{conversation_id}/messages", params={"user_id": owner})
+    assert response.status_code == 200
+    assert response.json() == {"messages": [], "nextCursor": None}
+    assert client.get(f"/api/conversations/{conversation_id}/messages", params={"user_id": other}).status_code == 404
+    assert client.get(f"/api/conversations/{conversation_id}/messages").status_code == 422
+
+
+def test_delete_requires_the_owner(client):
+    owner = client.get("/api/user").json()["id"]
+    other = client.get("/api/user").json()["id"]
+    conversation_id = create_conversation(client, owner)
+
+    assert client.delete(f"/api/conversations/{conversation_id}").status_code == 422
+    assert client.delete(f"/api/conversations/{conversation_id}", params={"user_id": other}).status_code == 404
+    response = client.delete(f"/api/conversations/{conversation_id}", params={"user_id": owner})
+    assert response.status_code == 200
+    assert client.delete(f"/api/conversations/{conversation_id}", params={"user_id": owner}).status_code == 404
+
+
+def test_rejected_message_leaves_no_turn(client):
+    owner = client.get("/api/user").json()["id"]
+    conversation_id = create_conversation(client, owner)
+    body = {"content": "hello", "model": "fake", "user_id": owner, "conversation_id": conversation_id}
+
+    response = client.post("/api/message", json={**body, "document_ids": ["doc_missing"]})
+    assert response.status_code == 404
+    page = client.get(f"/api/conversations/{conversation_id}/messages", params={"user_id": owner}).json()
+    assert page["messages"] == []
+
+    response = client.post("/api/message", json=body)
+    assert response.status_code == 200
+    page = client.get(f"/api/conversations/{conversation_id}/messages", params={"user_id": owner}).json()
+    assert [message["sender"] for message in page["messages"]] == ["user", "assistant"]
+
+
+def test_fallback_reply_leaves_no_turn(client):
+    owner = client.get("/api/user").json()["id"]
+    conversation_id = create_conversation(client, owner)
+    # No API key is configured for phi4 in the tests, so the reply is the canned fallback
+    body = {"content": "hello", "model": "phi4", "user_id": owner, "conversation_id": conversation_id}
+
+    response = client.post("/api/message", json=body)
+    assert response.status_code == 200
+    assert response.text.startswith(f"USER_ID:{owner}\n")
+    page = client.get(f"/api/conversations/{conversation_id}/messages", params={"user_id": owner}).json()
+    assert page["messages"] == []
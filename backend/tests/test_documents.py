@@ -0,0 +1,53 @@
+def upload(client, user_id, text="Some uploaded text for the document tests."):
+    response = client.post(
+        "/api/upload-document",
+        files={"file": ("notes.txt", text.encode("utf-8"), "text/plain")},
+        data={"user_id": user_id},
+    )
+    assert response.status_code == 200
+    return response.json()["document_id"]
+
+
+def test_document_status_requires_the_owner(client):
+    owner = client.get("/api/user").json()["id"]
+    other = client.get("/api/user").json()["id"]
+    document_id = upload(client, owner)
+
+    response = client.get(f"/api/documents/{document_id}", params={"user_id": owner})
+    assert response.status_code == 200
+    assert response.json()["user_id"] == owner
+    assert client.get(f"/api/documents/{document_id}", params={"user_id": other}).status_code == 404
+    assert client.get(f"/api/documents/{document_id}").status_code == 422
+
+
+def chunked(data, size=1024):
+    # A generator body is sent without Content-Length
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def test_chunked_upload_over_the_limit_is_rejected(client, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 1024)
+    owner = client.get("/api/user").json()["id"]
+    boundary = "limit-test"
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"user_id\"\r\n\r\n{owner}\r\n"
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"big.txt\"\r\n"
+        "Content-Type: text/plain\r\n\r\n"
+    ).encode("utf-8") + b"x" * (main.UPLOAD_OVERHEAD_BYTES + 4096) + f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    response = client.post("/api/upload-document", content=chunked(body),
+                           headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    assert response.status_code == 413
+    assert response.json()["detail"].startswith("File too large")
+
+
+def test_chunked_json_body_over_the_limit_is_rejected(client, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "MAX_JSON_BODY_BYTES", 2048)
+    body = b'{"content": "' + b"x" * 4096 + b'", "model": "fake"}'
+    response = client.post("/api/message", content=chunked(body), headers={"Content-Type": "application/json"})
+    assert response.status_code == 413
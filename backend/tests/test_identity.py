@@ -0,0 +1,18 @@
+import asyncio
+
+from identity import IdentityService, MemorySessionStore, USER_ID_PREFIX
+
+
+def test_only_issued_ids_are_accepted():
+    service = IdentityService(MemorySessionStore(), sweep_interval=0)
+
+    async def scenario():
+        issued = await service.resolve(None)
+        assert await service.resolve(issued) == issued
+        # A made-up ID is not registered; the caller gets a fresh one instead
+        replaced = await service.resolve("user_made_up")
+        assert replaced != "user_made_up" and replaced.startswith(USER_ID_PREFIX)
+        assert await service.store.get("user_made_up") is None
+        return service.issued
+
+    assert asyncio.run(scenario()) == 2
@@ -0,0 +1,120 @@
+import asyncio
+import os
+import time
+
+import ingestion
+from ingestion import (STATUS_FAILED, STATUS_PROCESSING, STATUS_QUEUED, STATUS_READY, DocumentIndex,
+                       IngestionPipeline)
+
+SHA = "a" * 64
+
+
+def make_index(tmp_path):
+    blob = tmp_path / SHA
+    blob.write_text("Some uploaded text. " * 20)
+    index = DocumentIndex(str(tmp_path / "documents.db"))
+    return index, lambda sha256: str(tmp_path / sha256)
+
+
+async def wait_for_status(index, document_id, status, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        document = await index.get_document(document_id)
+        if document["status"] == status:
+            return document
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"document never reached {status}: {document}")
+
+
+def test_claim_is_exclusive(tmp_path):
+    index, _ = make_index(tmp_path)
+
+    async def scenario():
+        await index.add_document("user_1", SHA, "a.txt", "txt", 400)
+        assert await index.claim(SHA, time.time() - 60)
+        assert not await index.claim(SHA, time.time() - 60)
+        # Once the claim is older than the stale cutoff it can be taken over
+        assert await index.claim(SHA, time.time() + 1)
+
+    asyncio.run(scenario())
+    index.close()
+
+
+def test_job_claimed_by_crashed_worker_is_resumed_after_restart(tmp_path):
+    index, path_for = make_index(tmp_path)
+
+    async def scenario():
+        document_id, status, created = await index.add_document("user_1", SHA, "a.txt", "txt", 400)
+        assert (status, created) == (STATUS_QUEUED, True)
+        # A worker claimed the job and died before storing the chunks
+        assert await index.claim(SHA, time.time())
+        assert (await index.get_document(document_id))["status"] == STATUS_PROCESSING
+
+        # The restarted worker sees a fresh claim; the sweep requeues it once it goes stale
+        pipeline = IngestionPipeline(index, path_for, workers=1, stale_seconds=0.3, sweep_interval=0.05)
+        await pipeline.start()
+        try:
+            document = await wait_for_status(index, document_id, STATUS_READY)
+        finally:
+            await pipeline.stop()
+        assert document["chunk_count"] >= 1
+        assert await index.get_chunks(SHA)
+
+    asyncio.run(scenario())
+    index.close()
+
+
+def test_live_claim_is_kept_fresh(tmp_path):
+    index, path_for = make_index(tmp_path)
+
+    async def scenario():
+        await index.add_document("user_1", SHA, "a.txt", "txt", 400)
+        assert await index.claim(SHA, time.time())
+        pipeline = IngestionPipeline(index, path_for, workers=1, stale_seconds=0.3)
+        # The heartbeat keeps refreshing the claim, so the sweep finds nothing stale
+        heartbeat = asyncio.create_task(pipeline._heartbeat(SHA))
+        try:
+            await asyncio.sleep(0.5)
+            assert await index.stale_jobs(time.time() - 0.3) == []
+        finally:
+            heartbeat.cancel()
+        await asyncio.sleep(0.35)
+        assert await index.stale_jobs(time.time() - 0.3) == [(SHA, "txt")]
+
+    asyncio.run(scenario())
+    index.close()
+
+
+def _kill_worker(path):
+    # Takes the pool process down the way a segfaulting parser would
+    os._exit(1)
+
+
+def test_crashed_worker_does_not_break_the_pipeline(tmp_path, monkeypatch):
+    index, path_for = make_index(tmp_path)
+    crash_sha = "b" * 64
+    (tmp_path / crash_sha).write_text("never extracted")
+    # Pool processes are forked after this, so they see the crashing extractor too
+    monkeypatch.setitem(ingestion.EXTRACTORS, "crash", _kill_worker)
+    crashes = []
+    replace_pool = IngestionPipeline._replace_pool
+    monkeypatch.setattr(IngestionPipeline, "_replace_pool",
+                        lambda self, broken: (crashes.append(broken), replace_pool(self, broken)))
+
+    async def scenario():
+        pipeline = IngestionPipeline(index, path_for, workers=1)
+        await pipeline.start()
+        try:
+            crashed_id = (await pipeline.submit("user_1", crash_sha, "bad.crash", "crash", 15))["document_id"]
+            document = await wait_for_status(index, crashed_id, STATUS_FAILED)
+            assert document["error"] == "Extraction worker crashed"
+            # Retried once on a fresh pool, which is then replaced again
+            assert len(crashes) == 2
+            # Later jobs run on a working pool
+            document_id = (await pipeline.submit("user_1", SHA, "a.txt", "txt", 400))["document_id"]
+            await wait_for_status(index, document_id, STATUS_READY)
+        finally:
+            await pipeline.stop()
+
+    asyncio.run(scenario())
+    index.close()
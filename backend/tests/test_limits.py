@@ -0,0 +1,187 @@
+import asyncio
+import gc
+import logging
+
+import pytest
+
+import limits
+from limits import (AdmissionController, AdmissionRejected, MemoryRateLimitBackend, ProviderGate,
+                    SQLiteRateLimitBackend)
+from providers import FakeProvider
+
+
+class FakeClock:
+    """Stands in for the `time` module inside limits.py so buckets refill on demand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(limits, "time", fake)
+    return fake
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        yield MemoryRateLimitBackend()
+        return
+    sqlite_backend = SQLiteRateLimitBackend(str(tmp_path / "rate_limits.db"))
+    yield sqlite_backend
+    asyncio.run(sqlite_backend.close())
+
+
+def test_bucket_allows_a_burst_then_reports_the_wait(backend, clock):
+    async def scenario():
+        return [await backend.take("user:a", 1.0, 2) for _ in range(3)]
+
+    assert asyncio.run(scenario()) == [0.0, 0.0, 1.0]
+
+
+def test_bucket_refills_at_the_configured_rate(backend, clock):
+    async def scenario():
+        for _ in range(2):
+            assert await backend.take("user:a", 0.5, 2) == 0.0
+        assert await backend.take("user:a", 0.5, 2) == pytest.approx(2.0)
+        clock.now += 1.0
+        # Half a token back: the wait shrinks but the request is still refused
+        assert await backend.take("user:a", 0.5, 2) == pytest.approx(1.0)
+        clock.now += 1.0
+        assert await backend.take("user:a", 0.5, 2) == 0.0
+
+    asyncio.run(scenario())
+
+
+def test_refill_is_capped_at_the_burst(backend, clock):
+    async def scenario():
+        await backend.take("user:a", 1.0, 3)
+        clock.now += 3600
+        results = [await backend.take("user:a", 1.0, 3) for _ in range(4)]
+        # Other users have their own bucket
+        results.append(await backend.take("user:b", 1.0, 3))
+        return results
+
+    assert asyncio.run(scenario()) == [0.0, 0.0, 0.0, 1.0, 0.0]
+
+
+def test_rate_limit_rejection_carries_retry_after(clock):
+    admission = AdmissionController(MemoryRateLimitBackend(), rate_per_minute=6, burst=1)
+
+    async def scenario():
+        await admission.check_rate("user_1")
+        with pytest.raises(AdmissionRejected) as rejected:
+            await admission.check_rate("user_1")
+        return rejected.value
+
+    rejected = asyncio.run(scenario())
+    assert rejected.retry_after == pytest.approx(10.0)
+    assert rejected.retry_after_header == "10"
+    assert admission.rate_limited == 1
+
+
+def test_rotating_user_ids_does_not_escape_the_client_limit(clock):
+    admission = AdmissionController(MemoryRateLimitBackend(), rate_per_minute=6, burst=1,
+                                    client_rate_per_minute=6, client_burst=3)
+
+    async def scenario():
+        for n in range(3):
+            await admission.check_rate(f"user_{n}", "203.0.113.7")
+        with pytest.raises(AdmissionRejected):
+            await admission.check_rate("user_fresh", "203.0.113.7")
+        # Another address has its own allowance
+        await admission.check_rate("user_other", "198.51.100.2")
+
+    asyncio.run(scenario())
+    assert admission.rate_limited == 1
+
+
+def test_retry_after_header_rounds_up_to_whole_seconds():
+    assert AdmissionRejected("x", 0.2).retry_after_header == "1"
+    assert AdmissionRejected("x", 2.1).retry_after_header == "3"
+    assert AdmissionRejected("x", 0).retry_after_header == "1"
+
+
+def test_zero_rate_disables_the_user_limit():
+    admission = AdmissionController(MemoryRateLimitBackend(), rate_per_minute=0, burst=1)
+
+    async def scenario():
+        for _ in range(5):
+            await admission.check_rate("user_1")
+
+    asyncio.run(scenario())
+    assert admission.rate_limited == 0
+
+
+def test_gate_queues_in_order_and_rejects_when_the_queue_is_full():
+    gate = ProviderGate("Fake", max_concurrent=1, max_queue=1, queue_timeout=5)
+    order = []
+
+    async def holder(name):
+        await gate.acquire()
+        order.append(name)
+
+    async def scenario():
+        await gate.acquire()
+        waiter = asyncio.create_task(holder("queued"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            await gate.acquire()
+        assert rejected.value.retry_after > 0
+        # Releasing hands the slot straight to the queued request
+        gate.release(0.5)
+        await waiter
+        return gate.snapshot()
+
+    snapshot = asyncio.run(scenario())
+    assert order == ["queued"]
+    assert (snapshot["active"], snapshot["waiting"], snapshot["rejected"], snapshot["queued"]) == (1, 0, 1, 1)
+
+
+def test_gate_queue_timeout_is_rejected():
+    gate = ProviderGate("Fake", max_concurrent=1, max_queue=4, queue_timeout=0.05)
+
+    async def scenario():
+        await gate.acquire()
+        with pytest.raises(AdmissionRejected, match="Timed out"):
+            await gate.acquire()
+
+    asyncio.run(scenario())
+    snapshot = gate.snapshot()
+    assert (snapshot["active"], snapshot["waiting"], snapshot["timed_out"]) == (1, 0, 1)
+
+
+def test_ticket_release_is_idempotent():
+    admission = AdmissionController(MemoryRateLimitBackend())
+    provider = FakeProvider(max_concurrency=2)
+
+    async def scenario():
+        ticket = await admission.acquire_slot(provider)
+        assert admission.gate_for(provider).snapshot()["active"] == 1
+        ticket.release()
+        ticket.release()
+
+    asyncio.run(scenario())
+    assert admission.gate_for(provider).snapshot()["active"] == 0
+
+
+def test_leaked_ticket_is_logged_not_released(caplog):
+    admission = AdmissionController(MemoryRateLimitBackend())
+    provider = FakeProvider(max_concurrency=2)
+
+    async def scenario():
+        await admission.acquire_slot(provider)
+
+    with caplog.at_level(logging.ERROR, logger="limits"):
+        asyncio.run(scenario())
+        gc.collect()
+    assert "admission slot was never released" in caplog.text
+    assert admission.gate_for(provider).snapshot()["active"] == 1
@@ -0,0 +1,19 @@
+import os
+
+import metrics
+
+
+def test_samples_are_labelled_with_the_worker():
+    counter = metrics.Counter("test_worker_label_total", "Test counter", ("model",))
+    histogram = metrics.Histogram("test_worker_label_seconds", "Test histogram", ("model",), buckets=(1.0,))
+    counter.labels("fake").inc()
+    histogram.labels("fake").observe(0.5)
+    try:
+        text = metrics.render()
+    finally:
+        metrics.REGISTRY.remove(counter)
+        metrics.REGISTRY.remove(histogram)
+    worker = f'worker="{os.getpid()}"'
+    assert f'test_worker_label_total{{model="fake",{worker}}} 1.0' in text
+    assert f'test_worker_label_seconds_bucket{{model="fake",le="1.0",{worker}}} 1' in text
+    assert f'test_worker_label_seconds_count{{model="fake",{worker}}} 1' in text
@@ -0,0 +1,31 @@
+import asyncio
+import time
+
+from limits import AdmissionController, MemoryRateLimitBackend
+from providers import FakeProvider
+
+
+def test_fake_stream_reports_usage():
+    provider = FakeProvider(response_tokens=5, first_token_latency=0, tokens_per_second=0)
+    usage = {}
+
+    async def scenario():
+        return [token async for token in provider.stream([{"role": "user", "content": "one two"}], "user_1", usage)]
+
+    assert asyncio.run(scenario()) == ["one ", "two ", "one ", "two ", "one "]
+    assert usage == {"prompt_tokens": provider.count_tokens("one two"), "completion_tokens": 5, "model": "fake"}
+
+
+def test_concurrency_is_capped_by_admission_only():
+    provider = FakeProvider(max_concurrency=1, first_token_latency=0.2, response_tokens=1)
+    messages = [{"role": "user", "content": "hi"}]
+
+    async def scenario():
+        started = time.perf_counter()
+        await asyncio.gather(provider.complete(messages, "user_1"), provider.complete(messages, "user_2"))
+        return time.perf_counter() - started
+
+    # The provider itself doesn't serialize calls; the admission gate holds its limit
+    assert asyncio.run(scenario()) < 0.35
+    admission = AdmissionController(MemoryRateLimitBackend())
+    assert admission.gate_for(provider).max_concurrent == 1
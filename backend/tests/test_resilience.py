@@ -0,0 +1,251 @@
+import asyncio
+
+import pytest
+
+import resilience
+from limits import AdmissionController, MemoryRateLimitBackend
+from providers import Provider, ProviderError
+from resilience import CircuitBreaker, CircuitOpen, UpstreamGuard
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(resilience.time, "monotonic", fake.monotonic)
+    return fake
+
+
+class ScriptedProvider(Provider):
+    """Answers each call with the next scripted error, or a reply once the script runs out"""
+
+    def __init__(self, errors, **kwargs):
+        super().__init__("scripted", **kwargs)
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def complete(self, messages, user_id, usage=None):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "reply"
+
+
+def run_complete(guard, provider):
+    return asyncio.run(guard.complete(provider, [{"role": "user", "content": "hi"}], "user_1"))
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("Fake", threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.before_call()
+    breaker.record_failure()
+    assert (breaker.state, breaker.opened) == ("open", 1)
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    assert breaker.short_circuited == 1
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker("Fake", threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert (breaker.state, breaker.failures) == ("closed", 1)
+
+
+def test_half_open_allows_a_single_probe(clock):
+    breaker = CircuitBreaker("Fake", threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 29
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    clock.now += 1
+    breaker.before_call()
+    assert breaker.state == "half_open"
+    # Everyone else keeps failing fast while the probe is out
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    breaker.record_success()
+    assert (breaker.state, breaker.failures) == ("closed", 0)
+    breaker.before_call()
+
+
+def test_failed_probe_reopens_the_circuit(clock):
+    breaker = CircuitBreaker("Fake", threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    breaker.before_call()
+    breaker.record_failure()
+    assert (breaker.state, breaker.opened) == ("open", 2)
+    clock.now += 29
+    with pytest.raises(CircuitOpen):
+        breaker.before_call()
+    clock.now += 1
+    breaker.before_call()
+    assert breaker.state == "half_open"
+
+
+def test_released_probe_lets_the_next_call_probe(clock):
+    breaker = CircuitBreaker("Fake", threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    breaker.before_call()
+    breaker.release_probe()
+    breaker.before_call()
+    assert breaker.state == "half_open"
+
+
+def test_guard_retries_server_errors_then_succeeds():
+    guard = UpstreamGuard(lambda model: None)
+    provider = ScriptedProvider(
+        [ProviderError("busy", status_code=503), ProviderError("slow down", status_code=429)],
+        resilience={"max_retries": 2, "backoff_base": 0, "circuit_threshold": 5},
+    )
+    assert run_complete(guard, provider) == "reply"
+    state = guard.state_for(provider)
+    assert (provider.calls, state.stats.retries, state.breaker.state, state.breaker.failures) == (3, 2, "closed", 0)
+
+
+def test_guard_does_not_retry_or_trip_on_client_errors():
+    guard = UpstreamGuard(lambda model: None)
+    provider = ScriptedProvider([ProviderError("bad request", status_code=400)] * 3,
+                                resilience={"max_retries": 2, "circuit_threshold": 1})
+    for _ in range(3):
+        with pytest.raises(ProviderError):
+            run_complete(guard, provider)
+    assert provider.calls == 3
+    assert guard.state_for(provider).breaker.state == "closed"
+
+
+def test_open_circuit_fails_fast_without_calling_the_provider():
+    guard = UpstreamGuard(lambda model: None)
+    provider = ScriptedProvider([ProviderError("payment required", status_code=402)],
+                                resilience={"max_retries": 2, "circuit_threshold": 1, "circuit_reset": 60})
+    with pytest.raises(ProviderError):
+        run_complete(guard, provider)
+    assert guard.state_for(provider).breaker.state == "open"
+    with pytest.raises(CircuitOpen):
+        run_complete(guard, provider)
+    assert provider.calls == 1
+
+
+class StreamingProvider(Provider):
+    """Streams a scripted reply after `stall` seconds, failing with the next scripted error when one is left
+
+    An error scripted as a (tokens, error) pair is raised after those tokens were sent.
+    """
+
+    supports_streaming = True
+
+    def __init__(self, model, reply, stall=0.0, errors=(), **kwargs):
+        super().__init__(model, **kwargs)
+        self.reply = list(reply)
+        self.stall = stall
+        self.errors = list(errors)
+        self.calls = 0
+        self.cancelled = 0
+
+    async def stream(self, messages, user_id, usage=None):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.stall)
+            if self.errors:
+                sent, error = self.errors.pop(0)
+                for token in sent:
+                    yield token
+                raise error
+            for token in self.reply:
+                yield token
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled += 1
+            raise
+
+
+def run_stream(guard, provider):
+    async def collect():
+        return [token async for token in guard.stream(provider, [{"role": "user", "content": "hi"}], "user_1")]
+
+    return asyncio.run(collect())
+
+
+def hedged(primary_stall, hedge_stall, hedge_delay=None, **guard_kwargs):
+    policy = {"hedge_model": "hedge"} if hedge_delay is None else {"hedge_model": "hedge", "hedge_delay": hedge_delay}
+    primary = StreamingProvider("primary", ["slow ", "reply"], stall=primary_stall, resilience=policy)
+    hedge = StreamingProvider("hedge", ["fast ", "reply"], stall=hedge_stall)
+    guard = UpstreamGuard({"hedge": hedge}.get, **guard_kwargs)
+    # Enough first-token samples for the p95 to become the hedge delay
+    for _ in range(resilience.HEDGE_MIN_SAMPLES):
+        guard.state_for(primary).ttft.add(0.01)
+    return primary, hedge, guard
+
+
+def test_hedge_fires_after_the_p95_first_token_time_and_relays_the_winner():
+    primary, hedge, guard = hedged(primary_stall=3600, hedge_stall=0)
+    assert guard.hedge_delay(primary) == pytest.approx(0.01)
+
+    assert run_stream(guard, primary) == ["fast ", "reply"]
+    stats = guard.state_for(primary).stats
+    assert (stats.hedges, stats.hedge_wins) == (1, 1)
+    # The slow primary was cancelled rather than left running
+    assert (primary.calls, primary.cancelled) == (1, 1)
+
+
+def test_losing_hedge_is_cancelled():
+    primary, hedge, guard = hedged(primary_stall=0.2, hedge_stall=3600)
+
+    assert run_stream(guard, primary) == ["slow ", "reply"]
+    stats = guard.state_for(primary).stats
+    assert (stats.hedges, stats.hedge_wins) == (1, 0)
+    assert (hedge.calls, hedge.cancelled) == (1, 1)
+
+
+def test_hedge_takes_a_slot_of_the_hedge_provider_or_is_skipped():
+    admission = AdmissionController(MemoryRateLimitBackend())
+    primary, hedge, guard = hedged(primary_stall=0.2, hedge_stall=3600, hedge_delay=0.01, try_slot=admission.try_slot)
+
+    assert run_stream(guard, primary) == ["slow ", "reply"]
+    gate = admission.gate_for(hedge)
+    # The losing hedge gave its slot back
+    assert (gate.stats.admitted, gate.snapshot()["active"]) == (1, 0)
+
+    # With every hedge slot taken the request waits on the primary alone
+    held = [admission.try_slot(hedge) for _ in range(gate.max_concurrent)]
+    assert run_stream(guard, primary) == ["slow ", "reply"]
+    assert hedge.calls == 1
+    assert guard.state_for(primary).stats.hedges_skipped == 1
+    for ticket in held:
+        ticket.release()
+
+
+def test_stream_is_retried_before_the_first_token_only():
+    guard = UpstreamGuard(lambda model: None)
+    policy = {"max_retries": 2, "backoff_base": 0}
+    provider = StreamingProvider("flaky", ["whole ", "reply"], resilience=policy,
+                                 errors=[([], ProviderError("busy", status_code=503))])
+    assert run_stream(guard, provider) == ["whole ", "reply"]
+    assert (provider.calls, guard.state_for(provider).stats.retries) == (2, 1)
+
+    provider = StreamingProvider("broken", ["whole ", "reply"], resilience=policy,
+                                 errors=[(["partial "], ProviderError("busy", status_code=503))])
+    relayed = []
+
+    async def collect():
+        async for token in guard.stream(provider, [{"role": "user", "content": "hi"}], "user_1"):
+            relayed.append(token)
+
+    with pytest.raises(ProviderError):
+        asyncio.run(collect())
+    # Tokens already relayed can't be taken back, so the failure is not retried
+    assert relayed == ["partial "]
+    assert (provider.calls, guard.state_for(provider).stats.retries) == (1, 0)
@@ -0,0 +1,26 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from pydantic import ValidationError
+
+from schemas import MAX_CONTENT_CHARS, MAX_DOCUMENTS_PER_MESSAGE, MessageRequest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_importing_schemas_does_not_open_stores():
+    code = "import sys, schemas; print(sorted({'retrieval', 'ingestion', 'documents'} & set(sys.modules)))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=BACKEND_DIR, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
+
+
+def test_message_request_limits():
+    MessageRequest(content="hi", document_ids=["doc"] * MAX_DOCUMENTS_PER_MESSAGE)
+    with pytest.raises(ValidationError):
+        MessageRequest(content="hi", document_ids=["doc"] * (MAX_DOCUMENTS_PER_MESSAGE + 1))
+    with pytest.raises(ValidationError):
+        MessageRequest(content="x" * (MAX_CONTENT_CHARS + 1))
+    with pytest.raises(ValidationError):
+        MessageRequest(content="")
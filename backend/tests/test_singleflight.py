@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+async def tokens(items, started, delay=0.01):
+    started.append(True)
+    for item in items:
+        await asyncio.sleep(delay)
+        yield item
+
+
+async def collect(stream):
+    return [token async for token in stream]
+
+
+def test_identical_streams_share_one_upstream():
+    flight = SingleFlight()
+    started = []
+
+    async def consume():
+        return await collect(flight.stream("key", lambda: tokens(["a", "b", "c"], started)))
+
+    async def scenario():
+        return await asyncio.gather(consume(), consume(), consume())
+
+    assert asyncio.run(scenario()) == [["a", "b", "c"]] * 3
+    assert started == [True]
+    assert (flight.stats.leaders, flight.stats.coalesced) == (1, 2)
+    assert flight.snapshot()["in_flight_streams"] == 0
+
+
+def test_late_joiner_replays_tokens_already_sent():
+    flight = SingleFlight()
+    started = []
+
+    async def scenario():
+        first = flight.stream("key", lambda: tokens(["a", "b", "c"], started))
+        assert await first.__anext__() == "a"
+        late = [token async for token in flight.stream("key", lambda: tokens(["x"], started))]
+        rest = [token async for token in first]
+        return late, rest
+
+    assert asyncio.run(scenario()) == (["a", "b", "c"], ["b", "c"])
+    assert started == [True]
+
+
+def test_stream_error_reaches_every_subscriber():
+    flight = SingleFlight()
+
+    async def failing():
+        yield "a"
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream broke")
+
+    async def consume(received):
+        async for token in flight.stream("key", failing):
+            received.append(token)
+
+    async def scenario():
+        first, second = [], []
+        results = await asyncio.gather(consume(first), consume(second), return_exceptions=True)
+        return results, first, second
+
+    results, first, second = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) and str(result) == "upstream broke" for result in results)
+    assert first == second == ["a"]
+    # A failed flight is forgotten, so the next request starts afresh
+    assert flight.snapshot()["in_flight_streams"] == 0
+
+
+def test_call_error_reaches_every_waiter():
+    flight = SingleFlight()
+    calls = []
+
+    async def failing():
+        calls.append(True)
+        await asyncio.sleep(0.01)
+        raise ValueError("bad reply")
+
+    async def scenario():
+        return await asyncio.gather(*(flight.call("key", failing) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flight.snapshot()["in_flight_calls"] == 0
+
+
+def test_upstream_is_cancelled_when_the_last_subscriber_leaves():
+    flight = SingleFlight()
+    closed = []
+
+    async def endless():
+        try:
+            while True:
+                await asyncio.sleep(0.01)
+                yield "t"
+        finally:
+            closed.append(True)
+
+    async def scenario():
+        first = flight.stream("key", endless)
+        second = flight.stream("key", endless)
+        await first.__anext__()
+        await second.__anext__()
+        await first.aclose()
+        # One follower remains, so the generation keeps going
+        assert await second.__anext__() == "t"
+        assert not closed
+        await second.aclose()
+        await asyncio.sleep(0.02)
+
+    asyncio.run(scenario())
+    assert closed == [True]
+    assert flight.stats.cancelled == 1
+
+
+def test_call_survives_a_waiter_leaving():
+    flight = SingleFlight()
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        return "reply"
+
+    async def scenario():
+        leaver = asyncio.create_task(flight.call("key", slow))
+        stayer = asyncio.create_task(flight.call("key", slow))
+        await asyncio.sleep(0.01)
+        leaver.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leaver
+        return await stayer
+
+    assert asyncio.run(scenario()) == "reply"
+    assert flight.stats.cancelled == 0
+
+
+def test_disabled_flight_runs_each_call():
+    flight = SingleFlight(enabled=False)
+    started = []
+
+    async def scenario():
+        return await asyncio.gather(*(
+            asyncio.create_task(collect(flight.stream("key", lambda: tokens(["a"], started)))) for _ in range(2)
+        ))
+
+    assert asyncio.run(scenario()) == [["a"], ["a"]]
+    assert started == [True, True]
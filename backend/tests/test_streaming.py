@@ -0,0 +1,43 @@
+import asyncio
+
+from streaming import DisconnectAwareStreamingResponse
+
+
+def test_on_close_runs_when_the_body_never_starts():
+    closed = []
+    started = []
+
+    async def body():
+        started.append(True)
+        yield b"never sent"
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        # The client is gone before the response starts
+        raise OSError("connection closed")
+
+    response = DisconnectAwareStreamingResponse(body(), on_close=lambda: closed.append(True))
+    asyncio.run(response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send))
+    assert closed == [True]
+    assert not started
+
+
+def test_on_close_runs_after_a_complete_body():
+    closed = []
+    sent = []
+
+    async def body():
+        yield b"hello"
+
+    async def receive():
+        await asyncio.sleep(10)
+
+    async def send(message):
+        sent.append(message)
+
+    response = DisconnectAwareStreamingResponse(body(), on_close=lambda: closed.append(True))
+    asyncio.run(response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send))
+    assert closed == [True]
+    assert sent[-1] == {"type": "http.response.body", "body": b"", "more_body": False}
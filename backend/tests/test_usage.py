@@ -0,0 +1,167 @@
+import asyncio
+
+import pytest
+
+from usage import MemoryUsageStore, SQLiteUsageStore, UsageLedger, UsageRecord
+
+
+def record(user_id="user_1", model="fake", **fields):
+    values = {"outcome": "ok", "source": "upstream", "prompt_tokens": 10, "completion_tokens": 5,
+              "cost_usd": 0.001, "latency_seconds": 0.2}
+    values.update(fields)
+    return UsageRecord(user_id=user_id, model=model, **values)
+
+
+class FlakyStore(MemoryUsageStore):
+    """Fails the first `failures` writes"""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.closed = False
+
+    async def write(self, records):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        await super().write(records)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryUsageStore()
+    return SQLiteUsageStore(str(tmp_path / "usage.db"))
+
+
+def test_records_are_buffered_until_flushed(store):
+    ledger = UsageLedger(store, flush_interval=60, batch_size=100)
+
+    async def scenario():
+        ledger.record(record())
+        ledger.record(record(source="cache", prompt_tokens=0, completion_tokens=0, cost_usd=0.0))
+        ledger.record(record(user_id="user_2", outcome="error", prompt_tokens=0, completion_tokens=0, cost_usd=0.0))
+        before = await ledger.user_report("user_1", 1)
+        assert await ledger.flush() == 3
+        after = await ledger.user_report("user_1", 1)
+        models = await ledger.model_report(1)
+        await ledger.stop()
+        return before, after, models
+
+    before, after, models = asyncio.run(scenario())
+    assert before["totals"]["requests"] == 0
+    totals = after["totals"]
+    assert (totals["requests"], totals["cached"], totals["errors"]) == (2, 1, 0)
+    assert (totals["prompt_tokens"], totals["completion_tokens"], totals["total_tokens"]) == (10, 5, 15)
+    assert totals["cost_usd"] == pytest.approx(0.001)
+    assert totals["avg_latency_ms"] == pytest.approx(200.0)
+    assert [m["model"] for m in after["models"]] == ["fake"]
+    assert (models["totals"]["requests"], models["totals"]["errors"]) == (3, 1)
+    assert (ledger.recorded, ledger.flushed, ledger.flushes) == (3, 3, 1)
+
+
+def test_full_batch_wakes_the_flusher():
+    store = MemoryUsageStore()
+    ledger = UsageLedger(store, flush_interval=60, batch_size=3)
+
+    async def scenario():
+        ledger.start()
+        for _ in range(3):
+            ledger.record(record())
+        await asyncio.sleep(0.05)
+        flushed = ledger.flushed
+        await ledger.stop()
+        return flushed
+
+    assert asyncio.run(scenario()) == 3
+
+
+def test_interval_flushes_a_partial_batch():
+    ledger = UsageLedger(MemoryUsageStore(), flush_interval=0.05, batch_size=100)
+
+    async def scenario():
+        ledger.start()
+        ledger.record(record())
+        await asyncio.sleep(0.2)
+        snapshot = ledger.snapshot()
+        await ledger.stop()
+        return snapshot
+
+    snapshot = asyncio.run(scenario())
+    assert (snapshot["flushed"], snapshot["buffered"]) == (1, 0)
+
+
+def test_failed_flush_keeps_the_batch_for_the_next_one():
+    store = FlakyStore(failures=1)
+    ledger = UsageLedger(store, flush_interval=60, batch_size=100)
+
+    async def scenario():
+        ledger.record(record())
+        ledger.record(record())
+        assert await ledger.flush() == 0
+        assert ledger.snapshot()["buffered"] == 2
+        ledger.record(record())
+        assert await ledger.flush() == 3
+        return await ledger.user_report("user_1", 1)
+
+    report = asyncio.run(scenario())
+    assert report["totals"]["requests"] == 3
+    assert (ledger.flush_failures, ledger.dropped) == (1, 0)
+
+
+def test_full_buffer_drops_new_records():
+    store = FlakyStore(failures=1)
+    ledger = UsageLedger(store, flush_interval=60, batch_size=100, max_buffer=2)
+
+    async def scenario():
+        for _ in range(3):
+            ledger.record(record())
+        assert ledger.dropped == 1
+        # The failed batch goes back into the buffer, which is then full again
+        await ledger.flush()
+        ledger.record(record())
+        await ledger.flush()
+
+    asyncio.run(scenario())
+    assert (ledger.recorded, ledger.flushed, ledger.dropped) == (2, 2, 2)
+
+
+def test_stop_flushes_what_is_left_and_closes_the_store():
+    store = FlakyStore(failures=0)
+    ledger = UsageLedger(store, flush_interval=60, batch_size=100)
+
+    async def scenario():
+        ledger.start()
+        ledger.record(record())
+        await ledger.stop()
+        return await store.user_rollups("user_1", "0000-00-00")
+
+    rows = asyncio.run(scenario())
+    assert rows[0]["requests"] == 1
+    assert store.closed
+
+
+def test_disabled_ledger_records_nothing():
+    ledger = UsageLedger(MemoryUsageStore(), enabled=False)
+    ledger.record(record())
+    assert ledger.snapshot()["buffered"] == 0
+
+
+def test_usage_reports_need_the_admin_token(client, monkeypatch):
+    import main
+
+    user_id = client.get("/api/user").json()["id"]
+    path = f"/api/usage/users/{user_id}"
+    monkeypatch.setattr(main, "USAGE_ADMIN_TOKEN", "")
+    assert client.get(path).status_code == 403
+
+    monkeypatch.setattr(main, "USAGE_ADMIN_TOKEN", "s3cret")
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get("/api/usage/models").status_code == 401
+    response = client.get(path, headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200
+    assert client.get("/api/usage/models", headers={"Authorization": "Bearer s3cret"}).status_code == 200
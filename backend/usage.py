@@ -0,0 +1,406 @@
+"""Token usage and cost ledger, written behind the request path.
+
+Each chat completion adds a `UsageRecord`: prompt and completion tokens
+(from the provider's `usage` report, else estimated with its tokenizer),
+latency, time to first token and estimated cost. Records are buffered in
+memory; a background task flushes them in batches every
+`USAGE_FLUSH_INTERVAL` seconds or once `USAGE_FLUSH_BATCH` records are
+waiting. Requests never wait on the store. If the store falls behind, past
+`USAGE_BUFFER_MAX` buffered records new ones are dropped and counted.
+
+Each flush folds the batch into daily rollups per (user, model) and per
+model in the same transaction that stores the raw rows. The report endpoints
+read only the rollups, so a query costs the number of days and models it
+covers, not the number of requests. Reports lag by at most one flush
+interval.
+
+`USAGE_STORE=sqlite` (default, `USAGE_DB_PATH`) keeps raw rows for
+`USAGE_RETENTION_DAYS` and is shared by worker processes.
+`USAGE_STORE=memory` keeps only the rollups in-process.
+`package.module:ClassName` loads a custom `UsageStore`. `USAGE_LEDGER_ENABLED=0`
+turns accounting off.
+"""
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import importlib
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "2"))
+USAGE_FLUSH_BATCH = int(os.getenv("USAGE_FLUSH_BATCH", "500"))
+USAGE_BUFFER_MAX = int(os.getenv("USAGE_BUFFER_MAX", "50000"))
+USAGE_RETENTION_DAYS = float(os.getenv("USAGE_RETENTION_DAYS", "90"))
+# Raw rows past retention are pruned at most this often
+USAGE_PRUNE_INTERVAL = 3600
+
+# Counters kept per rollup row, in column order
+ROLLUP_FIELDS = (
+    "requests", "cached", "errors", "cancelled", "estimated",
+    "prompt_tokens", "completion_tokens", "cost_usd", "latency_seconds",
+)
+
+
+@dataclass
+class UsageRecord:
+    """One completion as billed: `source` is upstream, cache, coalesced or fallback"""
+    user_id: str
+    model: str
+    outcome: str
+    source: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    estimated: bool = False
+    cost_usd: float = 0.0
+    latency_seconds: float = 0.0
+    ttft_seconds: Optional[float] = None
+    timestamp: float = field(default_factory=time.time)
+
+
+def day_of(ts: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+
+def rollup_deltas(records: List[UsageRecord]) -> Tuple[Dict[tuple, list], Dict[tuple, list]]:
+    """Sum a batch into (day, user_id, model) and (day, model) counter rows"""
+    by_user: Dict[tuple, list] = {}
+    by_model: Dict[tuple, list] = {}
+    for record in records:
+        day = day_of(record.timestamp)
+        values = (
+            1,
+            int(record.source in ("cache", "coalesced")),
+            int(record.outcome in ("error", "402")),
+            int(record.outcome == "cancelled"),
+            int(record.estimated),
+            record.prompt_tokens,
+            record.completion_tokens,
+            record.cost_usd,
+            record.latency_seconds,
+        )
+        for rollup, key in ((by_user, (day, record.user_id, record.model)), (by_model, (day, record.model))):
+            row = rollup.get(key)
+            if row is None:
+                rollup[key] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    row[i] += value
+    return by_user, by_model
+
+
+# --- Usage stores ---
+
+class UsageStore:
+    """Interface for ledger backends; rollup rows are dicts of `day`, `model` and ROLLUP_FIELDS"""
+
+    async def write(self, records: List[UsageRecord]) -> None:
+        """Store a batch and fold it into the rollups atomically"""
+        raise NotImplementedError
+
+    async def user_rollups(self, user_id: str, since_day: str) -> List[dict]:
+        raise NotImplementedError
+
+    async def model_rollups(self, since_day: str) -> List[dict]:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryUsageStore(UsageStore):
+    """Process-local rollups; raw records are not kept"""
+
+    def __init__(self):
+        self._by_user: Dict[tuple, list] = {}
+        self._by_model: Dict[tuple, list] = {}
+
+    async def write(self, records: List[UsageRecord]) -> None:
+        by_user, by_model = rollup_deltas(records)
+        for rollup, deltas in ((self._by_user, by_user), (self._by_model, by_model)):
+            for key, values in deltas.items():
+                row = rollup.setdefault(key, [0] * len(ROLLUP_FIELDS))
+                for i, value in enumerate(values):
+                    row[i] += value
+
+    async def user_rollups(self, user_id: str, since_day: str) -> List[dict]:
+        return [
+            {"day": day, "model": model, **dict(zip(ROLLUP_FIELDS, values))}
+            for (day, uid, model), values in self._by_user.items()
+            if uid == user_id and day >= since_day
+        ]
+
+    async def model_rollups(self, since_day: str) -> List[dict]:
+        return [
+            {"day": day, "model": model, **dict(zip(ROLLUP_FIELDS, values))}
+            for (day, model), values in self._by_model.items()
+            if day >= since_day
+        ]
+
+
+class SQLiteUsageStore(UsageStore):
+    """Raw usage rows plus daily rollup tables in a SQLite file shared by workers"""
+
+    def __init__(self, path: str, retention_days: float = USAGE_RETENTION_DAYS):
+        self.retention = retention_days * 86400
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        counters = ", ".join(
+            f"{name} {'REAL' if name in ('cost_usd', 'latency_seconds') else 'INTEGER'} NOT NULL DEFAULT 0"
+            for name in ROLLUP_FIELDS
+        )
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS usage_records ("
+            " id INTEGER PRIMARY KEY, timestamp REAL NOT NULL, user_id TEXT NOT NULL, model TEXT NOT NULL,"
+            " outcome TEXT NOT NULL, source TEXT NOT NULL, prompt_tokens INTEGER NOT NULL,"
+            " completion_tokens INTEGER NOT NULL, estimated INTEGER NOT NULL, cost_usd REAL NOT NULL,"
+            " latency_seconds REAL NOT NULL, ttft_seconds REAL);"
+            "CREATE INDEX IF NOT EXISTS idx_usage_records_time ON usage_records(timestamp);"
+            f"CREATE TABLE IF NOT EXISTS usage_user_daily (day TEXT NOT NULL, user_id TEXT NOT NULL,"
+            f" model TEXT NOT NULL, {counters}, PRIMARY KEY (user_id, day, model));"
+            f"CREATE TABLE IF NOT EXISTS usage_model_daily (day TEXT NOT NULL, model TEXT NOT NULL,"
+            f" {counters}, PRIMARY KEY (day, model));"
+        )
+        self._conn.commit()
+        columns = ", ".join(ROLLUP_FIELDS)
+        placeholders = ", ".join("?" for _ in ROLLUP_FIELDS)
+        increments = ", ".join(f"{name} = {name} + excluded.{name}" for name in ROLLUP_FIELDS)
+        self._upsert_user = (
+            f"INSERT INTO usage_user_daily (day, user_id, model, {columns}) VALUES (?, ?, ?, {placeholders})"
+            f" ON CONFLICT(user_id, day, model) DO UPDATE SET {increments}"
+        )
+        self._upsert_model = (
+            f"INSERT INTO usage_model_daily (day, model, {columns}) VALUES (?, ?, {placeholders})"
+            f" ON CONFLICT(day, model) DO UPDATE SET {increments}"
+        )
+
+    async def _run(self, fn, *args):
+        return await asyncio.to_thread(self._locked, fn, *args)
+
+    def _locked(self, fn, *args):
+        with self._lock:
+            return fn(*args)
+
+    def _write(self, records: List[UsageRecord]) -> None:
+        by_user, by_model = rollup_deltas(records)
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO usage_records (timestamp, user_id, model, outcome, source, prompt_tokens,"
+                " completion_tokens, estimated, cost_usd, latency_seconds, ttft_seconds)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (r.timestamp, r.user_id, r.model, r.outcome, r.source, r.prompt_tokens,
+                     r.completion_tokens, int(r.estimated), r.cost_usd, r.latency_seconds, r.ttft_seconds)
+                    for r in records
+                ],
+            )
+            self._conn.executemany(self._upsert_user, [(*key, *values) for key, values in by_user.items()])
+            self._conn.executemany(self._upsert_model, [(*key, *values) for key, values in by_model.items()])
+            now = time.time()
+            if self.retention > 0 and now - self._last_prune >= USAGE_PRUNE_INTERVAL:
+                self._last_prune = now
+                # Rollups outlive the raw rows they were built from
+                self._conn.execute("DELETE FROM usage_records WHERE timestamp < ?", (now - self.retention,))
+
+    def _rows(self, sql: str, params: tuple) -> List[dict]:
+        return [dict(row) for row in self._conn.execute(sql, params).fetchall()]
+
+    async def write(self, records: List[UsageRecord]) -> None:
+        await self._run(self._write, records)
+
+    async def user_rollups(self, user_id: str, since_day: str) -> List[dict]:
+        return await self._run(
+            self._rows,
+            f"SELECT day, model, {', '.join(ROLLUP_FIELDS)} FROM usage_user_daily WHERE user_id = ? AND day >= ?",
+            (user_id, since_day),
+        )
+
+    async def model_rollups(self, since_day: str) -> List[dict]:
+        return await self._run(
+            self._rows,
+            f"SELECT day, model, {', '.join(ROLLUP_FIELDS)} FROM usage_model_daily WHERE day >= ?",
+            (since_day,),
+        )
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def build_usage_store_from_env() -> UsageStore:
+    backend = os.getenv("USAGE_STORE", "sqlite")
+    if backend == "memory":
+        return MemoryUsageStore()
+    if backend == "sqlite":
+        path = os.getenv("USAGE_DB_PATH", "usage.db")
+        logger.info(f"Usage store: sqlite at {path}")
+        return SQLiteUsageStore(path)
+    module_name, _, class_name = backend.partition(":")
+    store_cls = getattr(importlib.import_module(module_name), class_name)
+    logger.info(f"Usage store: {backend}")
+    return store_cls()
+
+
+# --- Reports ---
+
+def summarize(rows: List[dict]) -> dict:
+    """Sum rollup rows into one set of totals with derived averages"""
+    totals = {name: 0 for name in ROLLUP_FIELDS}
+    for row in rows:
+        for name in ROLLUP_FIELDS:
+            totals[name] += row[name]
+    latency = totals.pop("latency_seconds")
+    totals["total_tokens"] = totals["prompt_tokens"] + totals["completion_tokens"]
+    totals["cost_usd"] = round(totals["cost_usd"], 6)
+    totals["avg_latency_ms"] = round(latency / totals["requests"] * 1000, 2) if totals["requests"] else None
+    return totals
+
+
+def group(rows: List[dict], key: str) -> Dict[str, List[dict]]:
+    groups: Dict[str, List[dict]] = {}
+    for row in rows:
+        groups.setdefault(row[key], []).append(row)
+    return groups
+
+
+# --- Ledger ---
+
+class UsageLedger:
+    """Buffers usage records and flushes them to a store in batches"""
+
+    def __init__(self, store: UsageStore, flush_interval: float = USAGE_FLUSH_INTERVAL,
+                 batch_size: int = USAGE_FLUSH_BATCH, max_buffer: int = USAGE_BUFFER_MAX, enabled: bool = True):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self.enabled = enabled
+        self.recorded = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.flush_failures = 0
+        self.last_flush_seconds: Optional[float] = None
+        self._buffer: List[UsageRecord] = []
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, record: UsageRecord) -> None:
+        """Queue a record; never blocks and never raises into the request"""
+        if not self.enabled:
+            return
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        self._buffer.append(record)
+        self.recorded += 1
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    async def flush(self) -> int:
+        """Write everything buffered so far; returns the number of records stored"""
+        async with self._flush_lock:
+            batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0
+            started = time.perf_counter()
+            try:
+                await self.store.write(batch)
+            except Exception as e:
+                self.flush_failures += 1
+                # Keep the batch for the next flush, as far as the buffer allows
+                kept = batch[:max(0, self.max_buffer - len(self._buffer))]
+                self._buffer[:0] = kept
+                self.dropped += len(batch) - len(kept)
+                logger.error(f"Usage flush of {len(batch)} records failed: {str(e)}")
+                return 0
+            self.last_flush_seconds = time.perf_counter() - started
+            self.flushes += 1
+            self.flushed += len(batch)
+            return len(batch)
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        if self.enabled and self._task is None:
+            self._stopping = False
+            # Bound to the running loop, which may differ from the one at import time
+            self._wake = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flush what is left and close the store"""
+        if self._task is not None:
+            # Let the loop finish its current write rather than cancelling it midway
+            self._stopping = True
+            self._wake.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        await self.store.close()
+
+    @staticmethod
+    def since_day(days: int) -> str:
+        return day_of(time.time() - (days - 1) * 86400)
+
+    async def user_report(self, user_id: str, days: int) -> dict:
+        """A user's totals, per-model and per-day usage over the last `days` days"""
+        since = self.since_day(days)
+        rows = await self.store.user_rollups(user_id, since)
+        return {
+            "user_id": user_id,
+            "since": since,
+            "totals": summarize(rows),
+            "models": [{"model": model, **summarize(group_rows)} for model, group_rows in sorted(group(rows, "model").items())],
+            "days": [{"day": day, **summarize(group_rows)} for day, group_rows in sorted(group(rows, "day").items())],
+        }
+
+    async def model_report(self, days: int) -> dict:
+        """Totals and per-model usage across all users over the last `days` days"""
+        since = self.since_day(days)
+        rows = await self.store.model_rollups(since)
+        return {
+            "since": since,
+            "totals": summarize(rows),
+            "models": [{"model": model, **summarize(group_rows)} for model, group_rows in sorted(group(rows, "model").items())],
+        }
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.store).__name__,
+            "buffered": len(self._buffer),
+            "recorded": self.recorded,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "flush_failures": self.flush_failures,
+            "last_flush_seconds": self.last_flush_seconds,
+            "flush_interval": self.flush_interval,
+            "batch_size": self.batch_size,
+        }
+
+
+# Process-wide usage ledger fed by the chat path
+ledger = UsageLedger(
+    build_usage_store_from_env(),
+    enabled=os.getenv("USAGE_LEDGER_ENABLED", "1").lower() in ("1", "true", "yes"),
+)
@@ -3,25 +3,42 @@ class ApiCache {
   constructor() {
     this.cache = new Map();
     this.timestamps = new Map();
+    this.etags = new Map();
     this.DEFAULT_TTL = 5 * 60 * 1000; // 5 minutes
   }
 
-  set(key, data, ttl = this.DEFAULT_TTL) {
+  set(key, data, ttl = this.DEFAULT_TTL, etag = null) {
     this.cache.set(key, data);
     this.timestamps.set(key, Date.now() + ttl);
+    if (etag) {
+      this.etags.set(key, etag);
+    } else {
+      this.etags.delete(key);
+    }
   }
 
   get(key) {
     const timestamp = this.timestamps.get(key);
     if (!timestamp || Date.now() > timestamp) {
-      // Expired or doesn't exist
-      this.cache.delete(key);
-      this.timestamps.delete(key);
+      // Expired or doesn't exist; keep entries with an ETag for revalidation
+      if (!this.etags.has(key)) {
+        this.cache.delete(key);
+        this.timestamps.delete(key);
+      }
       return null;
     }
     return this.cache.get(key);
   }
 
+  // Expired entry that can be revalidated with If-None-Match
+  getStale(key) {
+    const etag = this.etags.get(key);
+    if (!etag || !this.cache.has(key)) {
+      return null;
+    }
+    return { data: this.cache.get(key), etag };
+  }
+
   has(key) {
     return this.get(key) !== null;
   }
@@ -29,6 +46,7 @@ class ApiCache {
   clear() {
     this.cache.clear();
     this.timestamps.clear();
+    this.etags.clear();
   }
 
   // Get cache info for debugging
@@ -61,12 +79,28 @@ export async function cachedFetch(url, options = {}, cacheTTL) {
 
   console.log(`Cache miss for: ${fullUrl}`);
   
+  // Revalidate an expired copy instead of downloading the full payload again
+  const stale = options.force ? null : apiCache.getStale(cacheKey);
+  const requestOptions = stale
+    ? { ...options, headers: { ...(options.headers || {}), 'If-None-Match': stale.etag } }
+    : options;
+  
   try {
-    const response = await fetch(fullUrl, options);
+    const response = await fetch(fullUrl, requestOptions);
+    
+    if (response.status === 304 && stale) {
+      console.log(`Revalidated cached copy for: ${fullUrl}`);
+      apiCache.set(cacheKey, stale.data, cacheTTL, stale.etag);
+      return {
+        ok: true,
+        status: 200,
+        json: () => Promise.resolve(stale.data)
+      };
+    }
     
     if (response.ok) {
       const data = await response.json();
-      apiCache.set(cacheKey, data, cacheTTL);
+      apiCache.set(cacheKey, data, cacheTTL, response.headers.get('ETag'));
       
       // Return a response-like object
       return {
@@ -90,6 +124,7 @@ export function invalidateCache(pattern) {
     if (key.includes(pattern)) {
       apiCache.cache.delete(key);
       apiCache.timestamps.delete(key);
+      apiCache.etags.delete(key);
     }
   });
 }
@@ -15,8 +15,10 @@ export function UserProvider({ children }) {
     setIsLoading(true);
     
     try {
-      // Always get a new user from backend
-      const response = await cachedFetch('/api/user', {
+      // Reuse the stored identity if there is one; the backend issues a new one otherwise
+      const storedId = localStorage.getItem('user-id');
+      const url = storedId ? `/api/user?user_id=${encodeURIComponent(storedId)}` : '/api/user';
+      const response = await cachedFetch(url, {
         signal: AbortSignal.timeout(3000) // 3 second timeout
       }, 5 * 60 * 1000); // Cache for 5 minutes
       